@@ -3,15 +3,24 @@ import os , sys
 from .utils import *
 from katapult.core     import KatapultError , KatapultInstance , KatapultInstanceState , KatapultPlatform
 from katapult.core     import bcolors , kt_keypairName , kt_secGroupName , kt_secGroupNameMaestro , kt_bucketName , kt_vpcName , kt_maestroRoleName , kt_maestroProfileName, kt_maestroPolicyName , init_instance_name
+from katapult.core     import kt_imageNameRoot , kt_tagBaseImage , kt_tagEnvSet , kt_tagEnvPrefix
 from katapult.provider import debug
 from katapult.providerfat import KatapultFatProvider
 from katapult.providerlight import KatapultLightProvider
+from katapult.transfer import STAGING_PREFIX , ENV_ARTIFACT_PREFIX
+from katapult.fanout import P2P_PORT
 from botocore.exceptions import ClientError
 from datetime import datetime , timedelta
 from botocore.config import Config
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
+from dateutil import parser as dateparser
 import asyncio
+import hashlib
+import threading
+import gzip
+
+_staging_lock = threading.Lock()
 
 def aws_get_session(profile_name , region ):
     if profile_name and region:
@@ -208,6 +217,21 @@ def aws_create_vpc(session,region,cloudId=None):
 
     return vpc 
 
+# the instances of the group can reach each other's peer server (peer-to-peer fan-out of the shared inputs)
+def aws_allow_peer_traffic(ec2_client,group_id):
+    try:
+        ec2_client.authorize_security_group_ingress(
+            GroupId=group_id,
+            IpPermissions=[
+                {'IpProtocol': 'tcp',
+                'FromPort': P2P_PORT,
+                'ToPort': P2P_PORT,
+                'UserIdGroupPairs': [{'GroupId': group_id}]}
+            ])
+    except ClientError as e:
+        if 'InvalidPermission.Duplicate' not in str(e):
+            debug(1,"Could not allow the peer-to-peer traffic",e,color=bcolors.WARNING)
+
 def aws_create_security_group(session,region,vpc):
     debug(1,"Creating SECURITY GROUP ...")
     secGroup = None
@@ -251,6 +275,8 @@ def aws_create_security_group(session,region,vpc):
         debug(1,"An unknown error occured while creating the security group")
         #sys.exit()
         raise KatapultError()
+
+    aws_allow_peer_traffic(ec2_client,secGroup['GroupId'])
     
     debug(2,secGroup) 
 
@@ -327,7 +353,7 @@ def aws_create_subnet(session,region,vpc):
         return subnet
     return None # todo: create a subnet
 
-def aws_create_bucket(session,region):
+def aws_create_bucket(session,region,bucket_name=kt_bucketName):
 
     debug(1,"Creating BUCKET ...")
     s3_client = session.client('s3')
@@ -337,33 +363,60 @@ def aws_create_bucket(session,region):
 
     try :
 
-        bucket = s3_client.create_bucket(
-            ACL='private',
-            Bucket=kt_bucketName,
-            CreateBucketConfiguration={
-                'LocationConstraint': region
-            },
-
-        )
+        if region == 'us-east-1':
+            # us-east-1 doesn't accept a LocationConstraint
+            s3_client.create_bucket(
+                ACL='private',
+                Bucket=bucket_name
+            )
+        else:
+            s3_client.create_bucket(
+                ACL='private',
+                Bucket=bucket_name,
+                CreateBucketConfiguration={
+                    'LocationConstraint': region
+                },
+            )
 
     except ClientError as e:
         errMsg = str(e)
         if 'BucketAlreadyExists' in errMsg:
-            bucket = s3.Bucket(kt_bucketName)
-        elif 'BucketAlreadyOwnedByYou' in errMsg:
-            bucket = s3.Bucket(kt_bucketName)
+            # someone else's bucket or ours (created concurrently)
+            try:
+                s3_client.head_bucket( Bucket=bucket_name )
+            except ClientError as e2:
+                raise KatapultError("Could not create the bucket "+bucket_name+": "+errMsg)
+        elif 'BucketAlreadyOwnedByYou' not in errMsg:
+            raise KatapultError("Could not create the bucket "+bucket_name+": "+errMsg)
+
+    bucket = s3.Bucket(bucket_name)
 
     debug(2,bucket)
 
     return bucket 
 
+def aws_file_exists_in_bucket( session , bucket_name , key ):
+    s3_client = session.client('s3')
+    try:
+        s3_client.head_object( Bucket=bucket_name , Key=key )
+        return True
+    except ClientError as e:
+        return False
 
-def aws_upload_file( session , region , bucket , file_path ):
-    debug(1,"uploading FILE ...")
+def aws_upload_file( session , region , bucket_name , file_path , key ):
+    debug(1,"uploading FILE",file_path,"to",bucket_name,"...")
     s3_client = session.client('s3')
     #s3_client = boto3.client('s3', config=aws_get_config(region))
-    response = s3_client.upload_file( file_path, bucket['BucketName'], 'cr-run-script' )
+    try:
+        response = s3_client.upload_file( file_path, bucket_name, key )
+    except ClientError as e:
+        raise KatapultError("Could not upload "+file_path+" to the bucket "+bucket_name+": "+str(e))
     debug(2,response)
+    return key
+
+def aws_get_presigned_url( session , bucket_name , key , expiration , method='get_object' ):
+    s3_client = session.client('s3')
+    return s3_client.generate_presigned_url( method , Params={ 'Bucket' : bucket_name , 'Key' : key } , ExpiresIn=expiration )
 
 def aws_find_instance(session,instance_config):
 
@@ -406,7 +459,21 @@ def aws_find_instance(session,instance_config):
         return None 
 
 
-def aws_create_instance(session,instance_config,vpc,subnet,secGroup,keypair_name):
+# EC2 limit of the user data (before base64 encoding)
+kt_userDataMaxSize = 16 * 1024
+
+# cloud-init accepts gzipped user data (the runner files would not fit otherwise)
+# returns None if the script is still too large
+def aws_get_user_data(script):
+    if not script:
+        return None
+    user_data = gzip.compress(script.encode(),compresslevel=9)
+    if len(user_data) > kt_userDataMaxSize:
+        debug(1,"The boot script is too large for the user data (",len(user_data),"bytes ): the environments will be bootstrapped when deploying",color=bcolors.WARNING)
+        return None
+    return user_data
+
+def aws_create_instance(session,instance_config,vpc,subnet,secGroup,keypair_name,img_id=None,user_data=None):
 
     debug(1,"Creating INSTANCE ...")
 
@@ -496,9 +563,16 @@ def aws_create_instance(session,instance_config,vpc,subnet,secGroup,keypair_name
     else:
         block_device_mapping = [ ]
 
+    if img_id:
+        debug(1,"Launching from the golden image",img_id)
+
+    # the boot script installs the runner files and bootstraps the environments ('boot_bootstrap')
+    user_data_spec = { 'UserData' : user_data } if user_data else { }
+
     try:
         instances = ec2_client.run_instances(
-                ImageId = instance_config['img_id'],
+                **user_data_spec,
+                ImageId = img_id or instance_config['img_id'],
                 MinCount = 1,
                 MaxCount = 1,
                 InstanceType = instance_config['type'],
@@ -556,18 +630,110 @@ def aws_create_instance(session,instance_config,vpc,subnet,secGroup,keypair_name
 
     return instance , created
 
-def aws_create_instance_objects(session,instance_config,keypair_name,key_filename):
+def aws_create_instance_objects(session,instance_config,keypair_name,key_filename,img_id=None,user_data=None):
     region   = instance_config.get('region')
     keypair , kcreated = aws_create_keypair(session,region,keypair_name,key_filename)
     vpc      = aws_create_vpc(session,region,instance_config.get('cloud_id')) 
     secGroup = aws_create_security_group(session,region,vpc)
     subnet   = aws_create_subnet(session,region,vpc) 
     # this is where all the instance_config is actually used
-    instance , created = aws_create_instance(session,instance_config,vpc,subnet,secGroup,keypair_name)
+    instance , created = aws_create_instance(session,instance_config,vpc,subnet,secGroup,keypair_name,img_id,user_data)
 
     return instance , created 
 
 
+# Golden images: bootstrapped instances are baked into images tagged with the environments they contain
+
+def aws_get_env_set_key(base_img_id,env_names):
+    return hashlib.sha1( ( str(base_img_id) + ':' + ','.join(sorted(env_names)) ).encode() ).hexdigest()
+
+def aws_get_image_envs(image):
+    return set( tag['Key'][len(kt_tagEnvPrefix):] for tag in image.get('Tags') or [] if tag['Key'].startswith(kt_tagEnvPrefix) )
+
+def aws_get_image_tag(image,key):
+    for tag in image.get('Tags') or []:
+        if tag['Key'] == key:
+            return tag['Value']
+    return None
+
+def aws_describe_baked_images(ec2_client,filters):
+    images = ec2_client.describe_images( Owners=['self'] , Filters=filters )['Images']
+    return [ image for image in images if image.get('State','available') in ['available','pending'] ]
+
+# the image (baked from base_img_id) holding the most environments of env_names (the most recent one first)
+def aws_find_baked_image(session,base_img_id,env_names):
+    ec2_client = session.client("ec2")
+    images = aws_describe_baked_images(ec2_client,[ { 'Name' : 'tag:'+kt_tagBaseImage , 'Values' : [ base_img_id ] } ])
+    best_image = None
+    best_score = ( 0 , '' )
+    for image in images:
+        if image.get('State','available') != 'available':
+            continue
+        score = ( len(aws_get_image_envs(image) & set(env_names)) , image.get('CreationDate','') )
+        if score[0] > 0 and score > best_score:
+            best_image = image
+            best_score = score
+    if best_image is None:
+        return None
+    debug(2,"Found golden image",best_image['ImageId'],"with",best_score[0],"environment(s)")
+    return best_image['ImageId']
+
+def aws_create_baked_image(session,instance,base_img_id,env_names):
+    ec2_client = session.client("ec2")
+    key = aws_get_env_set_key(base_img_id,env_names)
+    if aws_describe_baked_images(ec2_client,[ { 'Name' : 'tag:'+kt_tagEnvSet , 'Values' : [ key ] } ]):
+        debug(2,"Golden image already baked for",env_names)
+        return None
+    name = kt_imageNameRoot + '-' + key[:16] + '-' + datetime.now().strftime('%Y%m%d%H%M%S')
+    debug(1,"Baking golden image",name,"from",instance.get_name(),"...")
+    try:
+        image = ec2_client.create_image(
+            InstanceId=instance.get_id(),
+            Name=name,
+            Description=('katapult golden image ('+', '.join(sorted(env_names))+')')[:255],
+            NoReboot=True
+        )
+        tags = [
+            { 'Key' : 'Name' , 'Value' : name } ,
+            { 'Key' : kt_tagBaseImage , 'Value' : base_img_id } ,
+            { 'Key' : kt_tagEnvSet , 'Value' : key }
+        ] + [ { 'Key' : kt_tagEnvPrefix + env_name , 'Value' : '1' } for env_name in sorted(env_names) ]
+        # 50 tags max per resource
+        ec2_client.create_tags( Resources=[ image['ImageId'] ] , Tags=tags[:50] )
+    except ClientError as e:
+        raise KatapultError("Could not bake the image of "+instance.get_name()+": "+str(e))
+    return image['ImageId']
+
+# keeps the last 'keep' images of every environments set
+# and removes the images (+snapshots) that have no environment in use anymore and are older than max_age days
+def aws_gc_baked_images(session,env_names,keep=1,max_age=7):
+    ec2_client = session.client("ec2")
+    images = aws_describe_baked_images(ec2_client,[ { 'Name' : 'tag-key' , 'Values' : [ kt_tagEnvSet ] } ])
+    env_sets = dict()
+    for image in images:
+        env_sets.setdefault( aws_get_image_tag(image,kt_tagEnvSet) , [] ).append(image)
+    now = datetime.now().astimezone()
+    removed = []
+    for key , set_images in env_sets.items():
+        set_images.sort( key = lambda image : image.get('CreationDate','') , reverse=True )
+        for i , image in enumerate(set_images):
+            in_use  = len(aws_get_image_envs(image) & set(env_names)) > 0
+            created = dateparser.parse(image['CreationDate']) if image.get('CreationDate') else now
+            if created.tzinfo is None:
+                created = created.astimezone()
+            if i < keep and ( in_use or now - created < timedelta(days=max_age) ):
+                continue
+            debug(1,"Removing stale golden image",image['ImageId'])
+            try:
+                ec2_client.deregister_image( ImageId=image['ImageId'] )
+                for mapping in image.get('BlockDeviceMappings') or []:
+                    if mapping.get('Ebs',{}).get('SnapshotId'):
+                        ec2_client.delete_snapshot( SnapshotId=mapping['Ebs']['SnapshotId'] )
+                removed.append(image['ImageId'])
+            except ClientError as e:
+                debug(1,"Could not remove the golden image",image['ImageId'],e,color=bcolors.WARNING)
+    return removed
+
 def aws_start_instance(session,instance):
     region  = instance.get_region()
     ec2_client = session.client("ec2")
@@ -889,7 +1055,23 @@ class AWSKatapultProviderImpl():
         keypair_name = self.get_keypair_name(self._profile_name,config.get('region'))
         key_filename = self.get_key_filename(self._profile_name,config.get('region'))
         session = self.get_session(config)
-        return aws_create_instance_objects(session,config,keypair_name,key_filename)
+        img_id  = self.find_baked_image(config,self._get_bake_env_names()) if self._config.get('bake_images',False) else None
+        user_data = aws_get_user_data(self._get_boot_script(config))
+        return aws_create_instance_objects(session,config,keypair_name,key_filename,img_id,user_data)
+
+    def find_baked_image(self,config,env_names):
+        if not env_names:
+            return None
+        session = self.get_session(config)
+        return aws_find_baked_image(session,config.get('img_id'),env_names)
+
+    def bake_image(self,instance,env_names):
+        session = self.get_session(instance)
+        return aws_create_baked_image(session,instance,instance.get_config('img_id'),env_names)
+
+    def gc_baked_images(self,region,env_names):
+        session = self.get_session(region)
+        return aws_gc_baked_images(session,env_names,self._config.get('baked_images_keep',1),self._config.get('baked_images_max_age',7))
 
     def start_instance(self,instance):
         session = self.get_session(instance)
@@ -920,6 +1102,36 @@ class AWSKatapultProviderImpl():
         session = self.get_session(region)
         return aws_get_suggested_image(session,region)
 
+    # the files are stored once in the bucket (keyed by content hash) and pulled by the instances with a presigned URL
+    # the bucket used to stage the files and cache the packed environments
+    def _get_staging_bucket(self):
+        region = self._config.get('staging_region') or self.get_region()
+        session = self.get_session(region)
+        bucket_name = self._config.get('staging_bucket') or kt_bucketName+'-'+str(self.get_account_id())+'-'+str(region)
+        with _staging_lock: # called from several threads
+            if getattr(self,'_staging_bucket',None) != bucket_name:
+                aws_create_bucket(session,region,bucket_name)
+                self._staging_bucket = bucket_name
+        return session , region , bucket_name
+
+    def stage_file(self,local_path,file_hash,expiration):
+        session , region , bucket_name = self._get_staging_bucket()
+        key = STAGING_PREFIX + file_hash
+        if not aws_file_exists_in_bucket(session,bucket_name,key):
+            aws_upload_file(session,region,bucket_name,local_path,key)
+            uploaded = True
+        else:
+            uploaded = False
+        return aws_get_presigned_url(session,bucket_name,key,expiration) , uploaded
+
+    def env_artifact_urls(self,env_name,expiration):
+        session , region , bucket_name = self._get_staging_bucket()
+        key = ENV_ARTIFACT_PREFIX + env_name + '.tar.gz'
+        urls = { 'put' : aws_get_presigned_url(session,bucket_name,key,expiration,'put_object') }
+        if aws_file_exists_in_bucket(session,bucket_name,key):
+            urls['get'] = aws_get_presigned_url(session,bucket_name,key,expiration)
+        return urls
+
     def get_session(self,obj):
         if isinstance(obj,dict):
             region = obj.get('region')
@@ -980,6 +1192,21 @@ class AWSKatapultFatProvider(KatapultFatProvider,AWSKatapultProviderImpl):
     def get_suggested_image(self,region):
         return AWSKatapultProviderImpl.get_suggested_image(self,region)
 
+    def stage_file(self,local_path,file_hash,expiration):
+        return AWSKatapultProviderImpl.stage_file(self,local_path,file_hash,expiration)
+
+    def env_artifact_urls(self,env_name,expiration):
+        return AWSKatapultProviderImpl.env_artifact_urls(self,env_name,expiration)
+
+    def find_baked_image(self,config,env_names):
+        return AWSKatapultProviderImpl.find_baked_image(self,config,env_names)
+
+    def bake_image(self,instance,env_names):
+        return AWSKatapultProviderImpl.bake_image(self,instance,env_names)
+
+    def gc_baked_images(self,region,env_names):
+        return AWSKatapultProviderImpl.gc_baked_images(self,region,env_names)
+
     def get_recommended_cpus(self,inst_cfg):
         return self._get_instancetypes_attribute(inst_cfg,"instancetypes-aws.csv","Instance type","Valid cores",list)
 
@@ -1034,6 +1261,21 @@ class AWSKatapultLightProvider(KatapultLightProvider,AWSKatapultProviderImpl):
     def get_suggested_image(self,region):
         return AWSKatapultProviderImpl.get_suggested_image(self,region)
 
+    def stage_file(self,local_path,file_hash,expiration):
+        return AWSKatapultProviderImpl.stage_file(self,local_path,file_hash,expiration)
+
+    def env_artifact_urls(self,env_name,expiration):
+        return AWSKatapultProviderImpl.env_artifact_urls(self,env_name,expiration)
+
+    def find_baked_image(self,config,env_names):
+        return AWSKatapultProviderImpl.find_baked_image(self,config,env_names)
+
+    def bake_image(self,instance,env_names):
+        return AWSKatapultProviderImpl.bake_image(self,instance,env_names)
+
+    def gc_baked_images(self,region,env_names):
+        return AWSKatapultProviderImpl.gc_baked_images(self,region,env_names)
+
     def grant_admin_rights(self,instance):
         session = self.get_session(instance)
         aws_grant_admin_rights(session,instance)   
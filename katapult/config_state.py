@@ -244,6 +244,40 @@ class ConfigManager():
                 else:
                     job.attach_env(env)
 
+        # the jobs consuming the outputs of other jobs ('depends_on' : names or ranks of the jobs)
+        for job in self._jobs:
+            depends_on = job.get_config('depends_on')
+            if not depends_on:
+                continue
+            if isinstance(depends_on,(str,int)):
+                depends_on = [ depends_on ]
+            for dep_ref in depends_on:
+                deps = [ j for j in self._jobs if j is not job and ( j.get_rank() == dep_ref if isinstance(dep_ref,int) else j.get_name() == dep_ref ) ]
+                if not deps:
+                    print("FATAL ERROR - could not find the job",dep_ref,"that job",job.get_rank(),"depends on")
+                    sys.exit()
+                for dep in deps:
+                    job.add_dependency(dep)
+        if self._has_circular_dependencies():
+            print("FATAL ERROR - the dependencies between the jobs are circular")
+            sys.exit()
+
+    def _has_circular_dependencies(self):
+        visiting , visited = set() , set()
+        def visit(job):
+            if job in visited:
+                return False
+            if job in visiting:
+                return True
+            visiting.add(job)
+            for dep in job.get_dependencies():
+                if visit(dep):
+                    return True
+            visiting.discard(job)
+            visited.add(job)
+            return False
+        return any( visit(job) for job in self._jobs )
+
     def _sanity_checks(self):
         if len(self._instances) > 10:
             self._provider.debug(1,"\033[91mWATCH OUT ! You are creating more than 10 instances - not allowed for now!\033[0m")
@@ -0,0 +1,171 @@
+import asyncio
+import asyncssh
+import os
+
+# keepalive defaults (seconds / number of missed keepalives before the connection is dropped)
+SSH_KEEPALIVE_INTERVAL  = 15
+SSH_KEEPALIVE_COUNT_MAX = 3
+
+# readiness probe of the instances ('readiness':'ssh')
+SSH_PROBE_TIMEOUT       = 3
+SSH_PROBE_PERIOD        = 2
+
+# True if a SSH server answers on host:port (we only read its banner: no authentication, no key exchange)
+async def probe_ssh_banner(host,port=22,timeout=SSH_PROBE_TIMEOUT):
+    writer = None
+    try:
+        reader , writer = await asyncio.wait_for(asyncio.open_connection(host,port),timeout)
+        banner = await asyncio.wait_for(reader.readline(),timeout)
+        return banner.startswith(b'SSH-')
+    except (OSError,asyncio.TimeoutError,ValueError):
+        return False
+    finally:
+        if writer is not None:
+            writer.close()
+
+class KatapultSSHClient(asyncssh.SSHClient):
+
+    # asyncssh doesn't expose a public 'is_closed' so we track it through the client callbacks
+
+    def __init__(self):
+        self._closed = False
+
+    def connection_lost(self,exc):
+        self._closed = True
+
+    def is_closed(self):
+        return self._closed
+
+class KatapultConnectionEntry():
+
+    def __init__(self,ssh_conn,ssh_client,loop):
+        self.ssh_conn   = ssh_conn
+        self.ssh_client = ssh_client
+        self.ftp_client = None
+        self.loop       = loop
+
+    def is_alive(self):
+        if self.ssh_conn is None or self.ssh_client is None:
+            return False
+        if self.ssh_client.is_closed():
+            return False
+        # connections are bound to the event loop they have been created in
+        try:
+            return self.loop is asyncio.get_running_loop()
+        except RuntimeError:
+            return False
+
+    def close(self):
+        if self.ftp_client is not None:
+            try:
+                self.ftp_client.exit()
+            except:
+                pass
+        if self.ssh_conn is not None:
+            try:
+                self.ssh_conn.close()
+            except:
+                pass
+        self.ftp_client = None
+        self.ssh_conn   = None
+
+# Pool of live SSH connections (+ SFTP client) keyed by instance name
+# The actual connection is made by the provider (connect_coro) so we keep its retry / reboot logic
+class KatapultConnectionPool():
+
+    def __init__(self,connect_coro,enabled=True,keepalive_interval=SSH_KEEPALIVE_INTERVAL,keepalive_count_max=SSH_KEEPALIVE_COUNT_MAX):
+        self._connect_coro  = connect_coro
+        self._enabled       = enabled
+        self._keepalive_interval  = keepalive_interval
+        self._keepalive_count_max = keepalive_count_max
+        self._entries = dict()
+        self._locks   = dict()
+        self._keys    = dict()
+        self._stats   = { 'hits' : 0 , 'misses' : 0 , 'reconnects' : 0 , 'keys_loaded' : 0 }
+
+    def is_enabled(self):
+        return self._enabled
+
+    def get_stats(self):
+        stats = dict(self._stats)
+        stats['connections'] = len([ e for e in self._entries.values() if e.is_alive() ])
+        return stats
+
+    def get_connect_options(self):
+        return {
+            'client_factory'      : KatapultSSHClient ,
+            'keepalive_interval'  : self._keepalive_interval ,
+            'keepalive_count_max' : self._keepalive_count_max
+        }
+
+    # parsed private keys are cached and only re-read if the file has changed
+    def get_private_key(self,keypair_filename):
+        mtime = os.path.getmtime(keypair_filename)
+        cached = self._keys.get(keypair_filename)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        k = asyncssh.read_private_key(keypair_filename)
+        self._keys[keypair_filename] = ( mtime , k )
+        self._stats['keys_loaded'] += 1
+        return k
+
+    def invalidate_key(self,keypair_filename):
+        self._keys.pop(keypair_filename,None)
+
+    def _get_lock(self,name):
+        loop = asyncio.get_running_loop()
+        lock_entry = self._locks.get(name)
+        if lock_entry is None or lock_entry[0] is not loop:
+            lock_entry = ( loop , asyncio.Lock() )
+            self._locks[name] = lock_entry
+        return lock_entry[1]
+
+    async def acquire(self,instance,with_sftp=True,**kwargs):
+        if not self._enabled:
+            self._stats['misses'] += 1
+            ssh_conn = await self._connect_coro(instance,**kwargs)
+            if ssh_conn is None:
+                return None , None
+            ftp_client = await ssh_conn.start_sftp_client() if with_sftp else None
+            return ssh_conn , ftp_client
+
+        name = instance.get_name()
+        async with self._get_lock(name):
+            entry = self._entries.get(name)
+            if entry is not None and entry.is_alive():
+                self._stats['hits'] += 1
+            else:
+                if entry is not None:
+                    # half-open / dropped / other loop
+                    self._stats['reconnects'] += 1
+                    entry.close()
+                    self._entries.pop(name,None)
+                else:
+                    self._stats['misses'] += 1
+                ssh_conn = await self._connect_coro(instance,**kwargs)
+                if ssh_conn is None:
+                    return None , None
+                entry = KatapultConnectionEntry(ssh_conn,ssh_conn.get_owner(),asyncio.get_running_loop())
+                self._entries[name] = entry
+            if with_sftp and entry.ftp_client is None:
+                entry.ftp_client = await entry.ssh_conn.start_sftp_client()
+            return entry.ssh_conn , entry.ftp_client
+
+    # the connection is kept alive in the pool unless the pool is disabled
+    def release(self,instance,ssh_conn):
+        if ssh_conn is None:
+            return
+        entry = self._entries.get(instance.get_name())
+        if not self._enabled or entry is None or entry.ssh_conn is not ssh_conn:
+            ssh_conn.close()
+
+    # drop the connection (for example when we know the instance has been rebooted or disconnected)
+    def discard(self,instance):
+        entry = self._entries.pop(instance.get_name(),None)
+        if entry is not None:
+            entry.close()
+
+    def close_all(self):
+        for name , entry in self._entries.items():
+            entry.close()
+        self._entries = dict()
@@ -19,6 +19,10 @@ kt_environmentNameRoot = 'katapult-env'
 kt_maestroProfileName  = 'katapult-maestro-profile'
 kt_maestroRoleName     = 'katapult-maestro-role'
 kt_maestroPolicyName   = 'katapult-maestro-policy'
+kt_imageNameRoot       = 'katapult-image'
+kt_tagBaseImage        = 'katapult-base-image'  # golden images: the image they have been baked from
+kt_tagEnvSet           = 'katapult-env-set'     # golden images: key of the environments set
+kt_tagEnvPrefix        = 'katapult-env:'        # golden images: one tag per environment (name with hash)
 
 # NEW > STARTED > ASSIGNED > DEPLOYED > ( RUNNING | WATCHING <-> IDLE )
 
@@ -87,6 +91,14 @@ class KatapultProcessState(IntFlag):
     UNKNOWN   = 64 # set != 0 otherwise it may test positive when watching
     ANY       = 64 + 32 + 16 + 8 + 4 + 2 + 1 
 
+# characters of the tasks states of an array job (tasks.state)
+TASK_STATES = {
+    '.' : KatapultProcessState.QUEUE ,
+    'r' : KatapultProcessState.RUNNING ,
+    'd' : KatapultProcessState.DONE ,
+    'a' : KatapultProcessState.ABORTED
+}
+
 class KatapultPlatform(IntFlag):
     UNKNOWN     = 0
     LINUX       = 1
@@ -289,6 +301,14 @@ class KatapultInstance():
         env = job.get_env()
         self._envs[env.get_name()] = env 
 
+    # the job is moved to another instance (dynamic dispatch)
+    def remove_job(self,job):
+        if job in self._jobs:
+            self._jobs.remove(job)
+
+    def has_environment(self,env):
+        return env.get_name() in self._envs
+
     def get_environments(self):
         return self._envs.values()
 
@@ -345,8 +365,7 @@ class KatapultEnvironment():
     def __init__(self,projectName,env_config):
         self._config   = env_config
         self._project  = projectName
-        _env_obj       = katapultutils.compute_environment_object(env_config)
-        self._hash     = katapultutils.compute_environment_hash(_env_obj)
+        self._hash     = katapultutils.compute_environment_object_hash(env_config)
         if not self._config.get('name'):
             self._name = kt_environmentNameRoot
 
@@ -441,11 +460,17 @@ class KatapultJob():
         self._env       = None
         self._instance  = None
         self._deployed = [ ]
+        self._dependencies = [ ] # the jobs whose outputs this job consumes ('depends_on')
         if not 'input_files' in self._config:
             print("\033[20minput name missing for Job\033[0m",self)
         if not 'output_files' in self._config:
             print("\033[91mConfiguration requires an output file name\033[0m",self)
             raise KatapultError() 
+        try:
+            self.get_array_range()
+        except (TypeError,ValueError,IndexError,KeyError):
+            print("\033[91mThe 'array' of a job should be a number of tasks or a [START,STOP] range\033[0m",self)
+            raise KatapultError() 
 
     def attach_env(self,env):
         self._env = env 
@@ -472,6 +497,48 @@ class KatapultJob():
     def get_rank(self):
         return self._rank
 
+    def get_name(self):
+        return self.get_config('name')
+
+    def get_dependencies(self):
+        return getattr(self,'_dependencies',[])
+
+    # this job runs once 'job' is done, with the output files of 'job' in its run directory
+    def add_dependency(self,job):
+        if job is self:
+            raise KatapultError('A job can not depend on itself')
+        if job not in self._dependencies:
+            self._dependencies.append(job)
+
+    # array job ('array' : N or [START,STOP]): (START,STOP) of the task indices or None
+    def get_array_range(self):
+        array = self.get_config('array')
+        if array is None or array is False:
+            return None
+        if isinstance(array,int):
+            return ( 0 , array )
+        return ( int(array[0]) , int(array[1]) )
+
+    def is_array(self):
+        return self.get_array_range() is not None
+
+    # output files of the job
+    # for an array job, the names with '{index}' are expanded for the given task indices
+    def get_output_files(self,indices=None):
+        out_files = self.get_config('output_files') or []
+        if not self.is_array():
+            return out_files
+        if indices is None:
+            # the files common to all the tasks
+            return [ f for f in out_files if '{index}' not in f ]
+        res = []
+        for out_file in out_files:
+            if '{index}' in out_file:
+                res.extend( [ out_file.replace('{index}',str(i)) for i in indices ] )
+            else:
+                res.append( out_file )
+        return res
+
     def get_deployed_jobs(self):
         return self._deployed
 
@@ -580,6 +647,10 @@ class KatapultDeployedJob(KatapultJob):
     def attach_process(self,process):
         self._processes.append(process)
 
+    # the job this job has been deployed from
+    def get_parent_job(self):
+        return self._job
+
     def get_path(self):
         return self._path
 
@@ -593,6 +664,10 @@ class KatapultDeployedJob(KatapultJob):
     def get_rank(self):
         return self._job._rank
 
+    # proxied
+    def get_dependencies(self):
+        return self._job.get_dependencies()
+
     # proxied
     def get_hash(self):
         return self._job._hash
@@ -644,6 +719,7 @@ class KatapultProcess():
         self._active = True
         self._aborted_reason = None
         self._substate = None
+        self._tasks_state = None # array jobs: one character per task (see arrayrun.py)
         self._job.attach_process(self)
      
     def get_uid(self):
@@ -696,6 +772,28 @@ class KatapultProcess():
     def set_aborted_reason(self,reason):
         self._aborted_reason = reason 
 
+    def set_tasks_state(self,value):
+        self._tasks_state = value
+
+    def get_tasks_state(self):
+        return getattr(self,'_tasks_state',None)
+
+    # state of a task of an array job (index in the range of the array)
+    def get_task_state(self,index):
+        tasks_state = self.get_tasks_state()
+        array_range = self._job.get_array_range()
+        if not tasks_state or not array_range or not ( array_range[0] <= index < array_range[1] ):
+            return KatapultProcessState.UNKNOWN
+        return TASK_STATES.get( tasks_state[index-array_range[0]] , KatapultProcessState.UNKNOWN )
+
+    # task indices of an array job in the given state(s)
+    def get_tasks_indices(self,state=KatapultProcessState.DONE):
+        tasks_state = self.get_tasks_state()
+        array_range = self._job.get_array_range()
+        if not tasks_state or not array_range:
+            return []
+        return [ array_range[0]+i for i , c in enumerate(tasks_state) if TASK_STATES.get(c,KatapultProcessState.UNKNOWN) & state ]
+
     def set_pid(self,value):
         self._pid = value 
 
@@ -0,0 +1,101 @@
+import asyncio
+import asyncssh
+from katapult.core import KatapultError
+
+# defaults for the peer-to-peer distribution of the shared inputs ('upload_mode':'p2p')
+P2P_PORT          = 8756              # the security group allows this port between the instances
+P2P_MIN_SIZE      = 16 * 1024 * 1024  # smaller files are pushed directly by the client
+P2P_CLIENT_SLOTS  = 1                 # number of instances the client pushes the same content to in parallel
+P2P_SERVE_TIMEOUT = 900               # the peer server exits after this idle time (seconds)
+
+# Something that holds a content and can serve it:
+# the client itself (instance=None) or an instance that has already received it
+class KatapultFanoutSource():
+
+    def __init__(self,instance=None,ssh_conn=None,path=None,slots=1):
+        self.instance = instance
+        self.ssh_conn = ssh_conn
+        self.path     = path
+        self.slots    = slots
+        self.busy     = 0
+
+    def is_client(self):
+        return self.instance is None
+
+    def is_free(self):
+        return self.busy < self.slots
+
+# Distribution tree of the shared contents
+# - every source (the client first) serves one receiver at a time
+# - a receiver becomes a source as soon as it holds the content
+# so the number of sources doubles at every round: log2(instances) rounds instead of one push per instance
+# The fan-out is only coordinating: the actual transfers are done by the push / fetch coroutines
+class KatapultFanout():
+
+    def __init__(self,client_slots=P2P_CLIENT_SLOTS):
+        self._client_slots = client_slots
+        self._contents  = dict() # ( group , hash ) -> [ sources ]
+        self._servers   = dict() # instance name -> task starting its peer server
+        self._condition = asyncio.Condition()
+        self._stats     = { 'pushed' : 0 , 'peered' : 0 , 'failed_peers' : 0 }
+
+    def get_stats(self):
+        return dict(self._stats)
+
+    def _pick(self,sources):
+        # peers first: the client uplink is the bottleneck
+        for source in sources:
+            if not source.is_client() and source.is_free():
+                return source
+        for source in sources:
+            if source.is_client() and source.is_free():
+                return source
+        return None
+
+    # the peer servers only have to be started once per instance
+    def get_server(self,instance,start_coro):
+        task = self._servers.get(instance.get_name())
+        if task is None or ( task.done() and ( task.cancelled() or task.exception() is not None ) ):
+            task = asyncio.ensure_future(start_coro())
+            self._servers[instance.get_name()] = task
+        return task
+
+    # gets a content to the receiver (holder = KatapultFanoutSource of the receiver, once it has the content)
+    # - push()         : sends the content from the client, returns an error or None
+    # - fetch(source)  : makes the receiver download the content from the source, returns an error or None
+    # peers that fail are not used anymore and we try again with another source (ultimately the client)
+    async def obtain(self,group,content_hash,holder,push,fetch):
+        key = ( group , content_hash )
+        sources = self._contents.get(key)
+        if sources is None:
+            sources = [ KatapultFanoutSource(slots=self._client_slots) ]
+            self._contents[key] = sources
+
+        while True:
+            async with self._condition:
+                source = await self._condition.wait_for(lambda: self._pick(sources))
+                source.busy += 1
+            try:
+                if source.is_client():
+                    error = await push()
+                else:
+                    error = await fetch(source)
+            except (OSError, asyncssh.Error, KatapultError) as e:
+                error = e
+            except asyncio.CancelledError:
+                source.busy -= 1
+                raise
+            async with self._condition:
+                source.busy -= 1
+                if error is None:
+                    sources.append(holder)
+                elif not source.is_client() and source in sources:
+                    sources.remove(source)
+                self._condition.notify_all()
+
+            if error is None:
+                self._stats['pushed' if source.is_client() else 'peered'] += 1
+                return None
+            if source.is_client():
+                return error
+            self._stats['failed_peers'] += 1
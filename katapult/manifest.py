@@ -0,0 +1,88 @@
+import hashlib
+import json
+import os
+import threading
+
+HASH_CACHE_FILE   = 'state.hashes.json'
+REMOTE_MANIFEST   = '.manifest.json'
+HASH_BLOCK_SIZE   = 1024 * 1024
+
+def compute_file_hash(path):
+    sha = hashlib.sha256()
+    with open(path,'rb') as the_file:
+        while True:
+            block = the_file.read(HASH_BLOCK_SIZE)
+            if not block:
+                break
+            sha.update(block)
+    return sha.hexdigest()
+
+# Local cache of (size, mtime, content hash) per absolute path
+# so unchanged files are not re-hashed on every deploy
+class KatapultHashCache():
+
+    def __init__(self,cache_file=HASH_CACHE_FILE):
+        self._cache_file = cache_file
+        self._entries    = None
+        self._dirty      = False
+        # get() runs in the executor threads
+        self._lock       = threading.Lock()
+
+    def _load(self):
+        if self._entries is not None:
+            return
+        self._entries = dict()
+        try:
+            with open(self._cache_file,'r') as cache_file:
+                self._entries = json.loads(cache_file.read())
+        except (OSError,ValueError):
+            pass
+
+    # returns ( size , hash ) - raises FileNotFoundError if the file doesnt exist
+    def get(self,path):
+        path  = os.path.abspath(path)
+        st    = os.stat(path)
+        with self._lock:
+            self._load()
+            entry = self._entries.get(path)
+        if entry is not None and entry[0] == st.st_size and entry[1] == st.st_mtime:
+            return entry[0] , entry[2]
+        # (hashed outside of the lock: the other files are not waiting on this one)
+        file_hash = compute_file_hash(path)
+        with self._lock:
+            self._entries[path] = [ st.st_size , st.st_mtime , file_hash ]
+            self._dirty = True
+        return st.st_size , file_hash
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            content = json.dumps(self._entries)
+            self._dirty = False
+        try:
+            with open(self._cache_file,'w') as cache_file:
+                cache_file.write(content)
+        except OSError:
+            with self._lock:
+                self._dirty = True
+
+# Remote manifest: remote path -> content hash
+class KatapultManifest():
+
+    def __init__(self,content=None):
+        self._entries = dict()
+        if content:
+            try:
+                self._entries = json.loads(content)
+            except ValueError:
+                self._entries = dict()
+
+    def get(self,remote_path):
+        return self._entries.get(remote_path)
+
+    def set(self,remote_path,file_hash):
+        self._entries[remote_path] = file_hash
+
+    def dumps(self):
+        return json.dumps(self._entries)
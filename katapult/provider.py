@@ -12,6 +12,16 @@ from enum import IntFlag
 import asyncio
 import asyncssh
 import importlib
+import secrets
+import urllib.parse
+from katapult.connpool import KatapultConnectionPool , probe_ssh_banner , SSH_PROBE_TIMEOUT , SSH_PROBE_PERIOD
+from katapult.transfer import KatapultUploader , KatapultTransferStats , KatapultChunkedTransfer , upload_tar_stream
+from katapult.transfer import UPLOAD_CONCURRENCY , UPLOAD_FLEET_CONCURRENCY , SFTP_BLOCK_SIZE , SFTP_MAX_REQUESTS
+from katapult.transfer import LARGE_FILE_THRESHOLD , LARGE_FILE_CHUNK_SIZE , LARGE_FILE_PARALLEL , LARGE_FILE_CHANNELS
+from katapult.transfer import STAGING_URL_EXPIRATION , STAGING_PULL_PARALLEL
+from katapult.fanout import KatapultFanout , KatapultFanoutSource , P2P_PORT , P2P_MIN_SIZE , P2P_CLIENT_SLOTS , P2P_SERVE_TIMEOUT
+from katapult.manifest import KatapultHashCache , KatapultManifest , REMOTE_MANIFEST , compute_file_hash
+from katapult.scanner import KatapultImportCache , get_stdlib_names
 
 COMMAND_ARGS_SEP = '__:__'
 ARGS_SEP         = '__,__'
@@ -58,6 +68,26 @@ class KatapultProvider(ABC):
 
         self._mock_server = None 
 
+        # persistent SSH connections (+SFTP) per instance
+        self._conn_pool = KatapultConnectionPool(self._open_connection,
+                                                 enabled=conf.get('ssh_pool',True),
+                                                 keepalive_interval=conf.get('ssh_keepalive_interval',15),
+                                                 keepalive_count_max=conf.get('ssh_keepalive_count_max',3))
+
+        # instances whose SSH server has answered the readiness probe (name -> id)
+        self._ssh_ready = dict()
+
+        # local (size,mtime,hash) cache for the content manifests
+        self._hash_cache = KatapultHashCache()
+        # instance name -> ( loop , lock ) of the remote manifests (concurrent deploys on the same instance)
+        self._manifest_locks = dict()
+
+        # what the client has sent to the staging bucket ('upload_mode':'bucket')
+        self._staging_stats = KatapultTransferStats()
+
+        # the peer servers only serve the URLs with this token ('upload_mode':'p2p')
+        self._p2p_token = secrets.token_hex(16)
+
     def debug_set_prefix(self,value):
         self.DBG_PREFIX = value
         global DBG_PREFIX
@@ -178,17 +208,77 @@ class KatapultProvider(ABC):
         # wait for instance to be ready 
         await self._wait_for_instance(instance)
 
-        # connect to instance
-        ssh_conn = await self._connect_to_instance(instance)
+        # connect to instance (or re-use the pooled connection)
+        ssh_conn , ftp_client = await self._conn_pool.acquire(instance)
         if ssh_conn is not None:
-            ftp_client = await ssh_conn.start_sftp_client()
-
             return instance.get_id() , ssh_conn , ftp_client        
         else:
             return instance.get_id() , None , None
 
+    # give the connection back to the pool (closes it if pooling is disabled)
+    def _release_connection(self,instance,ssh_conn):
+        self._conn_pool.release(instance,ssh_conn)
+
+    # forget the pooled connection (after a reboot, a disconnection etc.)
+    def _discard_connection(self,instance):
+        self._conn_pool.discard(instance)
+
+    def get_connection_stats(self):
+        return self._conn_pool.get_stats()
+
+    # the fleet-wide cap on in-flight uploads (semaphores are bound to the running loop)
+    def _get_fleet_upload_semaphore(self):
+        loop = asyncio.get_running_loop()
+        if getattr(self,'_fleet_upload_semaphore',None) is None or self._fleet_upload_semaphore[0] is not loop:
+            self._fleet_upload_semaphore = ( loop , asyncio.Semaphore(self._config.get('upload_fleet_concurrency',UPLOAD_FLEET_CONCURRENCY)) )
+        return self._fleet_upload_semaphore[1]
+
+    def _get_manifest_lock(self,instance):
+        loop = asyncio.get_running_loop()
+        lock_entry = self._manifest_locks.get(instance.get_name())
+        if lock_entry is None or lock_entry[0] is not loop:
+            lock_entry = ( loop , asyncio.Lock() )
+            self._manifest_locks[instance.get_name()] = lock_entry
+        return lock_entry[1]
+
+    def _get_uploader(self,ftp_client):
+        return KatapultUploader(ftp_client,
+                                concurrency=self._config.get('upload_concurrency',UPLOAD_CONCURRENCY),
+                                fleet_semaphore=self._get_fleet_upload_semaphore(),
+                                block_size=self._config.get('sftp_block_size',SFTP_BLOCK_SIZE),
+                                max_requests=self._config.get('sftp_max_requests',SFTP_MAX_REQUESTS))
+
+    def get_upload_stats(self):
+        return getattr(self,'_upload_stats',dict())
+
+    def get_staging_stats(self):
+        return self._staging_stats.summary()
+
+    # readiness probe: the instance is ready as soon as its SSH server answers
+    # (the EC2 status checks report it minutes later)
+    async def _is_ssh_ready(self,instance):
+        if self._config.get('readiness','ssh') != 'ssh':
+            return False
+        if instance.get_state() != KatapultInstanceState.RUNNING:
+            self._ssh_ready.pop(instance.get_name(),None)
+            return False
+        if self._ssh_ready.get(instance.get_name()) == instance.get_id():
+            return True
+        if self._mock_server: # mock/testing mode
+            host , port = self._mock_server.hostname , self._mock_server.port
+        else:
+            host , port = instance.get_dns_addr() , 22
+        if not await probe_ssh_banner(host,port,self._config.get('ssh_probe_timeout',SSH_PROBE_TIMEOUT)):
+            return False
+        self._ssh_ready[instance.get_name()] = instance.get_id()
+        return True
+
     async def _wait_for_instance(self,instance,with_reachability=False):
         
+        # 'ssh'    : wait for the SSH server to answer (or for the status checks to be ok)
+        # 'status' : only wait for the status checks when asked to (with_reachability)
+        probe_ssh = self._config.get('readiness','ssh') == 'ssh'
+
         # get the public DNS info when instance actually started (todo: check actual state)
         waitFor = True
         while waitFor:
@@ -203,6 +293,11 @@ class KatapultProvider(ABC):
             instanceState    = instance.get_state()
             reachability     = instance.get_reachability()
 
+            if probe_ssh and not lookForDNS and not reachability:
+                reachability = await self._is_ssh_ready(instance)
+                if reachability:
+                    instance.set_reachability(True)
+
             lookForState = True
             # 'pending'|'running'|'shutting-down'|'terminated'|'stopping'|'stopped'
             if instanceState == KatapultInstanceState.STOPPED:
@@ -222,7 +317,7 @@ class KatapultProvider(ABC):
                 except:
                     pass
 
-            if with_reachability:
+            if with_reachability or probe_ssh:
                 waitFor = lookForDNS or lookForState or not reachability
             else:
                 waitFor = lookForDNS or lookForState
@@ -236,15 +331,22 @@ class KatapultProvider(ABC):
                         debug(1,"waiting for",instance.get_name(),"...",instanceState.name," IP =",instance.get_ip_addr())
                     elif with_reachability and not reachability:
                         debug(1,"waiting for",instance.get_name(),"...",instanceState.name," IP =",instance.get_ip_addr(),"(waiting to be reachable)")
+                    elif probe_ssh and not reachability:
+                        debug(1,"waiting for",instance.get_name(),"...",instanceState.name," IP =",instance.get_ip_addr(),"(waiting for SSH)")
                     else:
                         debug(1,"waiting for",instance.get_name(),"...",instanceState.name," IP =",instance.get_ip_addr())
-                 
-                await asyncio.sleep(10)
+
+                # the SSH probe is cheap: check more often once the instance is running
+                if probe_ssh and not lookForDNS and not lookForState:
+                    await asyncio.sleep(self._config.get('ssh_probe_period',SSH_PROBE_PERIOD))
+                else:
+                    await asyncio.sleep(10)
 
         self.debug(2,instance)     
 
     # async because the one of the fat client will be async ...
     async def hard_reset_instance(self,instance):
+        self._discard_connection(instance)
         self.terminate_instance(instance)
         try :
             self._start_and_update_instance(instance)
@@ -267,6 +369,10 @@ class KatapultProvider(ABC):
         self._mock_server  = mock_server 
 
     async def _connect_to_instance(self,instance,**kwargs):
+        ssh_conn , ftp_client = await self._conn_pool.acquire(instance,with_sftp=False,**kwargs)
+        return ssh_conn
+
+    async def _open_connection(self,instance,**kwargs):
         # ssh into instance and run the script 
         region = instance.get_region()
         #if region is None:
@@ -282,11 +388,14 @@ class KatapultProvider(ABC):
                 #self.create_keypair(region)
                 await self._refresh_instance_key(instance)
             try:
-                k = asyncssh.read_private_key(keypair_filename)
+                k = self._conn_pool.get_private_key(keypair_filename)
             except:
                 # key file exists but is invalid >> try again
+                self._conn_pool.invalidate_key(keypair_filename)
                 await self._refresh_instance_key(instance)
-                k = asyncssh.read_private_key(keypair_filename)
+                k = self._conn_pool.get_private_key(keypair_filename)
+
+        kwargs = { **self._conn_pool.get_connect_options() , **kwargs }
 
         self.debug(1,"connecting to",instance.get_name(),"@",instance.get_ip_addr())
         retrys = 0 
@@ -398,8 +507,8 @@ class KatapultProvider(ABC):
                 self.debug(2,sshe)
                 raise sshe
 
-    async def sftp_put_remote_file(self,ftp_client,name):
-        ofile = await ftp_client.open(name,'w')
+    async def sftp_put_remote_file(self,ftp_client,name,remote_path=None):
+        ofile = await ftp_client.open(remote_path or name,'w')
         await ofile.write(self._get_remote_file(name))
         await ofile.close()
 
@@ -416,6 +525,384 @@ class KatapultProvider(ABC):
         await ofile.write(string)
         await ofile.close()
 
+    # run a list of operations (stat, mkdir, rm, chmod, symlink, write) in one round trip
+    # returns the list of results (same order as ops)
+    async def _remote_ops(self,instance,ssh_conn,ops,ftp_client=None,ops_py=None):
+        if not ops:
+            return []
+        if ops_py is None:
+            ops_py = instance.path_join( instance.get_global_dir() , 'remote_ops.py' )
+        payload = json.dumps(ops)
+        self.debug(2,"Executing",len(ops),"remote operations")
+        attempts = 0
+        while True:
+            try:
+                proc = await ssh_conn.run("python3 "+ops_py,input=payload)
+                results = json.loads(proc.stdout)
+                break
+            except (OSError, asyncssh.Error) as sshe:
+                self.debug(1,'SSH connection failed: ' + str(sshe),color=bcolors.FAIL)
+                raise sshe
+            except ValueError:
+                # the helper is likely missing (instance deployed with an older version): upload it
+                if attempts > 0:
+                    raise KatapultError("Could not run remote operations on "+instance.get_name()+": "+str(proc.stderr))
+                attempts += 1
+                if ftp_client is None:
+                    ftp_client = await ssh_conn.start_sftp_client()
+                await ftp_client.makedirs(instance.path_dirname(ops_py),exist_ok=True)
+                await self.sftp_put_remote_file(ftp_client,'remote_ops.py',ops_py)
+        for op , result in zip(ops,results):
+            if not result.get('ok'):
+                self.debug(1,"Remote operation failed",op,result.get('error'),color=bcolors.WARNING)
+        return results
+
+    def _is_large_file(self,size):
+        threshold = self._config.get('large_file_threshold',LARGE_FILE_THRESHOLD)
+        return threshold is not None and size >= threshold
+
+    # chunked/parallel/resumable transfers of large files
+    # items = [ ( local_path , remote_path , size ) ] ; direction = 'put' | 'get'
+    # returns the errors aligned with items
+    async def _transfer_large_files(self,instance,ssh_conn,ftp_client,direction,items,stats=None,ops_py=None):
+        if not items:
+            return []
+        loop = asyncio.get_running_loop()
+
+        async def hash_local(path):
+            if direction == 'put':
+                size , file_hash = await loop.run_in_executor(None,self._hash_cache.get,path)
+                return file_hash
+            return await loop.run_in_executor(None,compute_file_hash,path)
+
+        async def hash_remote(path):
+            results = await self._remote_ops(instance,ssh_conn,[ { 'op' : 'hash' , 'path' : path } ],ftp_client,ops_py)
+            return results[0].get('hash')
+
+        extra_clients = []
+        errors = []
+        try:
+            for i in range(self._config.get('large_file_channels',LARGE_FILE_CHANNELS)-1):
+                extra_clients.append( await ssh_conn.start_sftp_client() )
+            transfer = KatapultChunkedTransfer([ ftp_client ] + extra_clients , hash_local , hash_remote ,
+                                               chunk_size=self._config.get('large_file_chunk_size',LARGE_FILE_CHUNK_SIZE),
+                                               parallel=self._config.get('large_file_parallel',LARGE_FILE_PARALLEL),
+                                               stats=stats)
+            for local_path , remote_path , size in items:
+                self.debug(1,"transferring large file",local_path,"<>" ,remote_path,"(",size,"bytes )")
+                try:
+                    if direction == 'put':
+                        await transfer.put(local_path,remote_path)
+                    else:
+                        await transfer.get(remote_path,local_path,size)
+                    errors.append(None)
+                except (OSError, asyncssh.Error) as e:
+                    self.debug(1,"Error while transferring",local_path,e,color=bcolors.FAIL)
+                    errors.append(e)
+        finally:
+            for client in extra_clients:
+                client.exit()
+        self._hash_cache.save()
+        return errors
+
+    # stages a file in the bucket (once per content for the whole fleet)
+    # returns the URL the instances can pull it from (None if the provider doesn't support staging)
+    async def _stage_file(self,local_path):
+        loop = asyncio.get_running_loop()
+        size , file_hash = await loop.run_in_executor(None,self._hash_cache.get,local_path)
+        expiration = self._config.get('staging_url_expiration',STAGING_URL_EXPIRATION)
+        if getattr(self,'_staged_files',None) is None or self._staged_files[0] is not loop:
+            self._staged_files = ( loop , dict() )
+        staged = self._staged_files[1]
+
+        async def stage():
+            t0 = time.perf_counter()
+            result = await loop.run_in_executor(None,self.stage_file,local_path,file_hash,expiration)
+            if result is None:
+                return None , None
+            url , uploaded = result
+            if uploaded:
+                self._staging_stats.add(file_hash,size,time.perf_counter()-t0)
+            return url , time.time() + expiration
+
+        task = staged.get(file_hash)
+        if task is not None and task.done():
+            # failed or about to expire: stage it again
+            if task.cancelled() or task.exception() is not None or ( task.result()[1] is not None and task.result()[1] - time.time() < expiration / 2 ):
+                task = None
+        if task is None:
+            task = asyncio.ensure_future(stage())
+            staged[file_hash] = task
+        url , expires = await task
+        return url
+
+    # 'upload_mode':'bucket' - the client uploads each unique file once to the staging bucket
+    # and the instance pulls its files in parallel (presigned URLs)
+    # returns a list of booleans (pulled or not) aligned with files
+    async def _pull_staged_files(self,instance,ssh_conn,ftp_client,files,stats,ops_py=None):
+        pulled = [ False ] * len(files)
+        self._staging_stats.start()
+        urls = await asyncio.gather( *[ self._stage_file(local_path) for local_path , remote_path in files ] , return_exceptions=True )
+        self._staging_stats.stop()
+        self._hash_cache.save()
+
+        items   = []
+        indices = []
+        for i , url in enumerate(urls):
+            if url is None:
+                self.debug(1,"The provider doesn't support staging files, falling back to SFTP",color=bcolors.WARNING)
+                return pulled
+            if isinstance(url,Exception):
+                self.debug(1,"Could not stage",files[i][0],url,color=bcolors.WARNING)
+                continue
+            items.append( { 'url' : url , 'path' : files[i][1] } )
+            indices.append(i)
+        if not items:
+            return pulled
+
+        parallel = self._config.get('staging_pull_parallel',STAGING_PULL_PARALLEL)
+        results  = await self._remote_ops(instance,ssh_conn,[ { 'op' : 'fetch' , 'items' : items , 'parallel' : parallel } ],ftp_client,ops_py)
+        fetch_errors = results[0].get('errors') or [ results[0].get('error') ] * len(items)
+        for i , error in zip(indices,fetch_errors):
+            if error is None:
+                pulled[i] = True
+                stats.pulled += 1
+            else:
+                self.debug(1,"Could not pull",files[i][1],"from the bucket",error,color=bcolors.WARNING)
+        return pulled
+
+    # 'env_cache':True - presigned URLs of the packed environment (None if not available)
+    async def _get_env_artifact_urls(self,dpl_env):
+        if not self._config.get('env_cache',False):
+            return None
+        loop = asyncio.get_running_loop()
+        expiration = self._config.get('staging_url_expiration',STAGING_URL_EXPIRATION)
+        try:
+            return await loop.run_in_executor(None,self.env_artifact_urls,dpl_env.get_name_with_hash(),expiration)
+        except KatapultError as e:
+            self.debug(1,"Could not get the packed environment of",dpl_env.get_name_with_hash(),e,color=bcolors.WARNING)
+            return None
+
+    # the distribution tree of the current deploy ('upload_mode':'p2p') - bound to the running loop
+    def _get_fanout(self):
+        loop = asyncio.get_running_loop()
+        if getattr(self,'_fanout',None) is None or self._fanout[0] is not loop:
+            self._fanout = ( loop , KatapultFanout(self._config.get('p2p_client_slots',P2P_CLIENT_SLOTS)) )
+        return self._fanout[1]
+
+    def _reset_fanout(self):
+        self._fanout = None
+
+    # instances can only reach each other through their private IPs in the same region
+    def _get_fanout_group(self,instance):
+        if not instance.get_ip_addr_priv():
+            return None
+        return instance.get_region()
+
+    async def _start_peer_server(self,instance,ssh_conn):
+        script = instance.path_join( instance.get_global_dir() , 'p2p_serve.py' )
+        command = "python3 {0} {1} {2} {3} {4} {5}".format(script,instance.get_ip_addr_priv(),P2P_PORT,self._p2p_token,instance.get_home_dir(),self._config.get('p2p_serve_timeout',P2P_SERVE_TIMEOUT))
+        proc = await ssh_conn.run(command)
+        if proc.exit_status != 0:
+            raise KatapultError("Could not start the peer server on "+instance.get_name()+": "+str(proc.stderr))
+        return "http://{0}:{1}/{2}".format(instance.get_ip_addr_priv(),P2P_PORT,self._p2p_token)
+
+    # url of a file served by p2p_serve.py (base_url from _start_peer_server)
+    def _get_peer_url(self,base_url,path):
+        return base_url + urllib.parse.quote(path)
+
+    # the instance downloads the file from the peer (source) over the private network
+    async def _fetch_from_peer(self,source,instance,ssh_conn,remote_path,ops_py=None):
+        fanout = self._get_fanout()
+        base_url = await fanout.get_server(source.instance,lambda: self._start_peer_server(source.instance,source.ssh_conn))
+        self.debug(2,"fetching",remote_path,"from peer",source.instance.get_name())
+        results = await self._remote_ops(instance,ssh_conn,[ { 'op' : 'fetch' , 'items' : [ { 'url' : self._get_peer_url(base_url,source.path) , 'path' : remote_path } ] } ],None,ops_py)
+        errors = results[0].get('errors') or [ results[0].get('error') ]
+        if errors[0] is not None:
+            self.debug(1,"Could not fetch",remote_path,"from peer",source.instance.get_name(),errors[0],color=bcolors.WARNING)
+            return KatapultError(errors[0])
+        return None
+
+    # 'upload_mode':'p2p' - the client pushes a shared file to one instance
+    # and the instances then copy it from each other (see KatapultFanout)
+    # returns a list of errors (None, an error or False if the file hasn't been handled) aligned with files
+    async def _fan_out_files(self,instance,ssh_conn,ftp_client,uploader,files,ops_py=None):
+        results = [ False ] * len(files)
+        group   = self._get_fanout_group(instance)
+        if group is None:
+            return results
+        loop     = asyncio.get_running_loop()
+        min_size = self._config.get('p2p_min_size',P2P_MIN_SIZE)
+        fanout   = self._get_fanout()
+        stats    = uploader.get_stats()
+
+        async def obtain(i):
+            local_path , remote_path = files[i]
+            try:
+                size , file_hash = await loop.run_in_executor(None,self._hash_cache.get,local_path)
+            except OSError:
+                return # the error will be reported by the uploader
+            if size < min_size:
+                return
+
+            async def push():
+                errors = await self._push_files(instance,ssh_conn,ftp_client,uploader,[ files[i] ],ops_py)
+                return errors[0]
+
+            async def fetch(source):
+                error = await self._fetch_from_peer(source,instance,ssh_conn,remote_path,ops_py)
+                if error is None:
+                    stats.peered += 1
+                return error
+
+            holder = KatapultFanoutSource(instance,ssh_conn,remote_path)
+            results[i] = await fanout.obtain(group,file_hash,holder,push,fetch)
+
+        await asyncio.gather( *[ obtain(i) for i in range(len(files)) ] )
+        self._hash_cache.save()
+        return results
+
+    # sends the files:
+    # - 'upload_mode':'bucket' : pulled by the instance from the staging bucket (the others are pushed)
+    # - 'upload_mode':'p2p'    : large shared files are fanned out between the instances (the others are pushed)
+    # - otherwise pushed with the uploader (SFTP) or as one compressed tar stream ('upload_mode':'tar')
+    async def _send_files(self,instance,ssh_conn,ftp_client,uploader,files,ops_py=None):
+        upload_mode = self._config.get('upload_mode','sftp')
+        if upload_mode == 'p2p' and files:
+            results = await self._fan_out_files(instance,ssh_conn,ftp_client,uploader,files,ops_py)
+            errors  = [ None if result is False else result for result in results ]
+            rest    = [ i for i , result in enumerate(results) if result is False ]
+            rest_errors = await self._push_files(instance,ssh_conn,ftp_client,uploader,[ files[i] for i in rest ],ops_py)
+            for i , error in zip(rest,rest_errors):
+                errors[i] = error
+            return errors
+        if upload_mode == 'bucket' and files:
+            pulled = await self._pull_staged_files(instance,ssh_conn,ftp_client,files,uploader.get_stats(),ops_py)
+            errors = [ None ] * len(files)
+            rest   = [ i for i , ok in enumerate(pulled) if not ok ]
+            rest_errors = await self._push_files(instance,ssh_conn,ftp_client,uploader,[ files[i] for i in rest ],ops_py)
+            for i , error in zip(rest,rest_errors):
+                errors[i] = error
+            return errors
+        return await self._push_files(instance,ssh_conn,ftp_client,uploader,files,ops_py)
+
+    # large files are always sent in chunks
+    async def _push_files(self,instance,ssh_conn,ftp_client,uploader,files,ops_py=None):
+        errors = [ None ] * len(files)
+        large  = []
+        small  = []
+        for i , ( local_path , remote_path ) in enumerate(files):
+            try:
+                size = os.path.getsize(local_path)
+            except OSError:
+                size = 0 # the error will be reported by the uploader
+            if self._is_large_file(size):
+                large.append( ( i , size ) )
+            else:
+                small.append( i )
+
+        large_errors = await self._transfer_large_files(instance,ssh_conn,ftp_client,'put',[ ( files[i][0] , files[i][1] , size ) for i , size in large ],uploader.get_stats(),ops_py)
+        for ( i , size ) , error in zip(large,large_errors):
+            errors[i] = error
+
+        small_files = [ files[i] for i in small ]
+        small_errors = None
+        if self._config.get('upload_mode','sftp') == 'tar' and len(small_files) > 1:
+            tar_stats = KatapultTransferStats()
+            try:
+                await upload_tar_stream(ssh_conn,small_files,self._config.get('upload_compression','gzip'),tar_stats)
+                uploader.get_stats().merge(tar_stats)
+                small_errors = [ None ] * len(small_files)
+            except (OSError, asyncssh.Error) as e:
+                self.debug(1,"Could not stream the files as a tar archive, falling back to SFTP",e,color=bcolors.WARNING)
+        if small_errors is None:
+            small_errors = await uploader.upload(small_files)
+        for i , error in zip(small,small_errors):
+            errors[i] = error
+
+        return errors
+
+    # uploads files = [ ( local_path , remote_path ) ] using the content manifest stored in manifest_dir
+    # - unchanged files (same hash in the remote manifest and same remote size) are not re-sent
+    # - identical contents are only sent once (the other paths are copied remotely)
+    # returns the errors (aligned with files) and the transfer stats
+    async def _upload_files(self,instance,ssh_conn,ftp_client,files,manifest_dir,ops_py=None):
+        uploader = self._get_uploader(ftp_client)
+
+        if not self._config.get('upload_manifest',True):
+            errors = await self._send_files(instance,ssh_conn,ftp_client,uploader,files,ops_py)
+            return errors , uploader.get_stats()
+
+        loop   = asyncio.get_running_loop()
+        stats  = uploader.get_stats()
+        errors = [ None ] * len(files)
+        hashes = [ None ] * len(files)
+
+        # (hashing a big input takes a while: it must not block the deploys of the other instances)
+        async def get_hash(i):
+            try:
+                hashes[i] = await loop.run_in_executor(None,self._hash_cache.get,files[i][0])
+            except OSError as e:
+                errors[i] = e
+                stats.errors += 1
+
+        await asyncio.gather( *[ get_hash(i) for i in range(len(files)) ] )
+        self._hash_cache.save()
+
+        manifest_path = instance.path_join( manifest_dir , REMOTE_MANIFEST )
+        ops = [ { 'op' : 'read' , 'path' : manifest_path } ] + [ { 'op' : 'stat' , 'path' : remote_path } for local_path , remote_path in files ]
+        results  = await self._remote_ops(instance,ssh_conn,ops,ftp_client,ops_py)
+        manifest = KatapultManifest(results[0].get('content'))
+
+        sources   = dict() # content hash -> remote path holding (or about to hold) the content
+        pending   = []
+        for i , ( local_path , remote_path ) in enumerate(files):
+            if errors[i] is not None:
+                continue
+            size , file_hash = hashes[i]
+            remote_stat = results[1+i]
+            if manifest.get(remote_path) == file_hash and remote_stat.get('exists') and remote_stat.get('size') == size:
+                stats.skipped += 1
+                sources.setdefault(file_hash,remote_path)
+            else:
+                pending.append(i)
+
+        to_upload = []
+        to_copy   = []
+        for i in pending:
+            size , file_hash = hashes[i]
+            if file_hash in sources:
+                to_copy.append(i)
+            else:
+                sources[file_hash] = files[i][1]
+                to_upload.append(i)
+
+        upload_errors = await self._send_files(instance,ssh_conn,ftp_client,uploader,[ files[i] for i in to_upload ],ops_py)
+        for i , error in zip(to_upload,upload_errors):
+            errors[i] = error
+
+        if to_copy:
+            copy_ops = [ { 'op' : 'copy' , 'src' : sources[hashes[i][1]] , 'path' : files[i][1] } for i in to_copy ]
+            copy_results = await self._remote_ops(instance,ssh_conn,copy_ops,ftp_client,ops_py)
+            # the source may have failed or disappeared: fall back to a regular upload
+            retry = [ i for i , result in zip(to_copy,copy_results) if not result.get('ok') ]
+            stats.copied += len(to_copy) - len(retry)
+            retry_errors = await self._send_files(instance,ssh_conn,ftp_client,uploader,[ files[i] for i in retry ],ops_py)
+            for i , error in zip(retry,retry_errors):
+                errors[i] = error
+
+        if pending:
+            # another deploy may have written the manifest meanwhile: merge into the current one
+            async with self._get_manifest_lock(instance):
+                results  = await self._remote_ops(instance,ssh_conn,[ { 'op' : 'read' , 'path' : manifest_path } ],ftp_client,ops_py)
+                manifest = KatapultManifest(results[0].get('content'))
+                for i in pending:
+                    if errors[i] is None:
+                        manifest.set(files[i][1],hashes[i][1])
+                await self._remote_ops(instance,ssh_conn,[ { 'op' : 'write' , 'path' : manifest_path , 'content' : manifest.dumps() } ],ftp_client,ops_py)
+
+        return errors , stats
+
     async def _test_reupload(self,instance,file_test,ssh_conn,isfile=True):
         re_upload = False
         if isfile:
@@ -563,6 +1050,34 @@ class KatapultProvider(ABC):
     def version(self):
         pass
 
+    # stores a file in the provider's object storage (keyed by its content hash)
+    # and returns ( url , uploaded ) - None if the provider doesn't support it
+    def stage_file(self,local_path,file_hash,expiration):
+        return None
+
+    # presigned URLs of the packed environment: { 'put' : url , 'get' : url (if it has already been uploaded) }
+    # returns None if the provider doesn't support it
+    def env_artifact_urls(self,env_name,expiration):
+        return None
+
+    # the script to run when a new instance boots ('boot_bootstrap':True) - None by default
+    def _get_boot_script(self,inst_cfg):
+        return None
+
+    # golden images ('bake_images':True) - not supported by default
+    def find_baked_image(self,config,env_names):
+        return None
+
+    def bake_image(self,instance,env_names):
+        return None
+
+    def gc_baked_images(self,region,env_names):
+        return []
+
+    # the environments the golden images are looked up with (when creating instances)
+    def _get_bake_env_names(self):
+        return []
+
     # Core API 
 
     @abstractmethod
@@ -826,23 +1341,8 @@ def get_config(path):
     return config
 
 def get_standard_python_librairies():
-    #https://stackoverflow.com/questions/6463918/how-to-get-a-list-of-all-the-python-standard-library-modules
-    import distutils.sysconfig as sysconfig
-    import os
-    result = []
-    std_lib = sysconfig.get_python_lib(standard_lib=True)
-    for top, dirs, files in os.walk(std_lib):
-        for nm in files:
-            if nm != '__init__.py' and nm[-3:] == '.py':
-                result.append( os.path.join(top, nm)[len(std_lib)+1:-3].replace(os.sep, '.') )
-    
-    # double it with this ...
-    from katapult.isort.stdlibs.py39 import stdlib
-    for lib in stdlib:
-        result.append(lib)
-    result.append('.code')
-    result.append('.pytest')
-    return result
+    # set of the top-level modules of the standard library (no walk of the stdlib directory)
+    return get_stdlib_names()
 
 def guess_environment(envname,dir):
     environment_obj = {
@@ -856,8 +1356,6 @@ def guess_environment(envname,dir):
 
     librairies = get_standard_python_librairies()
 
-    julia_added = False
-
     files_to_upload = []
 
     # https://stackoverflow.com/questions/13454164/os-walk-without-hidden-folders
@@ -866,65 +1364,30 @@ def guess_environment(envname,dir):
         dirs[:] = [d for d in dirs if not d[0] == '.']
 
         for name in files:
-            file_path = os.path.join(root, name)
-            file_name, file_extension = os.path.splitext(name)   
-            if file_extension:
-                file_extension = file_extension.lower()   
-
-            if file_extension == '.py':
-                files_to_upload.append(file_path)
-                with open(file_path,'r') as the_file:
-                    try:
-                        file_content = the_file.read()
-                    except:
-                        continue
-                    packages = re.findall(r"\s*(from\s+([^\s]+)\s+import\s+([^\s]+)|import\s+([^\s]+).*)",file_content)
-                    for pkg in packages:
-                        if pkg[3]:
-                            pkg_name = pkg[3]
-                        elif pkg[1] and pkg[2]:
-                            pkg_name = pkg[1] #"{0}.{1}".format(pkg[1],pkg[2])
-                        else:
-                            pkg_name = None
-                        if pkg_name.startswith('.'):
-                            continue
-                        if pkg_name.startswith('_'):
-                            continue
-                        #if '#' in pkg[0] and pkg[0].index('#') < pkg[0].
-                        if '.' in pkg_name:
-                            pkg_name = pkg_name[:pkg_name.index('.')]
-                        if not pkg_name:
-                            continue
-                        if pkg_name in librairies:
-                            continue
-                        if pkg_name in environment_obj['env_pypi']:
-                            continue
-                        environment_obj['env_pypi'].append(pkg_name)
-            
-            elif file_extension == '.jl':
-                files_to_upload.append(file_path)
-                if not julia_added:
-                    environment_obj['env_conda'].append('julia')
-                    julia_added = True
-
-                with open(file_path,'r') as the_file:
-                    try:
-                        file_content = the_file.read()
-                    except:
-                        continue
-                    packages = re.findall(r"(Pkg\.add\(\"([^\^\")]+)\"\)|using\s+([^\s]+))",file_content)
-                    for pkg in packages:
-                        if pkg[2]:
-                            pkg_name = pkg[2]
-                        elif pkg[1]:
-                            pkg_name = pkg[1]
-                        else:
-                            pkg_name = None
-                        if not pkg_name:
-                            continue
-                        if pkg_name in environment_obj['env_julia']:
-                            continue
-                        environment_obj['env_julia'].append(pkg_name)
+            file_extension = os.path.splitext(name)[1].lower()
+            if file_extension in [ '.py' , '.jl' ]:
+                files_to_upload.append(os.path.join(root, name))
+
+    # the files are parsed in parallel and the results are cached (by mtime) for the next calls
+    import_cache = KatapultImportCache()
+    packages     = import_cache.scan(files_to_upload)
+    import_cache.save()
+
+    for file_path in files_to_upload:
+        if file_path.lower().endswith('.jl'):
+            if not 'julia' in environment_obj['env_conda']:
+                environment_obj['env_conda'].append('julia')
+            for pkg_name in packages[file_path] or []:
+                if pkg_name in environment_obj['env_julia']:
+                    continue
+                environment_obj['env_julia'].append(pkg_name)
+        else:
+            for pkg_name in packages[file_path] or []:
+                if pkg_name in librairies:
+                    continue
+                if pkg_name in environment_obj['env_pypi']:
+                    continue
+                environment_obj['env_pypi'].append(pkg_name)
 
     return environment_obj , files_to_upload      
 
@@ -13,15 +13,27 @@ from katapult.provider import KatapultProvider , KatapultProviderState , debug ,
 from katapult.config_state import ConfigManager , StateSerializer , STATE_FILE
 from enum import IntFlag
 from threading import current_thread
-import shutil
+import shutil , tempfile
 import asyncio , asyncssh
 import traceback 
+from katapult.transfer import LARGE_FILE_THRESHOLD , STAGING_URL_EXPIRATION
+from katapult.manifest import compute_file_hash
 
 random.seed()
 
 SLEEP_PERIOD = 15
 
-RUNNER_FILES = ['env_check.py','env_state.sh','config.py','bootstrap.sh','run.sh','microrun.sh','state.sh','tail.sh','getpid.sh','reset.sh','kill.sh']
+# spot instances ('eco'): the watcher of the interruption notice (see spot_watch.py)
+SPOT_METADATA_URL = 'http://169.254.169.254'
+SPOT_WATCH_PERIOD = 5
+SPOT_GRACE        = 60
+CHECKPOINT_DIR    = 'checkpoint'
+
+# warm worker of the environments declaring 'warm_modules' (uploaded in the directory of the environment)
+WARM_FILE    = 'forkserver.py'
+WARM_TIMEOUT = 600 # idle time (seconds) before it exits
+
+RUNNER_FILES = ['remote_ops.py','slotrun.py','arrayrun.py','p2p_serve.py','spot_watch.py','env_check.py','env_artifact.py','env_state.sh','config.py','bootstrap.sh','run.sh','microrun.sh','state.sh','tail.sh','getpid.sh','reset.sh','kill.sh']
 
 def set_sleep_period(value):
     global SLEEP_PERIOD
@@ -58,6 +70,21 @@ class KatapultFatProvider(KatapultProvider,ABC):
         # option
         self._mutualize_uploads = conf.get('mutualize_uploads',True)
 
+        self._upload_stats = dict()
+        self._deploy_timings = dict()
+
+        # dynamic dispatch ('job_dispatch'='dynamic'): central queue of the jobs not sent to an instance yet
+        # (None with the static assignation)
+        self._dispatch_queue    = None
+        self._dispatch_inflight = 0
+        self._dispatch_sending  = set() # jobs taken from the queue whose processes are being created
+        self._dispatch_failed   = set() # jobs that won't run (a job they depend on has been aborted)
+
+        # spot interruptions: the instances that are being reclaimed and the checkpoints of their jobs
+        self._interrupted_instances = set()
+        self._checkpoints           = dict() # job -> local directory of its checkpoint files
+        self._spot_watch_tasks      = [ ]    # watchers of the instances the jobs have been moved to
+
         self._state_serializer = None
         if self._config.get('recover',False):
             # load the state (if existing) and set the recovery mode accordingly
@@ -216,8 +243,12 @@ class KatapultFatProvider(KatapultProvider,ABC):
         files_path  = instance.path_join(global_path,'files')
         ready_path  = instance.path_join(global_path,'ready')
 
+        # the runner files may be installed at boot time already ('boot_bootstrap')
+        await self._wait_for_boot(instance,ssh_conn,'files.lock')
+
         # last file uploaded ...
-        re_upload  = await self._test_reupload(instance,ready_path,ssh_conn)
+        results    = await self._remote_ops(instance,ssh_conn,[ { 'op' : 'stat' , 'path' : ready_path } ],ftp_client)
+        re_upload  = not results[0].get('exists')
 
         #created = deploy_states[instance.get_name()].get('created')
 
@@ -226,18 +257,19 @@ class KatapultFatProvider(KatapultProvider,ABC):
         if re_upload:
 
             self.debug(2,"creating instance's directories ...")
-            stdout0, stderr0 = await self._exec_command(ssh_conn,"mkdir -p "+global_path+" "+files_path+" && rm -f "+ready_path)
+            await self._remote_ops(instance,ssh_conn,[
+                { 'op' : 'mkdir' , 'path' : global_path } ,
+                { 'op' : 'mkdir' , 'path' : files_path } ,
+                { 'op' : 'rm'    , 'path' : ready_path }
+            ])
             self.debug(2,"directories created")
 
             self.debug(1,"uploading instance's files ... ")
 
             # upload the install file, the env file and the script file
-            ftp_client = await ssh_conn.start_sftp_client()
-
-            # change dir to global dir (should be done once)
-            await ftp_client.chdir(global_path)
+            # (absolute paths: the sftp client may be shared through the connection pool)
             for file in RUNNER_FILES:
-                await self.sftp_put_remote_file(ftp_client,file) 
+                await self.sftp_put_remote_file(ftp_client,file,instance.path_join(global_path,file)) 
 
             self.debug(1,"Installing PyYAML for newly created instance ...")
             stdout, stderr = await self._exec_command(ssh_conn,"pip install pyyaml")
@@ -247,32 +279,181 @@ class KatapultFatProvider(KatapultProvider,ABC):
 
             sh_files = instance.path_join(global_path,"*.sh")
 
-            commands = [ 
-                # make bootstrap executable
-                { 'cmd': "chmod +x "+sh_files, 'out' : True },              
-            ]
             eol_command = get_EOL_conversion(instance,sh_files)
             if eol_command:
-                commands.append({'cmd':eol_command,'out':True})
+                await self._run_ssh_commands(instance,ssh_conn,[{'cmd':eol_command,'out':True}])
 
-            await self._run_ssh_commands(instance,ssh_conn,commands)
+            # make bootstrap executable + mark as ready
+            await self._remote_ops(instance,ssh_conn,[
+                { 'op' : 'chmod' , 'path' : sh_files , 'mode' : '+x' , 'glob' : True } ,
+                { 'op' : 'write' , 'path' : ready_path }
+            ])
 
-            await self.sftp_put_string(ftp_client,'ready',"")
+        # spot instance: the jobs are checkpointed and moved elsewhere on an interruption notice
+        if instance.get_config('eco') and self._config.get('spot_watch',True):
+            await self._start_spot_watch(instance,ssh_conn)
 
-            self.debug(1,"files uploaded.")
+        deploy_states[instance.get_name()] = { 'upload' : re_upload } 
 
+    async def _start_spot_watch(self,instance,ssh_conn):
+        script  = instance.path_join( instance.get_global_dir() , 'spot_watch.py' )
+        command = "python3 {0} {1} {2} {3}".format(script,self._config.get('spot_metadata_url',SPOT_METADATA_URL),self._config.get('spot_watch_period',SPOT_WATCH_PERIOD),self._config.get('spot_grace',SPOT_GRACE))
+        self.debug(1,"Starting the spot interruption watcher on",instance.get_name())
+        try:
+            stdout , stderr = await self._exec_command(ssh_conn,command)
+            self.debug(2,await stdout.read())
+        except (OSError, asyncssh.Error) as e:
+            self.debug(1,"Could not start the spot interruption watcher on",instance.get_name(),e,color=bcolors.WARNING)
+
+    # returns the command creating the environments files (from config.json) 
+    # and the content of generate_envs.sh (bootstrapping the environments)
+    def _get_bootstrap_commands(self,instance,dpl_envs):
+        global_path       = instance.get_global_dir() 
+        config_py         = instance.path_join( global_path , 'config.py' )
+        config_cmd        = ""
+        bootstrap_command = ""
 
-        deploy_states[instance.get_name()] = { 'upload' : re_upload } 
+        for dpl_env in dpl_envs:
+
+            # recreate pip+conda files according to config
+            config_cmd = config_cmd + (" ; " if config_cmd else "") + "cd " + dpl_env.get_path() + " && python3 "+config_py
+
+            # setup envs according to current config files state
+            # the environments are bootstrapped concurrently ('bootstrap_parallel')
+            # bootstrap.sh locks the steps sharing resources (apt, micromamba package cache ...)
+            env_bootstrap = instance.path_join( global_path , 'bootstrap.sh' ) + " \"" + dpl_env.get_name_with_hash() + "\" " + ("1" if self._config.get('dev',False) else "0")
+            if self._config.get('pip_installer','pip') == 'uv':
+                env_bootstrap = "KATAPULT_PIP_INSTALLER=uv " + env_bootstrap
+            if self._config.get('bootstrap_parallel',True):
+                # prefix the lines so the (interleaved) logs can still be read
+                env_bootstrap = "{ " + env_bootstrap + " 2>&1 | sed -u \"s/^/[" + dpl_env.get_name_with_hash() + "] /\" ; } &\n"
+                bootstrap_command = bootstrap_command + env_bootstrap
+            else:
+                bootstrap_command = bootstrap_command + (" ; " if bootstrap_command else "") + env_bootstrap
+
+        if bootstrap_command and self._config.get('bootstrap_parallel',True):
+            bootstrap_command = bootstrap_command + "wait\n"
+
+        return config_cmd , bootstrap_command
+
+    # the script run by cloud-init (as root) when a new instance boots ('boot_bootstrap')
+    # the runner files don't fit in the user data (16KB): the user data is a small loader
+    # that pulls the installer script (_get_boot_installer) from the staging bucket
+    # (the whole installer goes in the user data if the provider has no bucket)
+    def _get_boot_script(self,inst_cfg):
+        installer = self._get_boot_installer(inst_cfg)
+        if installer is None:
+            return None
+        url , script_hash = self._stage_boot_installer(installer)
+        if url is None:
+            return installer
+        boot_sh  = "/var/tmp/katapult-boot-" + script_hash[:16] + ".sh"
+        script   = "#!/bin/bash\n"
+        script  += "# katapult boot installer (runner files and bootstrap of the environments)\n"
+        script  += "for i in $(seq 1 10) ; do curl -fsSL -o \"" + boot_sh + "\" '" + url + "' && break ; sleep 3 ; done\n"
+        script  += "echo \"" + script_hash + "  " + boot_sh + "\" | sha256sum -c --quiet && exec bash \"" + boot_sh + "\"\n"
+        return script
+
+    # stores the installer in the staging bucket (keyed by its content hash)
+    # returns ( presigned url , hash ) - ( None , None ) if the provider doesn't support staging
+    def _stage_boot_installer(self,installer):
+        with tempfile.NamedTemporaryFile('w',suffix='.sh',delete=False) as the_file:
+            the_file.write(installer)
+        try:
+            script_hash = compute_file_hash(the_file.name)
+            result = self.stage_file(the_file.name,script_hash,self._config.get('staging_url_expiration',STAGING_URL_EXPIRATION))
+        except Exception as e:
+            self.debug(1,"Could not stage the boot script",e,color=bcolors.WARNING)
+            result = None
+        finally:
+            os.remove(the_file.name)
+        if result is None:
+            return None , None
+        url , uploaded = result
+        return url , script_hash
+
+    # the installer of the runner files and the environments
+    # it installs the runner files and bootstraps the environments while we are still waiting for the instance
+    # deploy() then waits on the locks of this script: files.lock (runner files installed) and boot.lock (environments bootstrapped)
+    # Note: the jobs are not assigned yet when the instances are created: all the configured environments are bootstrapped
+    def _get_boot_installer(self,inst_cfg):
+        if not self._config.get('boot_bootstrap',False) or not self._environments:
+            return None
+
+        instance = KatapultInstance(inst_cfg,None)
+        instance.set_platform(KatapultPlatform.LINUX)
+        username = inst_cfg.get('img_username')
+        run_dir  = instance.get_global_dir()
+        dpl_envs = [ environment.deploy(instance) for environment in self._environments ]
+        eof      = '__KATAPULT_EOF__'
+
+        def put_file(path,content):
+            if not content.endswith('\n'):
+                content = content + '\n'
+            return "cat > \"" + path + "\" <<'" + eof + "'\n" + content + eof + "\n"
+
+        def as_user(cmd):
+            # the locks are not inherited by the user commands
+            return "su - " + username + " -c '" + cmd + "' 6>&- 7>&-\n"
+
+        # the locks are created locked (and renamed) so deploy() never sees them unlocked while the script runs
+        script  = "#!/bin/bash\n"
+        script += "mkdir -p \"" + run_dir + "\"\n"
+        script += "exec 6>\"" + run_dir + "/files.lock.tmp\" ; flock 6 ; mv \"" + run_dir + "/files.lock.tmp\" \"" + run_dir + "/files.lock\"\n"
+        script += "exec 7>\"" + run_dir + "/boot.lock.tmp\" ; flock 7 ; mv \"" + run_dir + "/boot.lock.tmp\" \"" + run_dir + "/boot.lock\"\n"
+        for file in RUNNER_FILES:
+            script += put_file( instance.path_join(run_dir,file) , self._get_remote_file(file).replace('\r\n','\n') )
+        for dpl_env in dpl_envs:
+            script += "mkdir -p \"" + dpl_env.get_path() + "\"\n"
+            script += put_file( instance.path_join(dpl_env.get_path(),'config.json') , dpl_env.json() )
+            artifact_urls = None
+            if self._config.get('env_cache',False):
+                try:
+                    artifact_urls = self.env_artifact_urls(dpl_env.get_name_with_hash(),self._config.get('staging_url_expiration',STAGING_URL_EXPIRATION))
+                except KatapultError as e:
+                    self.debug(1,"Could not get the packed environment of",dpl_env.get_name_with_hash(),e,color=bcolors.WARNING)
+            if artifact_urls:
+                script += put_file( instance.path_join(dpl_env.get_path(),'artifact.json') , json.dumps(artifact_urls) )
+        config_cmd , bootstrap_command = self._get_bootstrap_commands(instance,dpl_envs)
+        generate_sh = instance.path_join(run_dir,'boot_envs.sh')
+        script += put_file( generate_sh , bootstrap_command )
+        script += "chmod +x \"" + run_dir + "\"/*.sh\n"
+        script += "chown -R " + username + ": \"" + run_dir + "\"\n"
+        script += as_user("pip install pyyaml")
+        script += "echo \"\" > \"" + instance.path_join(run_dir,'ready') + "\" ; chown " + username + ": \"" + instance.path_join(run_dir,'ready') + "\"\n"
+        script += "flock -u 6\n"
+        script += as_user(config_cmd)
+        script += as_user("bash " + generate_sh + " > " + instance.path_join(run_dir,'bootstrap.log') + " 2>&1")
+        script += "flock -u 7\n"
+        return script
+
+    # waits for the boot-time script (if any) to release a lock (files.lock or boot.lock)
+    # nothing to wait for if the instance hasn't been created with it (or has already booted)
+    async def _wait_for_boot(self,instance,ssh_conn,lock_name):
+        if not self._config.get('boot_bootstrap',False):
+            return
+        lock_file = instance.path_join( instance.get_global_dir() , lock_name )
+        # cloud-init may not have started the script yet when we first connect
+        wait_cmd  = "for i in $(seq 1 300) ; do [ -f " + lock_file + " ] && break ; ( ! command -v cloud-init >/dev/null || cloud-init status 2>/dev/null | grep -q -E 'done|error|disabled' ) && break ; sleep 1 ; done ; "
+        wait_cmd += "[ -f " + lock_file + " ] && flock -s -w 3600 " + lock_file + " true ; true"
+        self.debug(2,"waiting for the boot-time bootstrap (" + lock_name + ") ...")
+        stdout , stderr = await self._exec_command(ssh_conn,wait_cmd)
+        await stdout.read()
 
     async def _deploy_environments(self,instance,deploy_states,ssh_conn,ftp_client,**kwargs):
 
         re_upload_inst = deploy_states[instance.get_name()]['upload']
 
+        # the environments may be bootstrapped at boot time already ('boot_bootstrap')
+        await self._wait_for_boot(instance,ssh_conn,'boot.lock')
+
         # scan the instances environment (those are set when assigning a job to an instance)
         #TODO: debug this
         # NOT SURE why we're missing an environment sometimes...
-        bootstrap_command = ""
 
+        # build the plan of checks for all the environments (1 round trip)
+        dpl_envs  = []
+        stat_ops  = []
         for environment in instance.get_environments():
         #for environment in self._environments:
 
@@ -282,20 +463,40 @@ class KatapultFatProvider(KatapultProvider,ABC):
             self.debug(3,dpl_env.json())
 
             ready_file = instance.path_join( dpl_env.get_path() , 'ready' )
-            re_upload_env = await self._test_reupload(instance,ready_file, ssh_conn)
+            checks = { 'ready' : len(stat_ops) }
+            stat_ops.append( { 'op' : 'stat' , 'path' : ready_file } )
+            if dpl_env.get_config('env_conda') is not None:
+                mamba_test = instance.path_join( instance.get_home_dir() , 'micromamba' , 'envs' , dpl_env.get_name_with_hash() )
+                checks['mamba'] = len(stat_ops)
+                stat_ops.append( { 'op' : 'stat' , 'path' : mamba_test } )
+            if dpl_env.get_config('env_pypi') is not None and dpl_env.get_config('env_conda') is None:
+                venv_test = instance.path_join( instance.get_global_dir() , '.' + dpl_env.get_name_with_hash() )
+                checks['pip'] = len(stat_ops)
+                stat_ops.append( { 'op' : 'stat' , 'path' : venv_test } )
+            if dpl_env.get_config('warm_modules') is not None:
+                checks['warm'] = len(stat_ops)
+                stat_ops.append( { 'op' : 'stat' , 'path' : instance.path_join( dpl_env.get_path() , WARM_FILE ) } )
+            dpl_envs.append( ( environment , dpl_env , ready_file , checks ) )
+
+        stat_results = await self._remote_ops(instance,ssh_conn,stat_ops)
+
+        reupload_envs = []
+        prepare_ops   = []
+        warm_envs     = []
+        for environment , dpl_env , ready_file , checks in dpl_envs:
+
+            re_upload_env = not stat_results[checks['ready']].get('exists')
 
             re_upload_env_mamba  = False
             re_upload_env_pip    = False
             re_upload_env_aptget = False
 
             if not re_upload_env:
-                if dpl_env.get_config('env_conda') is not None:
-                    mamba_test = instance.path_join( instance.get_home_dir() , 'micromamba' , 'envs' , dpl_env.get_name_with_hash() )
-                    re_upload_env_mamba = await self._test_reupload(instance,mamba_test, ssh_conn,False)
+                if 'mamba' in checks:
+                    re_upload_env_mamba = stat_results[checks['mamba']].get('type') != 'dir'
                     re_upload_env = re_upload_env or re_upload_env_mamba
-                if dpl_env.get_config('env_pypi') is not None and dpl_env.get_config('env_conda') is None:
-                    venv_test = instance.path_join( instance.get_global_dir() , '.' + dpl_env.get_name_with_hash() )
-                    re_upload_env_pip = await self._test_reupload(instance,venv_test, ssh_conn, False)
+                if 'pip' in checks:
+                    re_upload_env_pip = stat_results[checks['pip']].get('type') != 'dir'
                     re_upload_env = re_upload_env or re_upload_env_pip
                 # TODO: have an aptget install TEST
                 #if dpl_env.get_config('env_aptget') is not None:
@@ -309,51 +510,55 @@ class KatapultFatProvider(KatapultProvider,ABC):
             deploy_states[instance.get_name()][environment.get_name_with_hash()] = { 'upload' : re_upload }
 
             if re_upload:
-                files_path = dpl_env.get_path()
-                global_path = instance.get_global_dir() 
+                debug(1,"re-upload of files ...")
+                reupload_envs.append(dpl_env)
+                prepare_ops.append( { 'op' : 'mkdir' , 'path' : dpl_env.get_path() } )
+                prepare_ops.append( { 'op' : 'rm'    , 'path' : ready_file } )
+                prepare_ops.append( { 'op' : 'rm'    , 'path' : instance.path_join( dpl_env.get_path() , 'artifact.*' ) , 'glob' : True } )
+
+            # (also missing when the environment has been bootstrapped at boot time)
+            if 'warm' in checks and ( re_upload or not stat_results[checks['warm']].get('exists') ):
+                warm_envs.append(dpl_env)
+
+        if reupload_envs:
+            self.debug(2,"creating environment directories ...")
+            await self._remote_ops(instance,ssh_conn,prepare_ops)
+            self.debug(2,"directories created")
 
-                self.debug(2,"creating environment directories ...")
-                stdout0, stderr0 = await self._exec_command(ssh_conn,"mkdir -p "+files_path+" && rm -f "+ready_file)
-                self.debug(2,"STDOUT for mkdir -p ",files_path,"...",await stdout0.read())
-                self.debug(2,"STDERR for mkdir -p ",files_path,"...",await stderr0.read())
-                self.debug(2,"directories created")
+        for dpl_env in warm_envs:
+            await self.sftp_put_remote_file(ftp_client,WARM_FILE,instance.path_join(dpl_env.get_path(),WARM_FILE))
 
-                self.debug(1,"uploading files ... ")
+        print_deploy = self._config.get('print_deploy',False) == True
 
-                # upload the install file, the env file and the script file
-                # change to env dir
-                await ftp_client.chdir(dpl_env.get_path())
-                await self.sftp_put_string(ftp_client,'config.json',dpl_env.json())
+        for dpl_env in reupload_envs:
+            files_path = dpl_env.get_path()
 
-                self.debug(1,"uploaded.")        
+            self.debug(1,"uploading files ... ")
 
-                print_deploy = self._config.get('print_deploy',False) == True
+            # upload the install file, the env file and the script file
+            await self.sftp_put_string(ftp_client,instance.path_join(files_path,'config.json'),dpl_env.json())
 
-                config_py = instance.path_join( global_path , 'config.py' )
+            # where bootstrap.sh looks for the packed environment (and uploads it once built)
+            artifact_urls = await self._get_env_artifact_urls(dpl_env)
+            if artifact_urls:
+                await self.sftp_put_string(ftp_client,instance.path_join(files_path,'artifact.json'),json.dumps(artifact_urls))
 
-                commands = [
-                    # recreate pip+conda files according to config
-                    { 'cmd': "cd " + files_path + " && python3 "+config_py , 'out' : True },
-                    # setup envs according to current config files state
-                    # FIX: mamba is not handling well concurrency
-                    # we run the mamba installs sequentially below
-                    #{ 'cmd': instance.path_join( global_path , 'bootstrap.sh' ) + " \"" + dpl_env.get_name_with_hash() + "\" " + ("1" if self._config.get('dev',False) else "0") , 'out': print_deploy , 'output': instance.path_join( dpl_env.get_path() , 'bootstrap._') },  
-                ]
+            self.debug(1,"uploaded.")        
 
-                bootstrap_command = bootstrap_command + (" ; " if bootstrap_command else "") + instance.path_join( global_path , 'bootstrap.sh' ) + " \"" + dpl_env.get_name_with_hash() + "\" " + ("1" if self._config.get('dev',False) else "0")
+        config_cmd , bootstrap_command = self._get_bootstrap_commands(instance,reupload_envs)
 
-                await self._run_ssh_commands(instance,ssh_conn,commands)
+        if config_cmd:
+            await self._run_ssh_commands(instance,ssh_conn,[ { 'cmd': config_cmd , 'out' : True } ])
                 
         if bootstrap_command:
             gbl_dir = instance.get_global_dir()
-            await ftp_client.chdir(gbl_dir)
-            await self.sftp_put_string(ftp_client,'generate_envs.sh',bootstrap_command)
             generate_sh = instance.path_join( gbl_dir , 'generate_envs.sh' ) 
+            await self.sftp_put_string(ftp_client,generate_sh,bootstrap_command)
             bootstrap_log = instance.path_join( gbl_dir , 'bootstrap.log' )
             commands = [
-                {'cmd': 'chmod +x ' + generate_sh , 'out':True}, # import to wait for this to be done !
-                {'cmd': generate_sh , 'out':print_deploy, 'output': bootstrap_log }
+                {'cmd': 'bash ' + generate_sh , 'out':print_deploy, 'output': bootstrap_log }
             ]
+            # (the bootstrap runs in the background unless print_deploy: its duration is not a deploy stage)
             await self._run_ssh_commands(instance,ssh_conn,commands)
         
 
@@ -361,8 +566,11 @@ class KatapultFatProvider(KatapultProvider,ABC):
 
         file_uploaded = dict()
 
-        # scan the instances environment (those are set when assigning a job to an instance)
-        for job in instance.get_jobs():
+        # build the plan for all the jobs of the instance (1 round trip for directories + checks)
+        dpl_jobs = []
+        plan_ops = []
+        dirs_ops = dict()
+        for job in kwargs.get('jobs') or instance.get_jobs():
             env      = job.get_env()        # get its environment
             dpl_env  = env.deploy(instance) # "deploy" the environment to the instance and get a DeployedEnvironment
             actual_deploy = kwargs.get('vscode_mode') == True
@@ -370,73 +578,104 @@ class KatapultFatProvider(KatapultProvider,ABC):
 
             input_files = self._get_files(dpl_job)            
 
-            mkdir_cmd = ""
+            dirs_ops[dpl_job.get_path()] = True
             for in_file_ in input_files:
                 in_file = in_file_['file']
                 local_path , local_rel_path , abs_path , rel_remote_path , external = self._resolve_dpl_job_paths(in_file,dpl_job)
                 dirname = instance.path_dirname(abs_path)
                 if dirname:
-                    mkdir_cmd = mkdir_cmd + (" && " if mkdir_cmd else "") + "mkdir -p " + dirname 
+                    dirs_ops[dirname] = True
 
-            self.debug(2,"creating job directories ...")
-            stdout0, stderr0 = await self._exec_command(ssh_conn,"mkdir -p "+dpl_job.get_path())
-            if mkdir_cmd != "":
-                stdout0, stderr0 = await self._exec_command(ssh_conn,mkdir_cmd)
-            self.debug(2,"directories created")
+            ready_file = instance.path_join( dpl_job.get_path() , 'ready' )
+            dpl_jobs.append( ( job , env , dpl_job , input_files , ready_file ) )
+
+        plan_ops = [ { 'op' : 'mkdir' , 'path' : dirname } for dirname in dirs_ops.keys() ]
+        num_dirs = len(plan_ops)
+        plan_ops.extend( [ { 'op' : 'stat' , 'path' : ready_file } for job , env , dpl_job , input_files , ready_file in dpl_jobs ] )
+
+        self.debug(2,"creating job directories ...")
+        results = await self._remote_ops(instance,ssh_conn,plan_ops)
+        self.debug(2,"directories created")
+
+        use_manifest  = self._config.get('upload_manifest',True)
+        reupload_jobs = []
+        for i , ( job , env , dpl_job , input_files , ready_file ) in enumerate(dpl_jobs):
+            # (the environments may still be checked concurrently with the pipelined deploy)
+            re_upload_env = deploy_states[instance.get_name()].get(env.get_name_with_hash(),dict()).get('upload')
+            re_upload     = not results[num_dirs+i].get('exists')
+            self.debug(2,"re_upload_env",re_upload_env,"re_upload",re_upload)
+            if re_upload: #or re_upload_env:
+                reupload_jobs.append( ( job , env , dpl_job , input_files , ready_file ) )
 
-            re_upload_env = deploy_states[instance.get_name()][env.get_name_with_hash()]['upload']
+        # with the content manifest, all the files are checked (only missing/changed files are sent)
+        upload_jobs = dpl_jobs if use_manifest else reupload_jobs
 
-            ready_file = instance.path_join( dpl_job.get_path() , 'ready' )
-            re_upload = await self._test_reupload(instance,ready_file, ssh_conn)
+        if not upload_jobs:
+            return
 
-            self.debug(2,"re_upload_env",re_upload_env,"re_upload",re_upload)
+        if reupload_jobs:
+            await self._remote_ops(instance,ssh_conn,[ { 'op' : 'rm' , 'path' : ready_file } for job , env , dpl_job , input_files , ready_file in reupload_jobs ])
 
-            if re_upload: #or re_upload_env:
+        global_path = instance.get_global_dir()
+        files_dir = instance.path_join( global_path , 'files' )
 
-                stdout0, stderr0 = await self._exec_command(ssh_conn,"rm -f "+ready_file)
+        upload_files = []
+        for job , env , dpl_job , input_files , ready_file in upload_jobs:
 
-                self.debug(1,"uploading job files ... ",dpl_job.get_hash())
+            self.debug(2,"uploading job files ... ",dpl_job.get_hash())
 
-                global_path = instance.get_global_dir()
-                files_dir = instance.path_join( global_path , 'files' )
+            #files = self._get_files(dpl_job)
 
-                #files = self._get_files(dpl_job)
+            for upfile_ in input_files:
 
-                for upfile_ in input_files:
+                upfile = upfile_['file']
+                local_path , local_rel_path , abs_path , rel_remote_path , external = self._resolve_dpl_job_paths(upfile,dpl_job)
+                        
+                # check if the remote path has already been uploaded ...
+                if abs_path in file_uploaded:
+                    self.debug(2,"skipping upload of file",upfile,"for job#",job.get_rank(),"(file has already been uploaded)")
+                    continue
+                file_uploaded[abs_path] = True
+                upload_files.append( ( local_path , abs_path , upfile_ ) )
 
-                    upfile = upfile_['file']
-                    local_path , local_rel_path , abs_path , rel_remote_path , external = self._resolve_dpl_job_paths(upfile,dpl_job)
-                            
-                    # check if the remote path has already been uploaded ...
-                    if abs_path in file_uploaded:
-                        self.debug(2,"skipping upload of file",upfile,"for job#",job.get_rank(),"(file has already been uploaded)")
-                        continue
-                    file_uploaded[abs_path] = True
-                    
-                    try:
-                        try:
-                            await ftp_client.put(local_path,abs_path) #os.path.basename(upfile))
-                        except FileNotFoundError as fne:
-                            if upfile_['type'] == 'upload':
-                                self.debug(1,"You defined an upload file that is not available",upfile)
-                            elif upfile_['type'] == 'input':
-                                self.debug(1,"You defined an input file that is not available:",upfile)
-                            elif upfile_['type'] == 'script':
-                                self.debug(1,"You defined a script that is not available",upfile)
-                            self.debug(1,fne)
-                        except Exception as e:
-                            self.debug(1,"Error while uploading",upfile)
-                            self.debug(1,e)
-
-                    except Exception as e:
-                        print("Error while uploading file",upfile)
-                        print(e)                
-
-                # used to check if everything is uploaded
-                await ftp_client.chdir(dpl_job.get_path())
-                await self.sftp_put_string(ftp_client, 'ready', "")
-
-                self.debug(1,"uploaded.",dpl_job.get_hash())
+        self.debug(1,"uploading",len(upload_files),"job files ...")
+
+        errors , stats = await self._upload_files(instance,ssh_conn,ftp_client,[ ( local_path , abs_path ) for local_path , abs_path , upfile_ in upload_files ],files_dir)
+
+        for ( local_path , abs_path , upfile_ ) , error in zip(upload_files,errors):
+            if error is None:
+                continue
+            upfile = upfile_['file']
+            if isinstance(error,FileNotFoundError):
+                if upfile_['type'] == 'upload':
+                    self.debug(1,"You defined an upload file that is not available",upfile)
+                elif upfile_['type'] == 'input':
+                    self.debug(1,"You defined an input file that is not available:",upfile)
+                elif upfile_['type'] == 'script':
+                    self.debug(1,"You defined a script that is not available",upfile)
+                self.debug(1,error)
+            else:
+                self.debug(1,"Error while uploading",upfile)
+                self.debug(1,error)
+
+        self._upload_stats[instance.get_name()] = stats.summary()
+        self.debug(1,"uploaded:",stats)
+        for remote_path , size , seconds in stats.timings:
+            self.debug(2,"uploaded",remote_path,size,"bytes in","{0:.3f}s".format(seconds))
+
+        # used to check if everything is uploaded
+        if reupload_jobs:
+            await self._remote_ops(instance,ssh_conn,[ { 'op' : 'write' , 'path' : ready_file } for job , env , dpl_job , input_files , ready_file in reupload_jobs ])
+
+    async def _timed_stage(self,timings,stage,coro):
+        t0 = time.perf_counter()
+        try:
+            return await coro
+        finally:
+            timings[stage] = time.perf_counter() - t0
+
+    def get_deploy_timings(self):
+        return self._deploy_timings
 
     async def _deploy_all(self,instance,**kwargs):
 
@@ -462,20 +701,40 @@ class KatapultFatProvider(KatapultProvider,ABC):
 
             try :
 
+                timings = dict()
+                self._deploy_timings[instance.get_name()] = timings
+                t0 = time.perf_counter()
+
                 self.debug(1,"-- deploy instances --")
 
-                await self._deploy_instance(instance,deploy_states,ssh_conn,ftp_client,**kwargs)
+                await self._timed_stage(timings,'instance',self._deploy_instance(instance,deploy_states,ssh_conn,ftp_client,**kwargs))
+
+                if self._config.get('deploy_pipeline',True):
+
+                    # the environments bootstrap while the job files are uploaded (they are independent)
+                    # so the deploy takes ~ max(bootstrap,uploads) instead of bootstrap+uploads
+                    self.debug(1,"-- deploy environments + jobs --")
 
-                self.debug(1,"-- deploy environments --")
+                    await asyncio.gather(
+                        self._timed_stage(timings,'environments',self._deploy_environments(instance,deploy_states,ssh_conn,ftp_client,**kwargs)) ,
+                        self._timed_stage(timings,'jobs',self._deploy_jobs(instance,deploy_states,ssh_conn,ftp_client,**kwargs))
+                    )
+
+                else:
 
-                await self._deploy_environments(instance,deploy_states,ssh_conn,ftp_client,**kwargs)
+                    self.debug(1,"-- deploy environments --")
 
-                self.debug(1,"-- deploy jobs --")
+                    await self._timed_stage(timings,'environments',self._deploy_environments(instance,deploy_states,ssh_conn,ftp_client,**kwargs))
 
-                await self._deploy_jobs(instance,deploy_states,ssh_conn,ftp_client,**kwargs) 
+                    self.debug(1,"-- deploy jobs --")
+
+                    await self._timed_stage(timings,'jobs',self._deploy_jobs(instance,deploy_states,ssh_conn,ftp_client,**kwargs))
+
+                timings['total'] = time.perf_counter() - t0
+                self.debug(1,"deploy timings",instance.get_name(),{ k : "{0:.3f}s".format(v) for k , v in timings.items() })
 
                 #ftp_client.close()
-                ssh_conn.close()
+                self._release_connection(instance,ssh_conn)
 
                 break
 
@@ -538,8 +797,8 @@ class KatapultFatProvider(KatapultProvider,ABC):
         self.debug(1,'RESETTING instance',instance.get_name())
         instanceid, ssh_conn , ftp_client = await self._wait_and_connect(instance)
         if ssh_conn is not None:
-            await self.sftp_put_remote_file(ftp_client,'reset.sh')
             reset_file = instance.path_join( instance.get_home_dir() , 'reset.sh' )
+            await self.sftp_put_remote_file(ftp_client,'reset.sh',reset_file)
             commands = []
             eol_command = get_EOL_conversion(instance,reset_file)
             if eol_command:
@@ -549,7 +808,7 @@ class KatapultFatProvider(KatapultProvider,ABC):
             )
             await self._run_ssh_commands(instance,ssh_conn,commands)
             #ftp_client.close()
-            ssh_conn.close()
+            self._release_connection(instance,ssh_conn)
         self.debug(1,'RESETTING done')    
 
 
@@ -586,11 +845,17 @@ class KatapultFatProvider(KatapultProvider,ABC):
         for job in self._jobs:
             self.debug(3,"PROCESS in deploy",job.get_last_process())
         
+        # new distribution tree for the shared inputs ('upload_mode':'p2p')
+        self._reset_fanout()
+
         jobs = []
         for instance in self._instances:
             jobs.append( self._deploy_all(instance,**kwargs) )
         await asyncio.gather( *jobs )
 
+        if self._config.get('upload_mode','sftp') == 'p2p':
+            self.debug(1,"peer-to-peer fan-out:",self._get_fanout().get_stats())
+
         self.set_state( self._state | KatapultProviderState.DEPLOYED )
 
     async def _revive(self,run_session,instance):
@@ -730,7 +995,7 @@ class KatapultFatProvider(KatapultProvider,ABC):
 
 
 
-    async def _run_jobs_for_instance(self,run_session,batch,instance,except_done,only_new_processes) :
+    async def _run_jobs_for_instance(self,run_session,batch,instance,except_done,only_new_processes,jobs=None) :
 
         # we're not coming from revive but we've recovered a state ...
         # if except_done == False and self._recovery == True:
@@ -738,6 +1003,7 @@ class KatapultFatProvider(KatapultProvider,ABC):
         #     except_done = True
 
         instanceid , ssh_conn , ftp_client = await self._wait_and_connect(instance)
+        pooled_conn = ssh_conn
         if ssh_conn is None:
             ssh_conn = await self._handle_instance_disconnect(run_session,instance,True,"could not run jobs for instance")
             if ssh_conn is None:
@@ -761,11 +1027,18 @@ class KatapultFatProvider(KatapultProvider,ABC):
         cmd_pid     = ""
         sep = "\n" # " && "
 
-        for job in instance.get_jobs():
+        # run the jobs concurrently as long as their cpus_req fit the instance cpus ('job_slots')
+        use_slots   = self._config.get('job_slots',True)
+
+        for job in ( instance.get_jobs() if jobs is None else jobs ):
 
             if except_done and job.has_completed():
                 continue
 
+            # dynamic dispatch: the job is sent once the instance (or another one) has free CPUs
+            if jobs is None and self._dispatch_queue and job in self._dispatch_queue:
+                continue
+
             # we just want to add to the run_session for newly created jobs
             if only_new_processes and job.has_processes():
                 continue
@@ -802,7 +1075,9 @@ class KatapultFatProvider(KatapultProvider,ABC):
             is_first = (cmd_run_pre=="")
             cmd_run_pre = cmd_run_pre + "rm -f " + pid_file + sep
             cmd_run_pre = cmd_run_pre + "mkdir -p " + run_path + sep
-            if is_first: # first sequential script is waiting for bootstrap to be done by default
+            if use_slots: # the jobs are queued until they get CPU slots (run.sh updates the state once started)
+                cmd_run_pre = cmd_run_pre + "echo 'queue(scheduled)' > " + state_file + "\n"
+            elif is_first: # first sequential script is waiting for bootstrap to be done by default
                 cmd_run_pre = cmd_run_pre + "echo 'wait(scheduled)' > " + state_file + "\n"
             else: # all other scripts will be queued
                 cmd_run_pre = cmd_run_pre + "echo 'queue(scheduled)' > " + state_file + "\n"
@@ -814,24 +1089,51 @@ class KatapultFatProvider(KatapultProvider,ABC):
             if ln_command != "":
                 cmd_run_pre = cmd_run_pre + ln_command + "\n"
 
+            cmd_run_pre = cmd_run_pre + self._get_dependencies_ln_command(run_session,dpl_job,run_path)
+            cmd_run_pre = cmd_run_pre + self._get_checkpoint_command(job,dpl_job,run_path)
+
             run_sh  = instance.path_join( global_path , 'run.sh' )
             run_log = instance.path_join( run_path , 'run-'+uid+'.log' )
             pid_sh  = instance.path_join( global_path , 'getpid.sh' )
-            cmd_run = cmd_run + run_sh+" \"" + dpl_env.get_name_with_hash() + "\" \""+dpl_job.get_command().replace("\"","\\\"")+"\" \"" + "|".join(job.get_config('input_files')or[]) + "\" \"" + "|".join( job.get_config('output_files') or []) + "\" " + batch.get_uid() + " " + job.get_hash()+" "+uid+">"+run_log+" 2>&1"
+            if use_slots:
+                cmd_run = cmd_run + str(self._get_job_cpus(job)*self._get_array_parallel(job,instance)) + " "
+            # array job: run.sh runs the tasks (START:STOP:PARALLEL)
+            array_range = job.get_array_range()
+            if array_range:
+                cmd_run = cmd_run + "KATAPULT_ARRAY=" + str(array_range[0]) + ":" + str(array_range[1]) + ":" + str(self._get_array_parallel(job,instance)) + " "
+            # warm worker ('warm_modules' of the environment): the python script is forked by the forkserver of the environment
+            elif env.get_config('warm_modules') is not None and dpl_job.get_command().startswith('python3 '):
+                cmd_run = cmd_run + "KATAPULT_WARM=" + ",".join(env.get_config('warm_modules')) + " KATAPULT_WARM_TIMEOUT=" + str(self._config.get('warm_timeout',WARM_TIMEOUT)) + " "
+            cmd_run = cmd_run + run_sh+" \"" + dpl_env.get_name_with_hash() + "\" \""+dpl_job.get_command().replace("\"","\\\"")+"\" \"" + "|".join(job.get_config('input_files')or[]) + "\" \"" + "|".join( job.get_output_files() ) + "\" " + batch.get_uid() + " " + job.get_hash()+" "+uid+">"+run_log+" 2>&1"
             cmd_run = cmd_run + "\n"
             cmd_pid = cmd_pid + pid_sh + " \"" + pid_file + "\"\n"
 
+        if use_slots and cmd_run:
+            # the CPUs are shared with the other batches of the instance (ledger), the priority decides who gets the freed ones
+            slotrun_py = instance.path_join( global_path , 'slotrun.py' )
+            cmd_run = "python3 " + slotrun_py + " " + str(instance.get_cpus() or 0) + " " + str(int(self._config.get('batch_priority',0))) + " <<'__KATAPULT_JOBS__'\n" + cmd_run + "__KATAPULT_JOBS__\n"
+
+        # this batch only starts once the other batches of the instance are over
+        if cmd_run and ( not use_slots or self._config.get('batch_isolation',False) ):
+            cmd_run_pre = "export KATAPULT_BATCH_ISOLATION=1\n" + cmd_run_pre
+
+        # (the pooled SFTP channel only belongs to the pooled connection)
+        if ssh_conn is not pooled_conn:
+            ftp_client = None
+
         tryagain = True
 
         while tryagain:
 
             batch_run_file = instance.path_join( global_path , 'batch_run-'+batch.get_uid()+'.sh')
             batch_pid_file = instance.path_join( global_path , 'batch_pid-'+batch.get_uid()+'.sh')
+            batch_ftp_client = None
             try:
-                ftp_client = await ssh_conn.start_sftp_client()
-                await ftp_client.chdir(global_path)
-                await self.sftp_put_string(ftp_client,batch_run_file,cmd_run_pre+cmd_run)
-                await self.sftp_put_string(ftp_client, batch_pid_file,cmd_pid)
+                # the pooled SFTP channel (or a new one, closed below, once we have reconnected)
+                if ftp_client is None:
+                    batch_ftp_client = await ssh_conn.start_sftp_client()
+                await self.sftp_put_string(ftp_client or batch_ftp_client,batch_run_file,cmd_run_pre+cmd_run)
+                await self.sftp_put_string(ftp_client or batch_ftp_client, batch_pid_file,cmd_pid)
                 commands = []
 
                 eol_command = get_EOL_conversion(instance,batch_run_file)
@@ -848,15 +1150,374 @@ class KatapultFatProvider(KatapultProvider,ABC):
             except Exception as e:
                 self.debug(1,e)
                 self.debug(1,"ERROR: the instance is unreachable while sending batch",instance,color=bcolors.FAIL)
-                ssh_conn = await self._handle_instance_disconnect(run_session,instance,True,"could not run jobs for instance")
+                ssh_conn   = await self._handle_instance_disconnect(run_session,instance,True,"could not run jobs for instance")
+                ftp_client = None
                 if ssh_conn is None:
                     return 
                 tryagain = True
+            finally:
+                if batch_ftp_client is not None:
+                    batch_ftp_client.exit()
 
-        ssh_conn.close()
+        self._release_connection(instance,ssh_conn)
 
         self.serialize_state()
 
+    # number of CPU slots used by the job
+    def _get_job_cpus(self,job):
+        cpus = job.get_config('cpus_req') or job.get_config('cpu_reqs')
+        try:
+            return max(1,int(cpus))
+        except (TypeError,ValueError):
+            return 1
+
+    # number of tasks of an array job running at the same time (1 for the other jobs)
+    # by default, as many as the instance CPUs allow (cpus_req is per task)
+    def _get_array_parallel(self,job,instance):
+        if not job.is_array():
+            return 1
+        parallel = job.get_config('array_parallel')
+        if not parallel:
+            parallel = ( instance.get_cpus() or 1 ) // self._get_job_cpus(job)
+        array_range = job.get_array_range()
+        return max( 1 , min( int(parallel) , array_range[1] - array_range[0] ) )
+
+    # number of CPUs used by the processes of the instance that are not over
+    def _get_busy_cpus(self,run_session,instance):
+        busy = 0
+        for process in run_session.get_active_processes(instance):
+            if not process.get_state() & (KatapultProcessState.DONE|KatapultProcessState.ABORTED):
+                dpl_job = process.get_job()
+                busy += self._get_job_cpus(dpl_job) * self._get_array_parallel(dpl_job,instance)
+        return busy
+
+    def _has_pending_dispatch(self):
+        return bool(self._dispatch_queue) or self._dispatch_inflight > 0
+
+    def _is_dynamic_dispatch(self):
+        return self._config.get('job_dispatch','static') == 'dynamic'
+
+    # the process of the job the dependent jobs use (None if the job is not over yet)
+    # a job that is queued or being sent has not run yet in this session
+    def _get_dependency_process(self,run_session,job):
+        if ( self._dispatch_queue and job in self._dispatch_queue ) or job in self._dispatch_sending:
+            return None
+        process = job.get_last_process()
+        if process is None:
+            return None
+        # (a job that has completed in a previous session and is not run again)
+        if process.get_batch() and process.get_batch().get_session() != run_session and process.get_state() != KatapultProcessState.DONE:
+            return None
+        if not process.get_state() & (KatapultProcessState.DONE|KatapultProcessState.ABORTED):
+            return None
+        return process
+
+    # 'ready' , 'wait' or 'failed' (a job it depends on has been aborted)
+    def _get_dependencies_state(self,run_session,job):
+        result = 'ready'
+        for dep in job.get_dependencies():
+            if dep in self._dispatch_failed:
+                return 'failed'
+            process = self._get_dependency_process(run_session,dep)
+            if process is None:
+                result = 'wait'
+            elif process.get_state() != KatapultProcessState.DONE:
+                return 'failed'
+        return result
+
+    # data locality: a job that depends on other jobs goes to the instance that holds most of their outputs
+    # (if its environment is there)
+    def _get_dispatch_instance(self,run_session,job):
+        counts = dict()
+        for dep in job.get_dependencies():
+            process = self._get_dependency_process(run_session,dep)
+            if process is not None:
+                counts[process.get_instance()] = counts.get(process.get_instance(),0) + len(self._get_process_output_files(process) or [])
+        best = job.get_instance()
+        for instance , count in counts.items():
+            if count > counts.get(best,0) and instance.has_environment(job.get_env()) and not self._is_interrupted(instance):
+                best = instance
+        # (the instance is being reclaimed)
+        if self._is_interrupted(best):
+            best = self._get_replacement_instance(run_session,job) or best
+        return best
+
+    # takes the next jobs of the central queue that are ready (their dependencies are over)
+    # - dynamic dispatch: as long as they fit the free CPUs of the instance (+ 'dispatch_prefetch' jobs staged in advance)
+    #   its own jobs first, then the jobs of the instances with the largest backlog (if the environment is there)
+    # - static assignation: all the ready jobs that go to the instance
+    def _take_dispatch_jobs(self,run_session,instance,steal=True):
+        if not self._dispatch_queue:
+            return []
+
+        # the jobs depending on an aborted job will never run
+        for job in list(self._dispatch_queue):
+            if self._get_dependencies_state(run_session,job) == 'failed':
+                self.debug(1,"Job",job.get_rank(),"will not run: a job it depends on has been aborted",color=bcolors.WARNING)
+                self._dispatch_queue.remove(job)
+                self._dispatch_failed.add(job)
+
+        ready      = [ job for job in self._dispatch_queue if self._get_dependencies_state(run_session,job) == 'ready' ]
+        targets    = { job : self._get_dispatch_instance(run_session,job) for job in ready }
+        candidates = [ job for job in ready if targets[job] == instance ]
+
+        if not self._is_dynamic_dispatch():
+            for job in candidates:
+                self._dispatch_queue.remove(job)
+            return candidates
+
+        use_slots = self._config.get('job_slots',True)
+        slots     = ( instance.get_cpus() or 1 ) if use_slots else 1
+        busy      = self._get_busy_cpus(run_session,instance)
+        prefetch  = int(self._config.get('dispatch_prefetch',0))
+
+        if steal:
+            backlog = dict()
+            for job in ready:
+                backlog[targets[job]] = backlog.get(targets[job],0) + 1
+            others  = [ job for job in ready if targets[job] != instance and instance.has_environment(job.get_env()) ]
+            others.sort( key=lambda job : -backlog[targets[job]] ) # (stable: keeps the ranks order)
+            candidates.extend(others)
+
+        taken = []
+        for job in candidates:
+            cpus = self._get_job_cpus(job) * self._get_array_parallel(job,instance)
+            # an idle instance always takes a job (slotrun.py caps its CPUs)
+            if busy + cpus > slots and ( busy > 0 or taken ):
+                if prefetch <= 0:
+                    break
+                prefetch -= 1
+            self._dispatch_queue.remove(job)
+            busy += cpus
+            taken.append(job)
+        return taken
+
+    # where the outputs of a job it depends on are on the instance
+    # (the run directory of that job if it ran there, a copy in the directory of the job otherwise)
+    def _get_dependency_dir(self,instance,dpl_job,process):
+        if process.get_instance() == instance:
+            return process.get_path()
+        return instance.path_join( dpl_job.get_path() , 'deps' , process.get_uid() )
+
+    # links the outputs of the jobs it depends on in the run directory of the job (with the same names)
+    def _get_dependencies_ln_command(self,run_session,dpl_job,run_path):
+        lnstr    = ""
+        instance = dpl_job.get_instance()
+        for dep in dpl_job.get_dependencies():
+            process = self._get_dependency_process(run_session,dep)
+            if process is None:
+                continue
+            dep_dir = self._get_dependency_dir(instance,dpl_job,process)
+            for out_file in self._get_process_output_files(process) or []:
+                target = instance.path_join( run_path , out_file )
+                if instance.path_dirname(out_file):
+                    lnstr = lnstr + "mkdir -p " + instance.path_dirname(target) + "\n"
+                lnstr = lnstr + "ln -sf " + instance.path_join( dep_dir , out_file ) + " " + target + "\n"
+        return lnstr
+
+    # copies the outputs of the jobs they depend on from the instances holding them
+    async def _stage_dependencies(self,run_session,instance,jobs):
+        transfers = dict() # source instance -> [ ( source path , target path ) ]
+        for job in jobs:
+            dpl_job = job.deploy(job.get_env().deploy(instance),False)
+            for dep in job.get_dependencies():
+                process = self._get_dependency_process(run_session,dep)
+                if process is None or process.get_instance() == instance:
+                    continue
+                dep_dir = self._get_dependency_dir(instance,dpl_job,process)
+                for out_file in self._get_process_output_files(process) or []:
+                    transfers.setdefault(process.get_instance(),[]).append( ( instance.path_join( process.get_path() , out_file ) , instance.path_join( dep_dir , out_file ) ) )
+        await self._transfer_from_instances(instance,transfers,"outputs")
+
+    # job with checkpoints ('checkpoint_files' , 'checkpoint_command'):
+    # writes checkpoint.json in the run directory (for spot_watch.py)
+    # and puts back the checkpoint files of the run that has been interrupted (staged in 'checkpoint/UID')
+    def _get_checkpoint_command(self,job,dpl_job,run_path):
+        files   = job.get_config('checkpoint_files') or []
+        command = job.get_config('checkpoint_command')
+        if not files and not command:
+            return ""
+        instance   = dpl_job.get_instance()
+        checkpoint = json.dumps( { 'files' : files , 'command' : command } )
+        cmdstr     = "cat > " + instance.path_join( run_path , 'checkpoint.json' ) + " <<'__KATAPULT_CHECKPOINT__'\n" + checkpoint + "\n__KATAPULT_CHECKPOINT__\n"
+        process    = self._checkpoints.get(job)
+        if process is not None:
+            checkpoint_dir = instance.path_join( dpl_job.get_path() , CHECKPOINT_DIR , process.get_uid() )
+            for the_file in files:
+                src = instance.path_join( checkpoint_dir , the_file )
+                dst = instance.path_join( run_path , the_file )
+                if instance.path_dirname(the_file):
+                    cmdstr = cmdstr + "mkdir -p " + instance.path_dirname(dst) + "\n"
+                cmdstr = cmdstr + "test -f " + src + " && cp -f " + src + " " + dst + "\n"
+        return cmdstr
+
+    # copies the checkpoint files of the interrupted runs of the jobs (before the instance is reclaimed)
+    async def _stage_checkpoints(self,instance,jobs):
+        transfers = dict() # source instance -> [ ( source path , target path ) ]
+        for job in jobs:
+            process = self._checkpoints.get(job)
+            if process is None:
+                continue
+            dpl_job        = job.deploy(job.get_env().deploy(instance),False)
+            checkpoint_dir = instance.path_join( dpl_job.get_path() , CHECKPOINT_DIR , process.get_uid() )
+            for the_file in job.get_config('checkpoint_files') or []:
+                transfers.setdefault(process.get_instance(),[]).append( ( instance.path_join( process.get_path() , the_file ) , instance.path_join( checkpoint_dir , the_file ) ) )
+        await self._transfer_from_instances(instance,transfers,"checkpoint")
+
+    def _is_interrupted(self,instance):
+        return instance.get_name() in self._interrupted_instances
+
+    # where a job goes when its instance is reclaimed: the least busy instance with its environment
+    def _get_replacement_instance(self,run_session,job):
+        candidates = [ inst for inst in self._instances if not self._is_interrupted(inst) and inst.has_environment(job.get_env()) ]
+        if not candidates:
+            return None
+        return min( candidates , key=lambda inst : self._get_busy_cpus(run_session,inst) / ( inst.get_cpus() or 1 ) )
+
+    # the spot instance is being reclaimed: spot_watch.py has checkpointed and stopped its jobs
+    # they run again on the other instances (from their checkpoint files)
+    async def _handle_spot_interruption(self,run_session,instance,processes):
+        self.debug(1,"Spot interruption of",instance.get_name(),": moving",len(processes),"job(s) to other instances",color=bcolors.WARNING)
+        self._interrupted_instances.add(instance.get_name())
+        targets = dict()
+        for process in processes:
+            process.deactivate()
+            process.set_aborted_reason('spot interruption')
+            job = process.get_job().get_parent_job()
+            if job.get_config('checkpoint_files'):
+                self._checkpoints[job] = process
+            target = self._get_replacement_instance(run_session,job)
+            if target is None:
+                self.debug(1,"No instance left to run job",job.get_rank(),color=bcolors.FAIL)
+                continue
+            targets.setdefault(target,[]).append(job)
+        # (the jobs are being sent: the jobs depending on them keep waiting)
+        for jobs in targets.values():
+            self._dispatch_sending.update(jobs)
+        self._dispatch_inflight += 1
+        try:
+            for target in targets:
+                self._ensure_instance_watch(run_session,target)
+            await asyncio.gather( *[ self._dispatch_jobs(run_session,target,jobs) for target , jobs in targets.items() ] )
+        finally:
+            self._dispatch_inflight -= 1
+
+    # copies files from other instances: directly between the instances (peer server) if they can reach each other
+    # or through the client otherwise
+    # transfers = { source instance : [ ( source path , target path ) ] }
+    async def _transfer_from_instances(self,instance,transfers,what):
+        if not transfers:
+            return
+
+        instanceid , ssh_conn , ftp_client = await self._wait_and_connect(instance)
+        if ssh_conn is None:
+            return
+        for source , files in transfers.items():
+            source_id , source_ssh , source_ftp = await self._wait_and_connect(source)
+            if source_ssh is None:
+                self.debug(1,"Could not get the",what,"of",source.get_name(),"for",instance.get_name(),color=bcolors.WARNING)
+                continue
+            try:
+                failed = files
+                group  = self._get_fanout_group(source)
+                if group is not None and group == self._get_fanout_group(instance):
+                    base_url = await self._get_fanout().get_server(source,lambda: self._start_peer_server(source,source_ssh))
+                    items    = [ { 'url' : self._get_peer_url(base_url,src) , 'path' : dst } for src , dst in files ]
+                    results  = await self._remote_ops(instance,ssh_conn,[ { 'op' : 'fetch' , 'items' : items } ],ftp_client)
+                    errors   = results[0].get('errors') or [ results[0].get('error') ] * len(files)
+                    failed   = [ f for f , error in zip(files,errors) if error is not None ]
+                    self.debug(2,"fetched",len(files)-len(failed),what,"file(s) from peer",source.get_name())
+                # through the client
+                for src , dst in failed:
+                    try:
+                        with tempfile.TemporaryDirectory() as tmp_dir:
+                            local_path = os.path.join(tmp_dir,instance.path_basename(dst))
+                            await source_ftp.get(src,local_path)
+                            await ftp_client.makedirs(instance.path_dirname(dst),exist_ok=True)
+                            await ftp_client.put(local_path,dst)
+                    except (OSError, asyncssh.Error) as e:
+                        self.debug(1,"Could not copy",src,"from",source.get_name(),"to",instance.get_name(),e,color=bcolors.WARNING)
+            except (OSError, asyncssh.Error, KatapultError) as e:
+                self.debug(1,"Could not get the",what,"of",source.get_name(),"for",instance.get_name(),e,color=bcolors.WARNING)
+            finally:
+                self._release_connection(source,source_ssh)
+        self._release_connection(instance,ssh_conn)
+
+    # takes a job that is staged on an overloaded instance but hasn't started yet
+    # (the staged process is cancelled there and the job is run again here)
+    async def _steal_staged_job(self,run_session,instance):
+        use_slots = self._config.get('job_slots',True)
+        slots     = ( instance.get_cpus() or 1 ) if use_slots else 1
+        if self._get_busy_cpus(run_session,instance) >= slots:
+            return []
+        staged = dict()
+        for process in run_session.get_active_processes():
+            victim = process.get_instance()
+            if victim == instance or process.get_state() != KatapultProcessState.QUEUE:
+                continue
+            if not instance.has_environment(process.get_job().get_parent_job().get_env()):
+                continue
+            staged.setdefault(victim,[]).append(process)
+        # only the instances that have more jobs than CPUs are overloaded
+        for victim in list(staged.keys()):
+            if self._get_busy_cpus(run_session,victim) <= ( ( victim.get_cpus() or 1 ) if use_slots else 1 ):
+                del staged[victim]
+        if not staged:
+            return []
+        victim   = max( staged , key=lambda inst : len(staged[inst]) )
+        process  = staged[victim][-1] # the last in the queue of the victim
+        process.deactivate()
+        self.debug(1,"Stealing job",process.get_job().get_rank(),"from",victim.get_name(),"for",instance.get_name(),color=bcolors.OKCYAN)
+        await self._kill(victim,[process])
+        process.set_state(KatapultProcessState.ABORTED)
+        process.set_aborted_reason('moved to '+instance.get_name())
+        return [ process.get_job().get_parent_job() ]
+
+    # the instance has been seen by the watcher: send it the next jobs if it has free CPUs
+    # (or the given jobs: the jobs of an interrupted instance)
+    async def _dispatch_jobs(self,run_session,instance,jobs=None):
+        if jobs is None:
+            jobs = self._take_dispatch_jobs(run_session,instance)
+            if not jobs and self._is_dynamic_dispatch() and self._config.get('dispatch_steal',True):
+                self._dispatch_inflight += 1
+                try:
+                    jobs = await self._steal_staged_job(run_session,instance)
+                finally:
+                    self._dispatch_inflight -= 1
+        if not jobs:
+            return
+
+        batch = None
+        self._dispatch_inflight += 1
+        self._dispatch_sending.update(jobs)
+        try:
+            # the jobs of other instances are moved here (their files are uploaded first)
+            moved = [ job for job in jobs if job.get_instance() != instance ]
+            for job in moved:
+                job.get_instance().remove_job(job)
+                job.set_instance(instance)
+            if moved:
+                instanceid , ssh_conn , ftp_client = await self._wait_and_connect(instance)
+                if ssh_conn:
+                    await self._deploy_jobs(instance,{ instance.get_name() : dict() },ssh_conn,ftp_client,jobs=moved)
+                    self._release_connection(instance,ssh_conn)
+            # the outputs of the jobs they depend on (held by other instances)
+            await self._stage_dependencies(run_session,instance,jobs)
+            # the checkpoints of the jobs coming from an interrupted instance
+            await self._stage_checkpoints(instance,jobs)
+            self.debug(1,"Dispatching",len(jobs),"job(s) to",instance.get_name(),color=bcolors.OKCYAN)
+            batch = run_session.create_batch()
+            await self._run_jobs_for_instance(run_session,batch,instance,False,False,jobs)
+        finally:
+            self._dispatch_inflight -= 1
+            self._dispatch_sending.difference_update(jobs)
+            # the jobs that could not be sent go back to the queue
+            lost = [ job for job in jobs if batch is None or job.get_last_process() is None or job.get_last_process().get_batch() != batch ]
+            if lost and self._dispatch_queue is not None:
+                self._dispatch_queue[0:0] = lost
+            elif lost:
+                self.debug(1,"Could not send",len(lost),"job(s) to",instance.get_name(),color=bcolors.FAIL)
+
     # entry point ...
     async def run(self,continue_session=False):
 
@@ -912,11 +1573,40 @@ class KatapultFatProvider(KatapultProvider,ABC):
         # IMPORTANT: create it after de-activation !
         batch = run_session.create_batch()
 
+        # central queue of the jobs sent later by the watcher (see _dispatch_jobs):
+        # - dynamic dispatch: all the jobs, each instance only gets what its CPUs can run now
+        # - jobs depending on other jobs ('depends_on'): sent once the jobs they depend on are done
+        dispatch = instance_filter is None and do_init
+        if dispatch:
+            self._dispatch_queue  = None
+            self._dispatch_failed = set()
+            self._checkpoints     = dict()
+            self._interrupted_instances = set()
+            to_run = sorted( [ job for instance in instances for job in instance.get_jobs() if not ( except_done and job.has_completed() ) ] , key=lambda job : job.get_rank() )
+            if self._is_dynamic_dispatch():
+                self._dispatch_queue = to_run
+            elif any( job.get_dependencies() for job in to_run ):
+                self._dispatch_queue = [ job for job in to_run if job.get_dependencies() ]
+
         # run the jobs on each instances
         jobs = []
+        sending = []
         for instance in instances:
-            jobs.append( self._run_jobs_for_instance(run_session,batch,instance,except_done,only_new_processes) ) 
-        await asyncio.gather( *jobs )
+            if dispatch and self._dispatch_queue is not None:
+                dispatch_jobs = [ job for job in instance.get_jobs() if job not in self._dispatch_queue and not ( except_done and job.has_completed() ) ]
+                if self._is_dynamic_dispatch():
+                    dispatch_jobs.extend( self._take_dispatch_jobs(run_session,instance,False) )
+                # (those have not run yet for the jobs depending on them)
+                self._dispatch_sending.update(dispatch_jobs)
+                sending.extend(dispatch_jobs)
+                if dispatch_jobs:
+                    jobs.append( self._run_jobs_for_instance(run_session,batch,instance,except_done,only_new_processes,dispatch_jobs) ) 
+            else:
+                jobs.append( self._run_jobs_for_instance(run_session,batch,instance,except_done,only_new_processes) ) 
+        try:
+            await asyncio.gather( *jobs )
+        finally:
+            self._dispatch_sending.difference_update(sending)
 
         # update the Provider state
         self.set_state( self._state | KatapultProviderState.RUNNING )
@@ -1081,7 +1771,7 @@ class KatapultFatProvider(KatapultProvider,ABC):
 
             if ssh_conn:
                 # ftp_client.close()
-                ssh_conn.close()   
+                self._release_connection(_instance,ssh_conn)
 
     async def print_objects(self):
         self.debug(1,"STATE =",self._state)
@@ -1187,6 +1877,33 @@ class KatapultFatProvider(KatapultProvider,ABC):
             self.debug(1,"Skipping instance",instance.get_name(),"(unreachable)",color=bcolors.WARNING)
             return
 
+        # states of the tasks of the array jobs (one character per task)
+        # the outputs of the completed tasks are fetched even if some other tasks have failed
+        array_processes = [ p for p in processes if p.get_job().is_array() and p.get_state() in ( KatapultProcessState.DONE , KatapultProcessState.ABORTED ) ]
+        if array_processes:
+            try:
+                results = await self._remote_ops(instance,ssh_conn,[ { 'op' : 'read' , 'path' : instance.path_join( p.get_path() , 'tasks.state' ) } for p in array_processes ],ftp_client)
+                for process , result in zip(array_processes,results):
+                    if result.get('exists') and result.get('content') is not None:
+                        process.set_tasks_state( result['content'].strip() )
+            except (OSError, asyncssh.Error, KatapultError) as e:
+                self.debug(2,"Could not get the states of the array tasks",e)
+
+        # sizes of the output files (one round trip) so large files can be fetched in chunks
+        remote_sizes = dict()
+        if self._config.get('large_file_threshold',LARGE_FILE_THRESHOLD) is not None:
+            out_paths = []
+            for process in processes:
+                for out_file in self._get_process_output_files(process) or []:
+                    out_paths.append( instance.path_join( process.get_path() , out_file ) )
+            try:
+                results = await self._remote_ops(instance,ssh_conn,[ { 'op' : 'stat' , 'path' : path } for path in out_paths ],ftp_client)
+                for path , result in zip(out_paths,results):
+                    if result.get('exists'):
+                        remote_sizes[path] = result.get('size')
+            except (OSError, asyncssh.Error, KatapultError) as e:
+                self.debug(2,"Could not get the size of the output files",e)
+
         for process in processes:
 
             if process.get_state() != KatapultProcessState.DONE and process.get_state() != KatapultProcessState.ABORTED:
@@ -1208,8 +1925,8 @@ class KatapultFatProvider(KatapultProvider,ABC):
                         except:
                             pass
 
-                    elif process.get_state() == KatapultProcessState.DONE:
-                        out_files = dpl_job.get_config('output_files') # this file is written for the local machine
+                    if process.get_state() == KatapultProcessState.DONE or dpl_job.is_array():
+                        out_files = self._get_process_output_files(process) # this file is written for the local machine
                         if out_files is None:
                             self.debug(1,"No output defined in config for job. We won't fetch",dpl_job,color=bcolors.WARNING)
                             break
@@ -1225,10 +1942,14 @@ class KatapultFatProvider(KatapultProvider,ABC):
                             else:
                                 file_name = out_file
                                 local_path = os.path.join(session_out_dir,file_name)
-                            #ftp_client.chdir(directory)
-                            await ftp_client.chdir( directory )
+                            size = remote_sizes.get(remote_file_path)
+                            if size is not None and self._is_large_file(size):
+                                errors = await self._transfer_large_files(instance,ssh_conn,ftp_client,'get',[ ( local_path , remote_file_path , size ) ])
+                                if errors[0] is not None:
+                                    raise errors[0]
+                                continue
                             try:
-                                await ftp_client.get( filename , local_path )   
+                                await ftp_client.get( remote_file_path , local_path )   
                             except asyncssh.sftp.SFTPNoSuchFile:
                                 self.debug(1,"No file for process",process.get_uid(),"job#",rank,directory,filename,local_path)
                                 pass
@@ -1244,13 +1965,100 @@ class KatapultFatProvider(KatapultProvider,ABC):
                         self.debug(1,"Enough retries. Stop fetching results",color=bcolors.FAIL)
                         return
         
-        ssh_conn.close()
+        self._release_connection(instance,ssh_conn)
+
+    # output files to fetch for a process (None if the job doesn't define any)
+    def _get_process_output_files(self,process):
+        dpl_job = process.get_job()
+        if dpl_job.get_config('output_files') is None:
+            return None
+        if dpl_job.is_array():
+            if process.get_state() not in ( KatapultProcessState.DONE , KatapultProcessState.ABORTED ):
+                return []
+            # only the outputs of the completed tasks
+            return dpl_job.get_output_files( process.get_tasks_indices(KatapultProcessState.DONE) )
+        if process.get_state() != KatapultProcessState.DONE:
+            return []
+        return dpl_job.get_config('output_files')
 
     async def finalize(self):
         if self._watcher_task:
             await self._watcher_task
             # while not self._watcher_task.done():
             #     await asyncio.sleep(SLEEP_PERIOD)
+        if self._config.get('bake_images',False):
+            await self.bake_images()
+        self.debug(2,"SSH connections stats",self.get_connection_stats())
+        self._conn_pool.close_all()
+
+    def _get_bake_env_names(self):
+        return [ env.get_name_with_hash() for env in self._environments ]
+
+    # the image only keeps the runner files and the environments:
+    # the instances launched from it should not see the servers, the CPU claims, the cancelled/interrupted jobs
+    # and the run directories of this instance
+    async def _clean_runtime_state(self,instance,ssh_conn):
+        global_path = instance.get_global_dir()
+        rm_ops = [
+            { 'op' : 'rm' , 'path' : instance.path_join(global_path,'*.pid') , 'glob' : True } ,
+            { 'op' : 'rm' , 'path' : instance.path_join(global_path,'batch_*-*.sh') , 'glob' : True } ,
+            { 'op' : 'rm' , 'path' : instance.path_join(global_path,'.locks','slots.json') } ,
+            { 'op' : 'rm' , 'path' : instance.path_join(global_path,'cancelled') } ,
+            { 'op' : 'rm' , 'path' : instance.path_join(global_path,'interrupted') }
+        ]
+        for job in instance.get_jobs():
+            if job.get_env() is not None:
+                # (the 'ready' markers of the jobs are in their directories)
+                job_path = instance.path_join( job.get_env().deploy(instance).get_path() , job.get_hash() )
+                rm_ops.append( { 'op' : 'rm' , 'path' : job_path , 'recursive' : True } )
+        results = await self._remote_ops(instance,ssh_conn,rm_ops)
+        errors = [ result.get('error') for result in results if not result.get('ok') ]
+        if errors:
+            self.debug(1,"Could not clean the runtime state of",instance.get_name(),errors,color=bcolors.WARNING)
+            return False
+        return True
+
+    # snapshots the instances with bootstrapped environments into golden images (tagged with those environments)
+    # the next instances are launched from them and skip the bootstrap of those environments
+    # returns the ids of the new images
+    async def bake_images(self):
+        loop   = asyncio.get_running_loop()
+        images = []
+        regions = dict()
+        for instance in self._instances:
+            regions[instance.get_region()] = True
+            dpl_envs = [ env.deploy(instance) for env in instance.get_environments() ]
+            if not dpl_envs or instance.get_state() != KatapultInstanceState.RUNNING:
+                continue
+            instanceid , ssh_conn , ftp_client = await self._wait_and_connect(instance)
+            if ssh_conn is None:
+                continue
+            try:
+                results = await self._remote_ops(instance,ssh_conn,[ { 'op' : 'stat' , 'path' : instance.path_join( dpl_env.get_path() , 'ready' ) } for dpl_env in dpl_envs ])
+                # only keep the bootstrapped environments
+                env_names = [ dpl_env.get_name_with_hash() for dpl_env , result in zip(dpl_envs,results) if result.get('exists') ]
+                cleaned   = bool(env_names) and await self._clean_runtime_state(instance,ssh_conn)
+            finally:
+                self._release_connection(instance,ssh_conn)
+            if not env_names:
+                self.debug(1,"No bootstrapped environment to bake on",instance.get_name())
+                continue
+            if not cleaned:
+                continue
+            try:
+                image_id = await loop.run_in_executor(None,self.bake_image,instance,env_names)
+            except KatapultError as e:
+                self.debug(1,e,color=bcolors.WARNING)
+                continue
+            if image_id:
+                self.debug(1,"Baked golden image",image_id,"from",instance.get_name(),color=bcolors.OKCYAN)
+                images.append(image_id)
+
+        env_names = self._get_bake_env_names()
+        for region in regions.keys():
+            await loop.run_in_executor(None,self.gc_baked_images,region,env_names)
+
+        return images
 
     # this method fetched a "real" RunSession object in memory
     # this is used especially when we use the light client to control a fat client
@@ -1372,6 +2180,9 @@ class KatapultFatProvider(KatapultProvider,ABC):
             self.debug(1,"INTERNET connection error. The process will stop.")
             return None 
 
+        # the pooled connection is likely dead
+        self._discard_connection(instance)
+
         # this is an Internet error
         if instance.get_state() == KatapultInstanceState.RUNNING:
             ssh_conn = await self._connect_to_instance(instance)
@@ -1452,9 +2263,9 @@ class KatapultFatProvider(KatapultProvider,ABC):
             pid         = process.get_pid()
             pid_child  = process.get_pid_child()
             if jobsinfo:
-                jobsinfo = jobsinfo + " \"" + dpl_env.get_name_with_hash() + "\" " + str(shash) + " " + str(uid) + " " + str(pid) + " " + str(pid_child) + " \"" + "|".join(job.get_config('output_files')) + "\""
+                jobsinfo = jobsinfo + " \"" + dpl_env.get_name_with_hash() + "\" " + str(shash) + " " + str(uid) + " " + str(pid) + " " + str(pid_child) + " \"" + "|".join(job.get_output_files()) + "\""
             else:
-                jobsinfo = "\"" + dpl_env.get_name_with_hash() + "\" " + str(shash) + " " + str(uid) + " " + str(pid) + " " + str(pid_child) + " \"" + "|".join(job.get_config('output_files')or[]) + "\""
+                jobsinfo = "\"" + dpl_env.get_name_with_hash() + "\" " + str(shash) + " " + str(uid) + " " + str(pid) + " " + str(pid_child) + " \"" + "|".join(job.get_output_files()) + "\""
             
         return jobsinfo 
     
@@ -1582,6 +2393,18 @@ class KatapultFatProvider(KatapultProvider,ABC):
 
                 fetched , ssh_conn = await self.__fetch_states_internal(run_session,instance,processes,do_revive,ssh_conn)
 
+                # spot interruption: the jobs have been stopped by spot_watch.py, they go to the other instances
+                # and the instance isn't watched anymore (it is about to be reclaimed, it must not be revived)
+                if wait_mode & KatapultProviderStateWaitMode.WATCH and run_session == self._current_session:
+                    interrupted = [ p for p in run_session.get_active_processes(instance) if p.get_state() == KatapultProcessState.ABORTED and ( p.get_substate() or '' ).startswith('spot interruption') ]
+                    if interrupted:
+                        await self._handle_spot_interruption(run_session,instance,interrupted)
+                        break
+
+                # dynamic dispatch: the instance gets the next jobs of the central queue as its CPUs free up
+                if wait_mode & KatapultProviderStateWaitMode.WATCH and self._dispatch_queue is not None and run_session == self._current_session:
+                    await self._dispatch_jobs(run_session,instance)
+
                 # always update the activate processes in case something happened
                 processes = run_session.get_active_processes(instance)
 
@@ -1598,7 +2421,7 @@ class KatapultFatProvider(KatapultProvider,ABC):
                 self.debug(2,retrieved,arr_retrieved)
                 self.debug(2,tested   ,arr_test     )
 
-                if retrieved and tested :
+                if retrieved and tested and not ( wait_mode & KatapultProviderStateWaitMode.WATCH and self._has_pending_dispatch() ) :
                     break
 
                 self.serialize_state()
@@ -1611,7 +2434,7 @@ class KatapultFatProvider(KatapultProvider,ABC):
                 else:
                     break
 
-            ssh_conn.close() 
+            self._release_connection(instance,ssh_conn)
 
             self.serialize_state()
 
@@ -1745,7 +2568,22 @@ class KatapultFatProvider(KatapultProvider,ABC):
             # self.deploy()
             pass
 
+    # the jobs of an interrupted instance have been moved to the instance: watch it again if its watcher is over
+    def _ensure_instance_watch(self,run_session,instance):
+        if self._instances_watching.get(instance.get_name(),False):
+            return
+        self._instances_watching[instance.get_name()] = True
+        job_state = KatapultProcessState.DONE|KatapultProcessState.ABORTED
+        self._spot_watch_tasks.append( asyncio.ensure_future( self.__wait_for_state_internal(run_session,instance,job_state,KatapultProviderStateWaitMode.WAIT|KatapultProviderStateWaitMode.WATCH,True) ) )
+
     async def _cancel_watch(self):
+        for task in self._spot_watch_tasks:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._spot_watch_tasks = [ ]
         if self._watcher_task is not None:
             self._watcher_task.cancel()
             try:
@@ -1797,8 +2635,10 @@ class KatapultFatProvider(KatapultProvider,ABC):
             if not run_session:
                 break
             
-            test = True 
-            for process in run_session.get_active_processes(instance):
+            # (the jobs still in the queue of the dynamic dispatch are not over yet)
+            # all the instances are tested: the jobs may be moved to another instance (dispatch, spot interruption)
+            test = not self._has_pending_dispatch()
+            for process in run_session.get_active_processes():
                 test = test and (process.get_state() & job_state )
             
             if test:
@@ -1844,7 +2684,7 @@ class KatapultFatProvider(KatapultProvider,ABC):
         # print
         self.print_jobs_summary(run_session,instance)
 
-        ssh_conn.close()
+        self._release_connection(instance,ssh_conn)
 
 
     async def get_jobs_states(self,run_session=None,last_running_processes=False):
@@ -1945,7 +2785,7 @@ class KatapultFatProvider(KatapultProvider,ABC):
             self.debug(1,"Error while preparing for VSCode",e)
             traceback.print_exc()
 
-        ssh_conn.close()
+        self._release_connection(instance,ssh_conn)
 
     @abstractmethod
     def get_recommended_cpus(self,inst_cfg):
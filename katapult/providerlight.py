@@ -226,16 +226,19 @@ class KatapultLightProvider(KatapultProvider,ABC):
         if mkdir_cmd:
             stdout , stderr , ssh_conn , ftp_client = await self._exec_maestro_command_simple(ssh_conn,ftp_client,mkdir_cmd)
             await stdout.read()
-        for remote_dir , files_infos in files_to_upload_per_dir.items():
-            await ftp_client.chdir(remote_dir)
-            for file_info in files_infos:
-                remote_file = os.path.basename(file_info['remote'])
-                try:
-                    await ftp_client.put(file_info['local'],remote_file)
-                except FileNotFoundError as fnfe:
-                    self.debug(1,"You have specified a file that does not exist:",fnfe,color=bcolors.FAIL)
-                except asyncssh.sftp.SFTPNoSuchFile as nsf:
-                    self.debug(1,"You have specified a file that does not exist:",nsf,remote_dir,file_info,color=bcolors.FAIL)
+        # only missing/changed files are sent (content manifest in ~/files)
+        files_infos = [ file_info for remote_dir , files_infos in files_to_upload_per_dir.items() for file_info in files_infos ]
+        if files_infos:
+            files_dir = self._maestro.path_join( self._get_home_dir() , 'files' )
+            errors , stats = await self._upload_files(self._maestro,ssh_conn,ftp_client,[ ( file_info['local'] , file_info['remote'] ) for file_info in files_infos ],files_dir,self._get_remote_files_path('remote_ops.py'))
+            for file_info , error in zip(files_infos,errors):
+                if isinstance(error,FileNotFoundError):
+                    self.debug(1,"You have specified a file that does not exist:",error,color=bcolors.FAIL)
+                elif isinstance(error,asyncssh.sftp.SFTPNoSuchFile):
+                    self.debug(1,"You have specified a file that does not exist:",error,file_info,color=bcolors.FAIL)
+                elif error is not None:
+                    self.debug(1,"Error while uploading",file_info,error,color=bcolors.FAIL)
+            self.debug(1,"uploaded:",stats)
         return config 
 
     def _translate_config_for_maestro(self,only_new):
@@ -602,8 +605,8 @@ class KatapultLightProvider(KatapultProvider,ABC):
         self.debug(1,'RESETTING instance',instance.get_name())
         instanceid, ssh_conn , ftp_client = await self._wait_and_connect(instance)
         if ssh_conn is not None:
-            await self.sftp_put_remote_file(ftp_client,'resetmaestro.sh')
             resetmaestro_sh = self._maestro.path_join( self._maestro.get_home_dir() , 'resetmaestro.sh' )
+            await self.sftp_put_remote_file(ftp_client,'resetmaestro.sh',resetmaestro_sh)
             commands = []
             eol_command = get_EOL_conversion(instance,resetmaestro_sh)
             if eol_command:
@@ -613,7 +616,7 @@ class KatapultLightProvider(KatapultProvider,ABC):
             )
             await self._run_ssh_commands(instance,ssh_conn,commands)
             #ftp_client.close()
-            ssh_conn.close()
+            self._release_connection(instance,ssh_conn)
         self.debug(1,'RESETTING done')
 
     async def deploy(self,**kwargs):
@@ -733,7 +736,7 @@ class KatapultLightProvider(KatapultProvider,ABC):
 
         # close
         #ftp_client.close()
-        ssh_conn.close()
+        self._release_connection(self._maestro,ssh_conn)
 
         return session_out_dir
 
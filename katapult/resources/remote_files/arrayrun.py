@@ -0,0 +1,88 @@
+import os , sys , subprocess , time , signal
+
+# Runs the tasks of an array job (called by run.sh from the run directory of the process)
+# usage: python3 arrayrun.py START:STOP:PARALLEL COMMAND
+# the command runs once per index in range(START,STOP) with $KATAPULT_TASK_INDEX set
+# PARALLEL tasks run at the same time (0 = number of CPUs of the instance)
+#
+# the state of the tasks is kept in 'tasks.state' (one character per task, in the order of the indices):
+#   '.' queued , 'r' running , 'd' done , 'a' aborted
+# a task that is already done in 'tasks.state' is not run again (restart of the same run directory)
+# the state of the process ('state' file) summarizes the tasks
+# exit status 0 (all the tasks are done) or TASKS_FAILED: the final state has been written (any other status: run.sh writes it)
+
+STATE_FILE   = 'state'
+TASKS_FILE   = 'tasks.state'
+FLUSH_PERIOD = 2.0
+TASKS_FAILED = 90
+
+start , stop , parallel = [ int(v) for v in sys.argv[1].split(':') ]
+command = sys.argv[2]
+if parallel <= 0:
+    parallel = os.cpu_count() or 1
+count = max(0,stop-start)
+
+tasks = bytearray(b'.'*count)
+try:
+    with open(TASKS_FILE,'rb') as the_file:
+        previous = the_file.read()
+    if len(previous) == count:
+        # only the completed tasks are kept
+        tasks = bytearray( c if c == ord('d') else ord('.') for c in previous )
+except OSError:
+    pass
+
+def summary():
+    done    = tasks.count(b'd')
+    running = tasks.count(b'r')
+    failed  = tasks.count(b'a')
+    return "array: {0} done {1} running {2} failed of {3}".format(done,running,failed,count)
+
+def flush(state=None):
+    with open(TASKS_FILE+'.tmp','wb') as the_file:
+        the_file.write(tasks)
+    os.replace(TASKS_FILE+'.tmp',TASKS_FILE)
+    with open(STATE_FILE,'w') as the_file:
+        the_file.write( ( state or 'running' ) + '(' + summary() + ')\n' )
+
+running = dict() # pid -> ( process , task position )
+pending = [ i for i in range(count) if tasks[i] != ord('d') ]
+pending.reverse()
+
+def terminate(signum,frame):
+    for pid in list(running):
+        try:
+            os.kill(pid,signal.SIGTERM)
+        except OSError:
+            pass
+    sys.exit(128+signum)
+
+signal.signal(signal.SIGTERM,terminate)
+
+last_flush = 0
+while pending or running:
+    while pending and len(running) < parallel:
+        i   = pending.pop()
+        env = dict(os.environ)
+        env['KATAPULT_TASK_INDEX'] = str(start+i)
+        process = subprocess.Popen(command,shell=True,executable='/bin/bash',env=env)
+        # (the process object is kept: subprocess would reap the task itself once the object is collected)
+        running[process.pid] = ( process , i )
+        tasks[i] = ord('r')
+    if time.time() - last_flush >= FLUSH_PERIOD:
+        flush()
+        last_flush = time.time()
+    # wait for one task at least (the state is flushed as the tasks complete)
+    pid , status = os.waitpid(-1,0)
+    entry = running.pop(pid,None)
+    if entry is not None:
+        process , i = entry
+        process.returncode = status # reaped already
+        tasks[i] = ord('d') if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0 else ord('a')
+
+# final state of the process (run.sh keeps it)
+if tasks.count(b'a'):
+    flush('aborted')
+    sys.exit(TASKS_FAILED)
+flush('done')
+sys.exit(0)
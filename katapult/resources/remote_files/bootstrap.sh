@@ -17,9 +17,24 @@ FILE_CONDA="$HOME/run/$env_name/environment.yml"
 FILE_PYPI="$HOME/run/$env_name/requirements.txt"
 FILE_APTGET="$HOME/run/$env_name/aptget.sh"
 FILE_JULIA="$HOME/run/$env_name/env_julia.jl"
+FILE_ARTIFACT="$HOME/run/$env_name/artifact.json"
+
+# held until the environment has been checked (run.sh blocks on it)
+exec 8>"$HOME/run/$env_name/bootstrap.lock"
+flock 8
 
 echo "bootstraping" > "$HOME/run/$env_name/state"
 
+# the environments may be bootstrapped concurrently:
+# only the steps using shared resources (apt/dpkg, micromamba install, the package cache, julia depot) are locked
+LOCK_DIR="$HOME/run/.locks"
+mkdir -p "$LOCK_DIR"
+
+# progress of this environment (env_state.sh reports it)
+function set_state () {
+  echo "bootstraping($1)" > "$HOME/run/$env_name/state"
+}
+
 rm -f "$HOME/run/$env_name/ready"
 
 printf "\n\n\n"
@@ -30,12 +45,21 @@ echo "********************************************************"
 echo "********************************************************"
 printf "\n\n\n"
 
+# try the packed environment first (the environment is then found below and not rebuilt)
+if [ -f "$FILE_ARTIFACT" ] && [[ "$dev" -ne 1 ]]; then
+  echo "fetching packed environment ..."
+  set_state "fetching packed environment"
+  /usr/bin/python3 $HOME/run/env_artifact.py fetch "$env_name" && echo "packed environment installed" || echo "no packed environment"
+fi
+
 if [ -f "$FILE_SH" ]; then
+  set_state "running env_command.sh"
   (cd "$HOME/run/$env_name/"; "$FILE_SH")
 fi
 
 if [ -f "$FILE_APTGET" ]; then
-  $FILE_APTGET
+  set_state "installing apt packages"
+  flock "$LOCK_DIR/apt" $FILE_APTGET
 fi
 
 if [ -f "$FILE_CONDA" ]; then
@@ -61,8 +85,13 @@ if [ -f "$FILE_CONDA" ]; then
 
   export MAMBA_ROOT_PREFIX=/home/ubuntu/micromamba
   export MAMBA_EXE=/home/ubuntu/.local/bin/micromamba
+  # (all the environments of the instance share the package cache $MAMBA_ROOT_PREFIX/pkgs: micromamba hardlinks the packages from it)
   
+  # only one bootstrap installs micromamba
+  exec 9>"$LOCK_DIR/micromamba-install"
+  flock 9
   if ! [ -x "$(command -v $HOME/.local/bin/micromamba)" ]; then
+    set_state "installing micromamba"
     echo "installing mamba ..."
     curl micro.mamba.pm/install.sh | bash
     #eval "$($HOME/.local/bin/micromamba shell hook -s posix)"
@@ -72,6 +101,29 @@ if [ -f "$FILE_CONDA" ]; then
     #eval "$($HOME/.local/bin/micromamba shell hook -s posix)"
     eval "$($HOME/.local/bin/micromamba shell hook --shell=bash )"
   fi  
+  flock -u 9
+  exec 9>&-
+
+  # the downloads run in parallel (in a scratch cache of the environment: --download-only extracts the packages too),
+  # the archives then join the shared package cache where the locked create extracts/links them
+  function mamba_create () {
+    local scratch="$MAMBA_ROOT_PREFIX/pkgs-$env_name"
+    set_state "downloading packages"
+    CONDA_PKGS_DIRS="$scratch" "$MAMBA_EXE" create -y -f "$FILE_CONDA" -n "$env_name" --download-only || echo "could not pre-download the packages"
+    set_state "installing packages"
+    exec 9>"$LOCK_DIR/micromamba-pkgs"
+    flock 9
+    mkdir -p "$MAMBA_ROOT_PREFIX/pkgs"
+    for archive in "$scratch"/*.tar.bz2 "$scratch"/*.conda; do
+      if [ -f "$archive" ] && ! [ -e "$MAMBA_ROOT_PREFIX/pkgs/$(basename "$archive")" ]; then
+        mv "$archive" "$MAMBA_ROOT_PREFIX/pkgs/"
+      fi
+    done
+    "$MAMBA_EXE" create -y -f "$FILE_CONDA" -n "$env_name"
+    flock -u 9
+    exec 9>&-
+    rm -rf "$scratch"
+  }
 
   # 2. check if we need to create the environment
 
@@ -84,7 +136,7 @@ if [ -f "$FILE_CONDA" ]; then
   #$HOME/miniconda/bin/activate $env_name >/dev/null
   if [[ "$dev" -eq 1 ]]; then
     echo "overwriting mamba environment"
-    micromamba create -y -f "$FILE_CONDA" -n "$env_name"
+    mamba_create
     echo "mamba environment created"
   else
     micromamba activate $env_name
@@ -94,7 +146,7 @@ if [ -f "$FILE_CONDA" ]; then
       echo "mamba environment not found"
       # $HOME/miniconda/bin/conda create -y -n "$env_name"
       # use mambda instead
-      micromamba create -y -f "$FILE_CONDA" -n "$env_name"
+      mamba_create
 
       echo "mamba environment created"
     fi
@@ -116,12 +168,41 @@ if ([ -f "$FILE_PYPI" ] && ! [ -f "$FILE_CONDA" ]); then
 
   # 1. nothing to do: virtualenv is already installed
 
+  # (pip reuses the wheels of its cache but copies the packages in every environment)
+  function pip_install () {
+    cd $HOME/run/ && virtualenv ".$env_name"
+    $HOME/run/.$env_name/bin/pip install -r "$FILE_PYPI"
+  }
+
+  # uv: one package cache for all the environments, the packages are hardlinked from it
+  function uv_install () {
+    export UV_CACHE_DIR="$HOME/.cache/uv"
+    export UV_LINK_MODE=hardlink
+    exec 9>"$LOCK_DIR/uv-install"
+    flock 9
+    UV_EXE="$(command -v uv || ls $HOME/.local/bin/uv $HOME/.cargo/bin/uv 2>/dev/null | head -n 1)"
+    if [ -z "$UV_EXE" ]; then
+      echo "installing uv ..."
+      curl -LsSf https://astral.sh/uv/install.sh | sh
+      UV_EXE="$(ls $HOME/.local/bin/uv $HOME/.cargo/bin/uv 2>/dev/null | head -n 1)"
+    fi
+    flock -u 9
+    exec 9>&-
+    [ -n "$UV_EXE" ] || return 1
+    # --seed: env_check.py lists the packages with the venv pip
+    "$UV_EXE" venv --seed "$HOME/run/.$env_name" && "$UV_EXE" pip install --python "$HOME/run/.$env_name/bin/python" -r "$FILE_PYPI"
+  }
+
   # 2. check if we need to create the virtual environment, and activate
   if ! [ -d "$HOME/run/.$env_name" ]; then
     echo "virtual environment not found"
-    cd $HOME/run/ && virtualenv ".$env_name"
+    set_state "installing pip packages"
+    if [[ "$KATAPULT_PIP_INSTALLER" == "uv" ]]; then
+      uv_install || { rm -rf "$HOME/run/.$env_name"; pip_install; }
+    else
+      pip_install
+    fi
     source "$HOME/run/.$env_name/bin/activate"
-    $HOME/run/.$env_name/bin/pip install -r "$FILE_PYPI"
   else
     echo "virtual environment exists"
     # we activate in run.sh now
@@ -134,11 +215,27 @@ fi # FILE_PYPI
 if [ -f "$FILE_JULIA" ]; then
   echo "Installing Julia packages ..."
   #julia $FILE_JULIA
-  nice julia $FILE_JULIA
+  set_state "installing julia packages"
+  flock "$LOCK_DIR/julia" nice julia $FILE_JULIA
   echo "Julia packages installed"
 fi
 
+set_state "checking"
 cd $HOME/run/$env_name && /usr/bin/python3 $HOME/run/env_check.py
+# env_check.py writes bootstraped/failed: make sure the waiting jobs don't find a 'bootstraping' state
+if ! [[ "$(cat $HOME/run/$env_name/state 2>/dev/null)" =~ ^(bootstraped|failed)$ ]]; then
+  echo "failed" > "$HOME/run/$env_name/state"
+fi
+
+# the jobs can start: they don't wait for the upload of the packed environment
+flock -u 8
+exec 8>&-
+
+# share the environment we've just built
+if [ -f "$FILE_ARTIFACT" ] && [ -f "$HOME/run/$env_name/ready" ]; then
+  echo "uploading packed environment ..."
+  /usr/bin/python3 $HOME/run/env_artifact.py pack "$env_name"
+fi
 
 #echo "bootstraped" > "$HOME/run/$env_name/state"
 
@@ -0,0 +1,78 @@
+import json , os , sys , subprocess , shutil
+import urllib.request
+
+# Cache of packed environments (keyed by the environment name with hash)
+# usage: python3 env_artifact.py fetch|pack ENV_NAME
+# - fetch : downloads and unpacks the packed environment ('get' URL of artifact.json)
+# - pack  : packs the bootstrapped environment and uploads it ('put' URL of artifact.json)
+# all the instances use the same prefixes ($HOME/micromamba/envs/ENV_NAME or $HOME/run/.ENV_NAME)
+# so the packed environments can be unpacked as is
+
+HOME = os.environ['HOME']
+
+action , env_name = sys.argv[1] , sys.argv[2]
+env_dir       = os.path.join(HOME,'run',env_name)
+fetched_file  = os.path.join(env_dir,'artifact.fetched')
+
+with open(os.path.join(env_dir,'artifact.json'),'r') as the_file:
+    artifact = json.load(the_file)
+
+def get_prefix():
+    if os.path.isfile(os.path.join(env_dir,'environment.yml')):
+        return os.path.join(HOME,'micromamba','envs',env_name)
+    if os.path.isfile(os.path.join(env_dir,'requirements.txt')):
+        return os.path.join(HOME,'run','.'+env_name)
+    return None
+
+def fetch():
+    prefix = get_prefix()
+    if prefix is None or not artifact.get('get'):
+        return 1
+    if os.path.isdir(prefix):
+        return 0
+    parent = os.path.dirname(prefix)
+    os.makedirs(parent,exist_ok=True)
+    try:
+        with urllib.request.urlopen(artifact['get'],timeout=60) as response:
+            tar = subprocess.Popen(['tar','-xzf','-','-C',parent],stdin=subprocess.PIPE)
+            try:
+                shutil.copyfileobj(response,tar.stdin,1024*1024)
+            finally:
+                tar.stdin.close()
+            if tar.wait() != 0:
+                raise OSError("tar exited with code "+str(tar.returncode))
+    except Exception as e:
+        print("could not fetch the packed environment:",e)
+        shutil.rmtree(prefix,ignore_errors=True)
+        return 1
+    with open(fetched_file,'w') as the_file:
+        the_file.write("")
+    return 0
+
+def pack():
+    prefix = get_prefix()
+    # nothing to share (or it comes from the cache already)
+    if prefix is None or not os.path.isdir(prefix) or not artifact.get('put') or os.path.isfile(fetched_file):
+        return 0
+    packed = os.path.join(env_dir,'artifact.tar.gz')
+    try:
+        subprocess.run(['tar','-czf',packed,'-C',os.path.dirname(prefix),os.path.basename(prefix)],check=True)
+        with open(packed,'rb') as the_file:
+            request = urllib.request.Request(artifact['put'],data=the_file,method='PUT',headers={ 'Content-Length' : str(os.path.getsize(packed)) })
+            with urllib.request.urlopen(request,timeout=600) as response:
+                response.read()
+    except Exception as e:
+        print("could not upload the packed environment:",e)
+        return 1
+    finally:
+        if os.path.isfile(packed):
+            os.remove(packed)
+    return 0
+
+if action == 'fetch':
+    sys.exit(fetch())
+elif action == 'pack':
+    sys.exit(pack())
+else:
+    print("unknown action",action)
+    sys.exit(1)
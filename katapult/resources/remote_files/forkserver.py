@@ -0,0 +1,238 @@
+import os , sys , json , socket , selectors , signal , shlex , time , array , runpy , importlib , traceback , hashlib , struct
+
+# Warm worker of an environment: a python process that has imported the modules of the environment already
+# and forks a child per job (the job doesn't pay for the interpreter start, the activation and the imports)
+# usage: python3 forkserver.py serve ENV_NAME MODULES [IDLE_TIMEOUT]   (started by run.sh in the activated environment)
+#        python3 forkserver.py submit ENV_NAME PID_FILE COMMAND      (run.sh: runs the command in a forked child)
+# MODULES = comma separated list of the modules to import
+# submit exits with the exit status of the job and writes the 'forked' file next to PID_FILE once the forkserver runs it
+# (no 'forked' file: not handled, no forkserver or not a python script - any exit status can be the one of the job)
+# the pid of the child is appended to PID_FILE like run.sh does (the 'pid' , 'state' and uid contract of state.sh is kept:
+# run.sh waits for submit and writes the state of the job as usual)
+# the child gets the stdout/stderr of submit (run.log/error.log) , its working directory and its environment
+# (except the variables of the activation of the environment)
+# the forkserver exits after IDLE_TIMEOUT seconds without jobs
+
+NOT_HANDLED  = 200 # (exit status when the job doesn't run: the 'forked' file tells it apart from the status of a job)
+FORKED_FILE  = 'forked'
+IDLE_TIMEOUT = 600
+POLL_PERIOD  = 0.2
+SHELL_CHARS  = set('|&;<>()$`\\"\'*?[]#~{}!')
+# (the variables set by the activation of the environment are the ones of the forkserver)
+ACTIVATION_VARS     = [ 'PATH' , 'VIRTUAL_ENV' , 'PYTHONHOME' , 'PYTHONPATH' , 'LD_LIBRARY_PATH' ]
+ACTIVATION_PREFIXES = ( 'CONDA_' , 'MAMBA_' , '_CE_' )
+
+# abstract unix socket: no file to clean up, released when the forkserver exits
+# (no file permissions either: the forkserver checks the user of the peer)
+def get_address(env_name):
+    return '\0katapult-warm-' + hashlib.sha1( ( os.environ['HOME'] + ':' + env_name ).encode() ).hexdigest()
+
+# [ script , args ... ] of a 'python3 script.py args' command (None if the command needs a shell)
+def get_script_argv(command):
+    try:
+        argv = shlex.split(command)
+    except ValueError:
+        return None
+    if len(argv) < 2 or os.path.basename(argv[0]) not in ( 'python' , 'python3' ) or not argv[1].endswith('.py'):
+        return None
+    if any( c in SHELL_CHARS for c in command ):
+        return None
+    return argv[1:]
+
+# uid of the process at the other end of the connection
+def get_peer_uid(conn):
+    pid , uid , gid = struct.unpack('3i',conn.getsockopt(socket.SOL_SOCKET,socket.SO_PEERCRED,struct.calcsize('3i')))
+    return uid
+
+def exit_code(status):
+    if os.WIFSIGNALED(status):
+        return 128 + os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+def run_child(request,fds):
+    code = 1
+    try:
+        signal.signal(signal.SIGTERM,signal.SIG_DFL)
+        signal.signal(signal.SIGINT,signal.SIG_DFL)
+        devnull = os.open(os.devnull,os.O_RDONLY)
+        os.dup2(devnull,0)
+        os.dup2(fds[0],1)
+        os.dup2(fds[1],2)
+        for fd in fds + [ devnull ]:
+            os.close(fd)
+        env = dict(os.environ)
+        for key , value in request['env'].items():
+            if key not in ACTIVATION_VARS and not key.startswith(ACTIVATION_PREFIXES):
+                env[key] = value
+        os.environ.clear()
+        os.environ.update(env)
+        os.chdir(request['cwd'])
+        script   = request['argv'][0]
+        sys.argv = list(request['argv'])
+        sys.path[0] = os.path.dirname(os.path.abspath(script))
+        code = 0
+        try:
+            runpy.run_path(script,run_name='__main__')
+        except SystemExit as e:
+            if e.code is None:
+                code = 0
+            elif isinstance(e.code,int):
+                code = e.code
+            else:
+                print(e.code,file=sys.stderr)
+                code = 1
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(code)
+
+# receives the request (the stdout/stderr descriptors come with it) and forks the child
+def spawn(conn,listener,selector):
+    conn.settimeout(5)
+    fds  = array.array('i')
+    data , ancdata , flags , addr = conn.recvmsg(65536,socket.CMSG_SPACE(2*fds.itemsize))
+    for level , kind , cmsg_data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(cmsg_data[:len(cmsg_data)-(len(cmsg_data)%fds.itemsize)])
+    fds = list(fds)
+    try:
+        while not data.endswith(b'\n'):
+            chunk = conn.recv(65536)
+            if not chunk:
+                raise ConnectionError('incomplete request')
+            data += chunk
+        request = json.loads(data.decode())
+        if len(fds) != 2:
+            raise ValueError('the request has no output descriptors')
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            selector.close()
+            listener.close()
+            conn.close()
+            run_child(request,fds)
+    finally:
+        for fd in fds:
+            os.close(fd)
+    return pid
+
+def serve(env_name,modules,timeout):
+    listener = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    try:
+        # (before the imports: the other jobs don't start another forkserver meanwhile)
+        listener.bind(get_address(env_name))
+    except OSError:
+        print('the forkserver of',env_name,'is running already')
+        return
+    os.chdir(os.environ['HOME'])
+    for name in modules:
+        try:
+            importlib.import_module(name)
+        except Exception:
+            print('could not import',name)
+            traceback.print_exc()
+    listener.listen(64)
+    print('forkserver of',env_name,'ready',flush=True)
+
+    selector = selectors.DefaultSelector()
+    selector.register(listener,selectors.EVENT_READ)
+    children = dict() # pid -> connection of submit
+    last     = time.time()
+    while True:
+        for key , events in selector.select(timeout=POLL_PERIOD):
+            conn , addr = listener.accept()
+            if get_peer_uid(conn) != os.getuid():
+                print('rejected a job of another user',flush=True)
+                conn.close()
+                continue
+            try:
+                pid = spawn(conn,listener,selector)
+            except (OSError,ValueError) as e:
+                print('could not start the job',e,flush=True)
+                conn.close()
+                continue
+            children[pid] = conn
+            try:
+                conn.sendall( ( 'pid ' + str(pid) + '\n' ).encode() )
+            except OSError:
+                pass
+            last = time.time()
+        while children:
+            pid , status = os.waitpid(-1,os.WNOHANG)
+            if pid == 0:
+                break
+            conn = children.pop(pid,None)
+            if conn is not None:
+                try:
+                    conn.sendall( ( 'exit ' + str(exit_code(status)) + '\n' ).encode() )
+                except OSError:
+                    pass
+                conn.close()
+            last = time.time()
+        if not children and time.time() - last > timeout:
+            break
+
+def submit(env_name,pid_file,command):
+    argv = get_script_argv(command)
+    if argv is None:
+        return NOT_HANDLED
+    sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    try:
+        sock.connect(get_address(env_name))
+    except OSError:
+        return NOT_HANDLED
+    request = ( json.dumps( { 'argv' : argv , 'cwd' : os.getcwd() , 'env' : dict(os.environ) } ) + '\n' ).encode()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    try:
+        sent = sock.sendmsg([request],[(socket.SOL_SOCKET,socket.SCM_RIGHTS,array.array('i',[1,2]))])
+        sock.sendall(request[sent:])
+    except OSError:
+        return NOT_HANDLED
+    reader = sock.makefile('rb')
+    line   = reader.readline().decode().split()
+    if len(line) != 2 or line[0] != 'pid':
+        return NOT_HANDLED
+    pid = int(line[1])
+    with open(pid_file,'a') as the_file:
+        the_file.write(',' + str(pid) + '\n')
+    with open(os.path.join(os.path.dirname(os.path.abspath(pid_file)),FORKED_FILE),'w') as the_file:
+        the_file.write(str(pid))
+
+    # kill.sh and spot_watch.py signal the job through submit (or directly with the pid)
+    def forward(signum,frame):
+        try:
+            os.kill(pid,signum)
+        except OSError:
+            pass
+    for signum in ( signal.SIGTERM , signal.SIGINT , signal.SIGHUP ):
+        signal.signal(signum,forward)
+
+    line = reader.readline().decode().split()
+    if len(line) == 2 and line[0] == 'exit':
+        return int(line[1])
+    # the forkserver is gone: wait for the job (its exit status is lost)
+    while True:
+        try:
+            os.kill(pid,0)
+        except OSError:
+            break
+        time.sleep(POLL_PERIOD)
+    print('the forkserver has exited before the job',file=sys.stderr)
+    return 1
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 4 and sys.argv[1] == 'serve':
+        modules = [ name for name in sys.argv[3].split(',') if name ]
+        serve( sys.argv[2] , modules , float(sys.argv[4]) if len(sys.argv) > 4 else IDLE_TIMEOUT )
+    elif len(sys.argv) >= 5 and sys.argv[1] == 'submit':
+        sys.exit( submit( sys.argv[2] , sys.argv[3] , sys.argv[4] ) )
+    else:
+        print(sys.argv[0],'serve ENV_NAME MODULES [IDLE_TIMEOUT] | submit ENV_NAME PID_FILE COMMAND')
+        sys.exit(NOT_HANDLED)
@@ -0,0 +1,81 @@
+import os , sys , signal , time , threading , shutil
+from http.server import ThreadingHTTPServer , BaseHTTPRequestHandler
+from urllib.parse import unquote
+
+# Serves the files of this instance to the other instances (peer-to-peer fan-out of the shared inputs)
+# usage: python3 p2p_serve.py <address> <port> <token> <root_dir> <idle_timeout>
+# the files are served at http://<address>:<port>/<token>/<absolute path> (only the files inside root_dir)
+# the command returns once the server is listening (it then runs in the background)
+
+address , port , token , root_dir , idle_timeout = sys.argv[1] , int(sys.argv[2]) , sys.argv[3] , os.path.realpath(os.path.expanduser(sys.argv[4])) , float(sys.argv[5])
+pid_file = os.path.join( os.path.dirname(os.path.abspath(__file__)) , 'p2p_serve.pid' )
+last_request = time.time()
+
+class PeerHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        global last_request
+        last_request = time.time()
+        prefix = '/' + token + '/'
+        if not self.path.startswith(prefix):
+            self.send_error(403)
+            return
+        path = os.path.realpath( '/' + unquote(self.path[len(prefix):]) )
+        if not path.startswith(root_dir + os.sep) or not os.path.isfile(path):
+            self.send_error(404)
+            return
+        with open(path,'rb') as the_file:
+            self.send_response(200)
+            self.send_header('Content-Type','application/octet-stream')
+            self.send_header('Content-Length',str(os.path.getsize(path)))
+            self.end_headers()
+            shutil.copyfileobj(the_file,self.wfile,1024*1024)
+        last_request = time.time()
+
+    def log_message(self,format,*args):
+        pass
+
+# stop the server of a previous deploy (it may have another token)
+# (only if the pid is still a p2p_serve.py process: the pid may have been reused since)
+try:
+    with open(pid_file,'r') as the_file:
+        previous = int(the_file.read().strip())
+    with open('/proc/{0}/cmdline'.format(previous),'rb') as the_file:
+        cmdline = the_file.read()
+    if b'p2p_serve.py' in cmdline:
+        os.kill(previous,signal.SIGTERM)
+        time.sleep(0.2)
+except (OSError,ValueError):
+    pass
+
+server = None
+for attempt in range(10):
+    try:
+        server = ThreadingHTTPServer((address,port),PeerHandler)
+        break
+    except OSError as e:
+        error = e
+        time.sleep(0.5)
+if server is None:
+    print(error,file=sys.stderr)
+    sys.exit(1)
+
+pid = os.fork()
+if pid > 0:
+    with open(pid_file,'w') as the_file:
+        the_file.write(str(pid))
+    print('ok')
+    sys.exit(0)
+
+os.setsid()
+devnull = os.open(os.devnull,os.O_RDWR)
+for fd in ( 0 , 1 , 2 ):
+    os.dup2(devnull,fd)
+
+def watchdog():
+    while time.time() - last_request < idle_timeout:
+        time.sleep(5)
+    server.shutdown()
+
+threading.Thread(target=watchdog,daemon=True).start()
+server.serve_forever()
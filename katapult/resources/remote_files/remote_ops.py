@@ -0,0 +1,155 @@
+import json , os , sys , stat , glob , shutil , hashlib
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+# Batched remote operations
+# reads a JSON list of operations on stdin and prints a JSON list of results (same order)
+# [ { "op" : "stat" , "path" : "..." } , { "op" : "mkdir" , "path" : "..." } , ... ]
+# ops: stat , mkdir , rm , chmod , symlink , write , read , copy , hash , fetch
+
+def expand(path):
+    return os.path.expanduser(path)
+
+def paths_of(op):
+    path = expand(op['path'])
+    if op.get('glob'):
+        return glob.glob(path)
+    return [ path ]
+
+def op_stat(op):
+    path = expand(op['path'])
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return { 'exists' : False }
+    if stat.S_ISDIR(st.st_mode):
+        kind = 'dir'
+    elif stat.S_ISREG(st.st_mode):
+        kind = 'file'
+    else:
+        kind = 'other'
+    return { 'exists' : True , 'type' : kind , 'size' : st.st_size , 'mtime' : st.st_mtime }
+
+def op_mkdir(op):
+    os.makedirs(expand(op['path']),exist_ok=True)
+    return { }
+
+def op_rm(op):
+    for path in paths_of(op):
+        if os.path.isdir(path) and not os.path.islink(path):
+            if op.get('recursive'):
+                shutil.rmtree(path,ignore_errors=True)
+            else:
+                os.rmdir(path)
+        else:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+    return { }
+
+def op_chmod(op):
+    mode = str(op.get('mode','+x'))
+    for path in paths_of(op):
+        if mode == '+x':
+            st = os.stat(path)
+            os.chmod(path, st.st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+        else:
+            os.chmod(path, int(mode,8))
+    return { }
+
+def op_symlink(op):
+    src = expand(op['src'])
+    dst = expand(op['path'])
+    parent = os.path.dirname(dst)
+    if parent:
+        os.makedirs(parent,exist_ok=True)
+    if os.path.lexists(dst):
+        if not op.get('force',True):
+            return { 'skipped' : True }
+        os.remove(dst)
+    os.symlink(src,dst)
+    return { }
+
+def op_write(op):
+    path = expand(op['path'])
+    parent = os.path.dirname(path)
+    if parent:
+        os.makedirs(parent,exist_ok=True)
+    with open(path,'w') as the_file:
+        the_file.write(op.get('content',''))
+    return { }
+
+def op_read(op):
+    path = expand(op['path'])
+    try:
+        with open(path,'r') as the_file:
+            return { 'exists' : True , 'content' : the_file.read() }
+    except FileNotFoundError:
+        return { 'exists' : False }
+
+def op_copy(op):
+    src = expand(op['src'])
+    dst = expand(op['path'])
+    parent = os.path.dirname(dst)
+    if parent:
+        os.makedirs(parent,exist_ok=True)
+    shutil.copyfile(src,dst)
+    return { }
+
+def op_hash(op):
+    sha = hashlib.sha256()
+    with open(expand(op['path']),'rb') as the_file:
+        while True:
+            block = the_file.read(1024*1024)
+            if not block:
+                break
+            sha.update(block)
+    return { 'hash' : sha.hexdigest() }
+
+# downloads items = [ { "url" : "..." , "path" : "..." } ] in parallel
+# returns one error (or None) per item
+def op_fetch(op):
+    def fetch(item):
+        path = expand(item['path'])
+        parent = os.path.dirname(path)
+        part_path = path + '.part'
+        try:
+            if parent:
+                os.makedirs(parent,exist_ok=True)
+            with urllib.request.urlopen(item['url'],timeout=op.get('timeout',60)) as response:
+                with open(part_path,'wb') as the_file:
+                    shutil.copyfileobj(response,the_file,1024*1024)
+            os.replace(part_path,path)
+            return None
+        except Exception as e:
+            return str(e)
+    with ThreadPoolExecutor(max_workers=max(1,int(op.get('parallel',8)))) as executor:
+        errors = list(executor.map(fetch,op.get('items',[])))
+    return { 'errors' : errors }
+
+OPERATIONS = {
+    'stat'    : op_stat ,
+    'mkdir'   : op_mkdir ,
+    'rm'      : op_rm ,
+    'chmod'   : op_chmod ,
+    'symlink' : op_symlink ,
+    'write'   : op_write ,
+    'read'    : op_read ,
+    'copy'    : op_copy ,
+    'hash'    : op_hash ,
+    'fetch'   : op_fetch
+}
+
+ops     = json.loads(sys.stdin.read() or '[]')
+results = []
+
+for op in ops:
+    try:
+        result = OPERATIONS[op['op']](op)
+        result['ok'] = True
+    except Exception as e:
+        result = { 'ok' : False , 'error' : str(e) }
+    results.append(result)
+
+print(json.dumps(results))
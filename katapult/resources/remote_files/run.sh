@@ -31,6 +31,16 @@ function check_cancelled () {
 
 check_cancelled
 
+function set_final_state () {
+  if [[ -n "$KATAPULT_ARRAY" ]] && [[ $1 == 0 || $1 == 90 ]]; then
+    : # the state has been written by arrayrun.py (90: some tasks have failed)
+  elif [[ $1 == 0 ]]; then
+    echo "done(completed normally)" > $run_path/state
+  else
+    echo "aborted(exit status = $1)" > $run_path/state
+  fi
+}
+
 
 # TODO: check if existing PID and PID running ... and throw warning, exit or do something ?
 # we print the mother PID in the PID file (it used to be the one from microrun)
@@ -46,41 +56,66 @@ do
   rm -f $output_file
 done
 
-waittime=0
-while [[ $(< $env_path/state) != "bootstraped" ]] || ! [ -f $env_path/state ]
-do
-  check_cancelled
-  if [[ $(< $env_path/state) == "failed" ]]; then
-    echo "Environment bootstraping has FAILED"
-    echo 'aborted(environment has failed)' > $run_path/state # used to check the state of a process
-    exit 97
-  fi
-  if [[ $(ps aux | grep "bootstrap.sh" | grep "$env_name" | grep -v 'grep') ]]; then
-    echo "Waiting on environment to be bootstraped"
-    sleep 15 # sleep 15 seconds
-    ((waittime=waittime+15))
-    if [ $waittime -gt 3600 ]; then
+# bootstrap.sh holds $env_path/bootstrap.lock until the environment has been checked:
+# we block on the lock (instead of polling) and read the state of the environment when it is released
+# (the wait wakes up every 30 seconds to check if the job has been cancelled)
+if [[ "$(cat $env_path/state 2>/dev/null)" != "bootstraped" ]]; then
+  echo "Waiting on environment to be bootstraped"
+  waittime=0
+  until flock -s -w 30 "$env_path/bootstrap.lock" true
+  do
+    check_cancelled
+    ((waittime=waittime+30))
+    if [ $waittime -ge 3600 ]; then
       echo "Waited too long for bootstraped environment\nexiting"
       echo 'aborted(waited too long for environment)' > $run_path/state
       exit 99
     fi
-  else
+  done
+  check_cancelled
+  env_state="$(cat $env_path/state 2>/dev/null)"
+  if [[ "$env_state" == "failed" ]]; then
+    echo "Environment bootstraping has FAILED"
+    echo 'aborted(environment has failed)' > $run_path/state # used to check the state of a process
+    exit 97
+  elif [[ "$env_state" != "bootstraped" ]]; then
     echo "Bootstraping has stopped without success, exiting"
     echo 'aborted(bootstraping has failed)' > $run_path/state
     exit 98
   fi
-done
+fi
 echo "Environment is bootstraped"
 
-while [[ $(ps aux | grep "batch_run" | grep -v "batch_run-$batch_uid" | grep -v 'grep') ]]
-do
-  echo "Waiting on previous batch to finish"
-  echo 'wait(waiting on previous batch to finish)' > $run_path/state
-  sleep 15
-done
+# isolated batches (or jobs run one after another) wait for the other batches to be over
+# otherwise slotrun.py has already admitted the job on free CPUs
+if [[ "$KATAPULT_BATCH_ISOLATION" == "1" ]]; then
+  while [[ $(ps aux | grep "batch_run" | grep -v "batch_run-$batch_uid" | grep -v 'grep') ]]
+  do
+    echo "Waiting on previous batch to finish"
+    echo 'wait(waiting on previous batch to finish)' > $run_path/state
+    sleep 15
+  done
+fi
 
 echo 'idle(about to start)' > $run_path/state # used to check the state of a process
 
+# warm worker ('warm_modules' of the environment): the forkserver of the environment forks the python script
+# (no activation, interpreter start and imports) - forkserver.py appends the child pid to the pid file
+# no 'forked' file: no forkserver yet (or not a python script) >> the job runs normally and starts the forkserver
+# (the exit status alone can't tell: it is the one of the job when the forkserver runs it)
+if [[ -v KATAPULT_WARM ]]; then
+  check_cancelled
+  cd $run_path
+  echo 'running(normally)' > $run_path/state
+  rm -f $run_path/forked
+  python3 $env_path/forkserver.py submit "$env_name" "$pid_file" "$thecommand" 2>error.log >run.log
+  exit_status=$?
+  if [ -f $run_path/forked ]; then
+    set_final_state $exit_status
+    exit
+  fi
+fi
+
 FILE_CONDA="$HOME/run/$env_name/environment.yml"
 FILE_PYPI="$HOME/run/$env_name/requirements.txt"
 
@@ -97,6 +132,11 @@ if ([ -f "$FILE_PYPI" ] && ! [ -f "$FILE_CONDA" ]); then
     source "$HOME/run/.$env_name/bin/activate"
 fi
 
+# the forkserver of the environment runs the next jobs (only one keeps running, it exits once idle)
+if [[ -v KATAPULT_WARM ]]; then
+  setsid python3 $env_path/forkserver.py serve "$env_name" "$KATAPULT_WARM" "${KATAPULT_WARM_TIMEOUT:-600}" </dev/null >>"$env_path/forkserver.log" 2>&1 &
+fi
+
 #exec nohup $HOME/run/$env_name/microrun.sh "$thecommand" "$run_path"
 #exit
 
@@ -118,15 +158,17 @@ echo 'running(normally)' > $run_path/state
 # CHANGED FOR INLINE COMMAND:
 #$thecommand 2>&1 >run.log & child_pid=$!
 #$thecommand 2>error.log >run.log & child_pid=$!
-bash -c "$thecommand" 2>error.log >run.log & child_pid=$!
+if [[ -n "$KATAPULT_ARRAY" ]]; then
+  # array job: arrayrun.py runs the command once per task index (KATAPULT_ARRAY=START:STOP:PARALLEL)
+  # and keeps the state of the tasks (tasks.state) and of the process
+  python3 $HOME/run/arrayrun.py "$KATAPULT_ARRAY" "$thecommand" 2>error.log >run.log & child_pid=$!
+else
+  bash -c "$thecommand" 2>error.log >run.log & child_pid=$!
+fi
 echo ",$child_pid" >> $pid_file
 wait $child_pid
 exit_status=$?
-if [[ $exit_status == 0 ]]; then
-  echo "done(completed normally)" > $run_path/state
-else
-  echo "aborted(exit status = $exit_status)" > $run_path/state
-fi
+set_final_state $exit_status
 
 # pgrep -P PID >>> Get the subprocesses
 
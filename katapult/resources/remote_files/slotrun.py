@@ -0,0 +1,133 @@
+import os , sys , subprocess , json , time , fcntl
+
+# Runs the jobs of a batch concurrently on the CPU slots of the instance
+# usage: python3 slotrun.py SLOTS [PRIORITY] < jobs
+# one job per line: "CPUS COMMAND" (CPUS = cpus_req of the job)
+# SLOTS = 0 : use the number of CPUs of the instance
+# a job starts as soon as enough slots are free (first fit in the order of the batch)
+# the jobs that have not started yet keep their 'queue' state (run.sh updates it once started)
+#
+# the slots are shared by all the batches running on the instance (other runs, jobs added to the session ...)
+# through a ledger of the CPUs in use: a batch doesn't wait for the others to be over, only for free CPUs
+# when CPUs are freed, the waiting batch with the highest PRIORITY (then the oldest) gets them first
+
+HOME        = os.environ['HOME']
+LOCK_DIR    = os.path.join(HOME,'run','.locks')
+LEDGER_FILE = os.path.join(LOCK_DIR,'slots.json')
+LEDGER_LOCK = os.path.join(LOCK_DIR,'slots.lock')
+POLL_PERIOD = 0.25
+
+slots    = int(sys.argv[1]) if len(sys.argv) > 1 else 0
+priority = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+if slots <= 0:
+    slots = os.cpu_count() or 1
+
+queue = []
+for line in sys.stdin.read().splitlines():
+    if not line.strip():
+        continue
+    cpus , command = line.split(' ',1)
+    # a job can't use more than the instance (it would never start)
+    queue.append( ( min(max(1,int(cpus)),slots) , command ) )
+
+me      = str(os.getpid())
+since   = time.time()
+running = dict() # pid -> ( process , cpus , claim key )
+counter = 0
+
+def is_alive(pid):
+    try:
+        os.kill(int(pid),0)
+        return True
+    except (OSError,ValueError):
+        return False
+
+# ledger = { 'claims' : { key : { 'owner' : pid , 'cpus' : n } } , 'waiting' : { pid : { 'priority' , 'since' , 'cpus' } } }
+def update_ledger(func):
+    os.makedirs(LOCK_DIR,exist_ok=True)
+    with open(LEDGER_LOCK,'w') as lock_file:
+        fcntl.flock(lock_file,fcntl.LOCK_EX)
+        try:
+            with open(LEDGER_FILE,'r') as the_file:
+                ledger = json.load(the_file)
+        except (OSError,ValueError):
+            ledger = dict()
+        claims  = ledger.setdefault('claims',dict())
+        waiting = ledger.setdefault('waiting',dict())
+        # forget the batches that are gone (killed, instance rebooted ...)
+        for key in [ k for k , v in claims.items() if not is_alive(v['owner']) ]:
+            del claims[key]
+        for key in [ k for k in waiting if not is_alive(k) ]:
+            del waiting[key]
+        result = func(ledger)
+        with open(LEDGER_FILE+'.tmp','w') as the_file:
+            json.dump(ledger,the_file)
+        os.replace(LEDGER_FILE+'.tmp',LEDGER_FILE)
+        return result
+
+def admit(ledger):
+    global counter
+    claims  = ledger['claims']
+    waiting = ledger['waiting']
+    free    = slots - sum( v['cpus'] for v in claims.values() )
+    started = []
+    for job in list(queue):
+        cpus , command = job
+        if cpus > free:
+            continue
+        # another batch should get those CPUs first
+        if any( key != me and v['cpus'] <= free and ( v['priority'] > priority or ( v['priority'] == priority and v['since'] < since ) ) for key , v in waiting.items() ):
+            break
+        counter += 1
+        key = me + ':' + str(counter)
+        claims[key] = { 'owner' : me , 'cpus' : cpus }
+        free -= cpus
+        queue.remove(job)
+        started.append( ( cpus , command , key ) )
+    if queue:
+        waiting[me] = { 'priority' : priority , 'since' : since , 'cpus' : min( cpus for cpus , command in queue ) }
+    else:
+        waiting.pop(me,None)
+    return started
+
+def release(keys):
+    def func(ledger):
+        for key in keys:
+            ledger['claims'].pop(key,None)
+    update_ledger(func)
+
+# reaps the jobs that are over (blocking: waits for one job at least) and frees their CPUs
+def reap(block):
+    finished = []
+    while running:
+        try:
+            pid , status = os.waitpid(-1, 0 if block and not finished else os.WNOHANG)
+        except ChildProcessError:
+            running.clear()
+            break
+        if pid == 0:
+            break
+        entry = running.pop(pid,None)
+        if entry is not None:
+            entry[0].returncode = status # reaped already (run.sh records the state of the job)
+            finished.append(entry[2])
+    if finished:
+        release(finished)
+
+try:
+    while queue or running:
+        reap(False)
+        if queue:
+            for cpus , command , key in update_ledger(admit):
+                process = subprocess.Popen(command,shell=True,executable='/bin/bash')
+                running[process.pid] = ( process , cpus , key )
+            # the CPUs may also be freed by the other batches: check regularly
+            time.sleep(POLL_PERIOD)
+        else:
+            reap(True)
+finally:
+    def func(ledger):
+        for key in [ k for k , v in ledger['claims'].items() if v['owner'] == me ]:
+            del ledger['claims'][key]
+        ledger['waiting'].pop(me,None)
+    update_ledger(func)
@@ -0,0 +1,153 @@
+import os , sys , json , time , signal , subprocess , glob , re
+import urllib.request , urllib.error
+
+# Watches the spot interruption notice of the instance (2 minutes before the instance is reclaimed)
+# usage: python3 spot_watch.py METADATA_URL PERIOD GRACE [foreground]
+# on a notice:
+# - the queued jobs don't start (slotrun.py and the batches are stopped)
+# - the running jobs run their checkpoint hook ('command' of checkpoint.json in the run directory)
+#   then get SIGTERM (SIGKILL after GRACE seconds)
+# - the state of the jobs becomes 'aborted(spot interruption)' so the client fetches the checkpoint files
+#   and runs the jobs again on another instance
+# the notice is written in $HOME/run/interrupted
+# the command returns once the watcher runs in the background (unless 'foreground')
+
+HOME         = os.environ['HOME']
+RUN_DIR      = os.path.join(HOME,'run')
+NOTICE_FILE  = os.path.join(RUN_DIR,'interrupted')
+PID_FILE     = os.path.join( os.path.dirname(os.path.abspath(__file__)) , 'spot_watch.pid' )
+ACTIVE_STATE = re.compile(r'^(queue|wait|idle|running)')
+
+metadata_url = sys.argv[1].rstrip('/') if len(sys.argv) > 1 else 'http://169.254.169.254'
+period       = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+grace        = float(sys.argv[3]) if len(sys.argv) > 3 else 90
+foreground   = len(sys.argv) > 4 and sys.argv[4] == 'foreground'
+
+def get_token():
+    # IMDSv2 (None: IMDSv1 only)
+    request = urllib.request.Request(metadata_url+'/latest/api/token',method='PUT',headers={ 'X-aws-ec2-metadata-token-ttl-seconds' : '300' })
+    try:
+        with urllib.request.urlopen(request,timeout=2) as response:
+            return response.read().decode()
+    except (OSError,urllib.error.URLError):
+        return None
+
+def get_notice():
+    token   = get_token()
+    headers = { 'X-aws-ec2-metadata-token' : token } if token else {}
+    request = urllib.request.Request(metadata_url+'/latest/meta-data/spot/instance-action',headers=headers)
+    try:
+        with urllib.request.urlopen(request,timeout=2) as response:
+            return json.loads(response.read().decode() or '{}')
+    except (OSError,ValueError,urllib.error.URLError):
+        # 404 until there is a notice
+        return None
+
+def read(path):
+    try:
+        with open(path,'r') as the_file:
+            return the_file.read().strip()
+    except OSError:
+        return None
+
+def is_alive(pid):
+    try:
+        os.kill(int(pid),0)
+        return True
+    except (OSError,ValueError,TypeError):
+        return False
+
+def is_watcher(pid):
+    # the pid may have been reused since the pid file was written
+    try:
+        with open('/proc/{0}/cmdline'.format(int(pid)),'rb') as the_file:
+            return b'spot_watch.py' in the_file.read()
+    except (OSError,ValueError,TypeError):
+        return False
+
+def kill(pid,sig):
+    try:
+        subprocess.run(['pkill','-'+str(int(sig)),'-P',str(pid)],stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL)
+        os.kill(int(pid),sig)
+    except (OSError,ValueError,TypeError):
+        pass
+
+def handle_notice(notice):
+    with open(NOTICE_FILE,'w') as the_file:
+        the_file.write(json.dumps(notice))
+
+    # nothing else starts on this instance
+    subprocess.run(['pkill','-KILL','-f','slotrun.py'],stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL)
+    subprocess.run(['pkill','-KILL','-f','batch_run-'],stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL)
+
+    # the jobs that have not completed ($HOME/run/ENV/JOB_HASH/UID/state)
+    jobs = []
+    for state_file in glob.glob(os.path.join(RUN_DIR,'*','*','*','state')):
+        state = read(state_file)
+        if state is None or not ACTIVE_STATE.match(state):
+            continue
+        run_path = os.path.dirname(state_file)
+        pids     = ( read(os.path.join(run_path,'pid')) or '' ).replace('\n','').split(',')
+        jobs.append( { 'path' : run_path , 'pid' : pids[1] if len(pids) > 1 else None , 'child' : pids[2] if len(pids) > 2 else None } )
+
+    # checkpoint hooks (in parallel, half the grace period at most)
+    hooks = []
+    for job in jobs:
+        checkpoint = read(os.path.join(job['path'],'checkpoint.json'))
+        try:
+            command = json.loads(checkpoint).get('command') if checkpoint else None
+        except ValueError:
+            command = None
+        if command and is_alive(job['child']):
+            env = dict(os.environ)
+            env['KATAPULT_INTERRUPTION'] = '1'
+            env['KATAPULT_JOB_PID']      = str(job['child'])
+            hooks.append( subprocess.Popen(command,shell=True,executable='/bin/bash',cwd=job['path'],env=env) )
+    deadline = time.time() + grace / 2
+    for hook in hooks:
+        try:
+            hook.wait(timeout=max(0,deadline-time.time()))
+        except subprocess.TimeoutExpired:
+            hook.kill()
+
+    for job in jobs:
+        if is_alive(job['child']):
+            kill(job['child'],signal.SIGTERM)
+    deadline = time.time() + grace / 2
+    while time.time() < deadline and any( is_alive(job['child']) or is_alive(job['pid']) for job in jobs ):
+        time.sleep(0.2)
+    for job in jobs:
+        for pid in ( job['child'] , job['pid'] ):
+            if is_alive(pid):
+                kill(pid,signal.SIGKILL)
+
+    # (after run.sh has written its own state)
+    for job in jobs:
+        with open(os.path.join(job['path'],'state'),'w') as the_file:
+            the_file.write('aborted(spot interruption)\n')
+
+if not foreground:
+    # stop the watcher of a previous deploy
+    previous = read(PID_FILE)
+    if is_watcher(previous):
+        try:
+            os.kill(int(previous),signal.SIGTERM)
+        except OSError:
+            pass
+    pid = os.fork()
+    if pid > 0:
+        with open(PID_FILE,'w') as the_file:
+            the_file.write(str(pid))
+        print('ok')
+        sys.exit(0)
+    os.setsid()
+    devnull = os.open(os.devnull,os.O_RDWR)
+    for fd in ( 0 , 1 , 2 ):
+        os.dup2(devnull,fd)
+
+while True:
+    notice = get_notice()
+    if notice:
+        handle_notice(notice)
+        break
+    time.sleep(period)
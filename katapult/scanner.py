@@ -0,0 +1,152 @@
+import ast
+import json
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor , ThreadPoolExecutor
+
+IMPORT_CACHE_FILE   = 'state.imports.json'
+SCAN_PARALLEL_MIN   = 32   # below this number of (uncached) files, we scan in the current process
+SCAN_WORKERS        = None # default number of processes of ProcessPoolExecutor
+
+_python_import_re = re.compile(r"\s*(from\s+([^\s]+)\s+import\s+([^\s]+)|import\s+([^\s]+).*)")
+_julia_package_re = re.compile(r"(Pkg\.add\(\"([^\^\")]+)\"\)|using\s+([^\s]+))")
+
+_stdlib_names = None
+
+# set of the top-level names of the standard library
+def get_stdlib_names():
+    global _stdlib_names
+    if _stdlib_names is None:
+        from katapult.isort.stdlibs.py39 import stdlib
+        names = set(stdlib)
+        names.update(sys.builtin_module_names)
+        names.update(getattr(sys,'stdlib_module_names',()))
+        names.update([ '.code' , '.pytest' ])
+        _stdlib_names = names
+    return _stdlib_names
+
+def _top_level(name):
+    if not name or name.startswith('.') or name.startswith('_'):
+        return None
+    return name.split('.')[0] or None
+
+# fallback for files that do not parse (python2 scripts, templates ...)
+def _scan_python_regex(content):
+    result = []
+    for pkg in _python_import_re.findall(content):
+        if pkg[3]:
+            pkg_name = pkg[3]
+        elif pkg[1] and pkg[2]:
+            pkg_name = pkg[1]
+        else:
+            continue
+        pkg_name = _top_level(pkg_name)
+        if pkg_name and pkg_name not in result:
+            result.append(pkg_name)
+    return result
+
+def scan_python_imports(content):
+    try:
+        tree = ast.parse(content)
+    except (SyntaxError,ValueError):
+        return _scan_python_regex(content)
+    result = []
+    for node in ast.walk(tree):
+        if isinstance(node,ast.Import):
+            names = [ alias.name for alias in node.names ]
+        elif isinstance(node,ast.ImportFrom) and not node.level:
+            names = [ node.module ]
+        else:
+            continue
+        for name in names:
+            pkg_name = _top_level(name)
+            if pkg_name and pkg_name not in result:
+                result.append(pkg_name)
+    return result
+
+def scan_julia_packages(content):
+    result = []
+    for pkg in _julia_package_re.findall(content):
+        pkg_name = pkg[2] or pkg[1]
+        if pkg_name and pkg_name not in result:
+            result.append(pkg_name)
+    return result
+
+# returns the packages used by the file (None if it cannot be read)
+def scan_file(path):
+    try:
+        with open(path,'r') as the_file:
+            content = the_file.read()
+    except (OSError,UnicodeDecodeError):
+        return None
+    if path.lower().endswith('.jl'):
+        return scan_julia_packages(content)
+    return scan_python_imports(content)
+
+# Local cache of (size, mtime, packages) per absolute path
+# so only the modified files are parsed again
+class KatapultImportCache():
+
+    def __init__(self,cache_file=IMPORT_CACHE_FILE):
+        self._cache_file = cache_file
+        self._entries    = None
+        self._dirty      = False
+
+    def _load(self):
+        if self._entries is not None:
+            return
+        self._entries = dict()
+        try:
+            with open(self._cache_file,'r') as cache_file:
+                self._entries = json.loads(cache_file.read())
+        except (OSError,ValueError):
+            pass
+
+    # returns { path : packages } for all the files
+    def scan(self,paths,parallel_min=SCAN_PARALLEL_MIN):
+        self._load()
+        result  = dict()
+        missing = []
+        for path in paths:
+            abs_path = os.path.abspath(path)
+            try:
+                st = os.stat(abs_path)
+            except OSError:
+                result[path] = None
+                continue
+            entry = self._entries.get(abs_path)
+            if entry is not None and entry[0] == st.st_size and entry[1] == st.st_mtime:
+                result[path] = entry[2]
+            else:
+                missing.append( ( path , abs_path , st ) )
+
+        if missing:
+            to_scan = [ abs_path for _ , abs_path , _ in missing ]
+            if len(to_scan) >= parallel_min:
+                try:
+                    with ProcessPoolExecutor(max_workers=SCAN_WORKERS) as executor:
+                        scanned = list(executor.map(scan_file,to_scan,chunksize=16))
+                except (OSError,RuntimeError,NotImplementedError):
+                    # no multiprocessing here (restricted environment e.g.)
+                    with ThreadPoolExecutor() as executor:
+                        scanned = list(executor.map(scan_file,to_scan))
+            else:
+                scanned = [ scan_file(abs_path) for abs_path in to_scan ]
+            for ( path , abs_path , st ) , packages in zip(missing,scanned):
+                result[path] = packages
+                if packages is not None:
+                    self._entries[abs_path] = [ st.st_size , st.st_mtime , packages ]
+                    self._dirty = True
+
+        return result
+
+    def save(self):
+        if not self._dirty:
+            return
+        try:
+            with open(self._cache_file,'w') as cache_file:
+                cache_file.write(json.dumps(self._entries))
+            self._dirty = False
+        except OSError:
+            pass
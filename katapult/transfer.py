@@ -0,0 +1,425 @@
+import asyncio
+import asyncssh
+import os
+import time
+import tarfile
+import threading
+import hashlib
+import json
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# defaults for the upload engine
+UPLOAD_CONCURRENCY       = 8      # in-flight puts per instance (same SFTP session)
+UPLOAD_FLEET_CONCURRENCY = 32     # in-flight puts for the whole fleet
+SFTP_BLOCK_SIZE          = 16384  # asyncssh default
+SFTP_MAX_REQUESTS        = 128    # asyncssh default (parallel read/write requests per file)
+TAR_FLUSH_SIZE           = 1024 * 1024 # stream the tar to the channel every MB
+TAR_QUEUE_SIZE           = 8      # chunks of the tar stream waiting for the channel
+LARGE_FILE_THRESHOLD     = 256 * 1024 * 1024 # files above this size are transferred in chunks
+LARGE_FILE_CHUNK_SIZE    = 32 * 1024 * 1024
+LARGE_FILE_PARALLEL      = 4      # chunks in flight per file
+LARGE_FILE_CHANNELS      = 2      # SFTP channels used per file
+TRANSFER_JOURNAL_DIR     = 'state.transfers'
+STAGING_URL_EXPIRATION   = 6 * 3600 # validity (seconds) of the presigned URLs of the staged files
+STAGING_PULL_PARALLEL    = 8      # parallel downloads from the staging bucket per instance
+STAGING_PREFIX           = 'staging/'
+ENV_ARTIFACT_PREFIX      = 'envs/'  # packed environments (keyed by the environment name with hash)
+
+class KatapultTransferStats():
+
+    def __init__(self):
+        self.files    = 0
+        self.bytes    = 0
+        self.errors   = 0
+        self.skipped  = 0    # unchanged files (content manifest)
+        self.copied   = 0    # duplicated contents copied remotely (content manifest)
+        self.pulled   = 0    # files pulled by the instance from the staging bucket
+        self.peered   = 0    # files fetched from another instance (peer-to-peer fan-out)
+        self.timings  = []   # ( remote_path , size , seconds )
+        self._start   = None
+        self._end     = None
+
+    def start(self):
+        if self._start is None:
+            self._start = time.perf_counter()
+
+    def stop(self):
+        self._end = time.perf_counter()
+
+    def add(self,remote_path,size,seconds):
+        self.files += 1
+        self.bytes += size
+        self.timings.append( ( remote_path , size , seconds ) )
+
+    def merge(self,other):
+        self.files   += other.files
+        self.bytes   += other.bytes
+        self.pulled  += other.pulled
+        self.peered  += other.peered
+        self.timings += other.timings
+
+    def get_elapsed(self):
+        if self._start is None:
+            return 0
+        end = self._end if self._end is not None else time.perf_counter()
+        return end - self._start
+
+    def get_rate(self):
+        elapsed = self.get_elapsed()
+        return self.bytes / elapsed if elapsed > 0 else 0
+
+    def summary(self):
+        return {
+            'files'         : self.files ,
+            'bytes'         : self.bytes ,
+            'errors'        : self.errors ,
+            'skipped'       : self.skipped ,
+            'copied'        : self.copied ,
+            'pulled'        : self.pulled ,
+            'peered'        : self.peered ,
+            'seconds'       : round(self.get_elapsed(),3) ,
+            'bytes_per_sec' : round(self.get_rate())
+        }
+
+    def __repr__(self):
+        return "{0} files, {1} bytes in {2:.2f}s ({3:.1f} KB/s, {4} errors, {5} unchanged, {6} copied, {7} pulled, {8} from peers)".format(self.files,self.bytes,self.get_elapsed(),self.get_rate()/1024,self.errors,self.skipped,self.copied,self.pulled,self.peered)
+
+# Bounded-concurrency uploads over one SFTP session
+# - concurrency      : max in-flight puts for this session
+# - fleet_semaphore  : shared semaphore capping the in-flight puts of all the instances
+# - block_size / max_requests : asyncssh pipelining options
+class KatapultUploader():
+
+    def __init__(self,ftp_client,concurrency=UPLOAD_CONCURRENCY,fleet_semaphore=None,block_size=SFTP_BLOCK_SIZE,max_requests=SFTP_MAX_REQUESTS):
+        self._ftp_client   = ftp_client
+        self._semaphore    = asyncio.Semaphore(max(1,concurrency))
+        self._fleet_semaphore = fleet_semaphore
+        self._block_size   = block_size
+        self._max_requests = max_requests
+        self._stats        = KatapultTransferStats()
+
+    def get_stats(self):
+        return self._stats
+
+    async def _put(self,local_path,remote_path):
+        async with self._semaphore:
+            if self._fleet_semaphore is not None:
+                await self._fleet_semaphore.acquire()
+            try:
+                t0   = time.perf_counter()
+                size = os.path.getsize(local_path)
+                await self._ftp_client.put(local_path,remote_path,block_size=self._block_size,max_requests=self._max_requests)
+                self._stats.add(remote_path,size,time.perf_counter()-t0)
+            finally:
+                if self._fleet_semaphore is not None:
+                    self._fleet_semaphore.release()
+
+    # files: list of ( local_path , remote_path )
+    # returns a list of exceptions (or None) in the same order as files
+    async def upload(self,files):
+        self._stats.start()
+        results = await asyncio.gather( *[ self._put(local_path,remote_path) for local_path , remote_path in files ] , return_exceptions=True )
+        self._stats.stop()
+        self._stats.errors += len([ r for r in results if r is not None ])
+        return results
+
+# sink of the tar stream (written by the thread producing the archive)
+# the data is handed over to the event loop every TAR_FLUSH_SIZE bytes
+# at most TAR_QUEUE_SIZE chunks wait for the channel: the producer blocks meanwhile
+class _StreamSink():
+
+    def __init__(self,loop,queue,cancelled):
+        self._loop      = loop
+        self._queue     = queue
+        self._cancelled = cancelled
+        self._slots     = threading.Semaphore(TAR_QUEUE_SIZE)
+        self._chunks    = []
+        self._size      = 0
+
+    def write(self,data):
+        self._chunks.append(bytes(data))
+        self._size += len(data)
+        if self._size >= TAR_FLUSH_SIZE:
+            self._push(self._take())
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def _take(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        self._size   = 0
+        return data
+
+    def _push(self,data):
+        while not self._slots.acquire(timeout=0.1):
+            if self._cancelled.is_set():
+                raise OSError("the tar stream has been cancelled")
+        self._loop.call_soon_threadsafe(self._queue.put_nowait,data)
+
+    # (event loop) the chunk has been written to the channel
+    def release(self):
+        self._slots.release()
+
+    # sends what is left and the end of the stream (None)
+    def finish(self):
+        if self._size:
+            self._push(self._take())
+        self._loop.call_soon_threadsafe(self._queue.put_nowait,None)
+
+def get_tar_compression(compression):
+    if compression == 'zstd' and zstandard is None:
+        return 'gzip'
+    return compression
+
+# Streams a compressed tar of files = [ ( local_path , remote_path ) ] through one SSH channel into 'tar -x'
+# (generated on the fly, no temporary archive). remote_path must be absolute.
+# Raises an exception if the remote extraction fails so that the caller can fall back to SFTP.
+async def upload_tar_stream(ssh_conn,files,compression='gzip',stats=None):
+    compression = get_tar_compression(compression)
+    if compression == 'zstd':
+        command = "zstd -dc | tar -x -C / -f -"
+    elif compression == 'gzip':
+        command = "tar -xz -C / -f -"
+    else:
+        command = "tar -x -C / -f -"
+
+    if stats is None:
+        stats = KatapultTransferStats()
+    stats.start()
+
+    loop      = asyncio.get_running_loop()
+    queue     = asyncio.Queue()
+    cancelled = threading.Event()
+    sink      = _StreamSink(loop,queue,cancelled)
+
+    # (thread) reading and compressing the files would block the event loop
+    def produce():
+        try:
+            zwriter = None
+            if compression == 'zstd':
+                zwriter = zstandard.ZstdCompressor().stream_writer(sink)
+                tar = tarfile.open(fileobj=zwriter,mode='w|')
+            elif compression == 'gzip':
+                tar = tarfile.open(fileobj=sink,mode='w|gz')
+            else:
+                tar = tarfile.open(fileobj=sink,mode='w|')
+            for local_path , remote_path in files:
+                t0 = time.perf_counter()
+                tar.add(local_path,arcname=remote_path.lstrip('/'),recursive=False)
+                stats.add(remote_path,os.path.getsize(local_path),time.perf_counter()-t0)
+            tar.close()
+            if zwriter is not None:
+                zwriter.flush(zstandard.FLUSH_FRAME)
+            sink.finish()
+        except BaseException:
+            # end of the stream: the error is raised by the event loop side
+            loop.call_soon_threadsafe(queue.put_nowait,None)
+            raise
+
+    async with ssh_conn.create_process(command,encoding=None) as proc:
+        producer = loop.run_in_executor(None,produce)
+        try:
+            while True:
+                data = await queue.get()
+                if data is None:
+                    break
+                proc.stdin.write(data)
+                await proc.stdin.drain()
+                sink.release()
+            # raises if the archive could not be produced (missing file etc.)
+            await producer
+        finally:
+            if not producer.done():
+                cancelled.set()
+                await asyncio.wait([producer])
+        proc.stdin.write_eof()
+        result = await proc.wait()
+
+    stats.stop()
+
+    if result.exit_status != 0:
+        raise OSError("remote tar extraction failed ({0}): {1}".format(result.exit_status,result.stderr))
+
+    return stats
+
+# Chunked, parallel and resumable transfer of (very) large files
+# - the file is split in byte ranges written in parallel at their offset, over one or more SFTP channels
+# - the completed chunks are recorded in a journal (TRANSFER_JOURNAL_DIR) so an interrupted transfer resumes
+# - the transfer is verified with a sha256 checksum (hash_local/hash_remote are coroutines path -> hex digest)
+class KatapultChunkedTransfer():
+
+    def __init__(self,ftp_clients,hash_local,hash_remote,chunk_size=LARGE_FILE_CHUNK_SIZE,parallel=LARGE_FILE_PARALLEL,journal_dir=TRANSFER_JOURNAL_DIR,stats=None):
+        self._ftp_clients = ftp_clients
+        self._hash_local  = hash_local
+        self._hash_remote = hash_remote
+        self._chunk_size  = max(1,chunk_size)
+        self._parallel    = max(1,parallel)
+        self._journal_dir = journal_dir
+        self._stats       = stats if stats is not None else KatapultTransferStats()
+
+    def get_stats(self):
+        return self._stats
+
+    def _journal_path(self,direction,local_path,remote_path):
+        key = hashlib.sha1( (direction+':'+os.path.abspath(local_path)+':'+remote_path).encode() ).hexdigest()
+        return os.path.join(self._journal_dir,key+'.json')
+
+    def _load_journal(self,journal_path,signature):
+        try:
+            with open(journal_path,'r') as journal_file:
+                journal = json.loads(journal_file.read())
+            if journal.get('signature') == signature:
+                return journal
+        except (OSError,ValueError):
+            pass
+        return None
+
+    def _save_journal(self,journal_path,journal):
+        os.makedirs(self._journal_dir,exist_ok=True)
+        tmp_path = journal_path + '.tmp'
+        with open(tmp_path,'w') as journal_file:
+            journal_file.write(json.dumps(journal))
+        os.replace(tmp_path,journal_path)
+
+    def _remove_journal(self,journal_path):
+        try:
+            os.remove(journal_path)
+        except OSError:
+            pass
+
+    # (in the executor: the journal is written after every chunk)
+    async def _save_journal_async(self,journal_path,journal):
+        snapshot = dict( journal , done=list(journal['done']) )
+        await asyncio.get_running_loop().run_in_executor(None,self._save_journal,journal_path,snapshot)
+
+    async def _run_chunks(self,size,journal,journal_path,do_chunk):
+        num_chunks = (size + self._chunk_size - 1) // self._chunk_size
+        journal_lock = asyncio.Lock() # the saves don't overlap (same temporary file)
+        done  = set(journal['done'])
+        queue = asyncio.Queue()
+        for index in range(num_chunks):
+            if index not in done:
+                queue.put_nowait(index)
+
+        async def worker(w):
+            while True:
+                try:
+                    index = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                offset = index * self._chunk_size
+                length = min(self._chunk_size,size-offset)
+                await do_chunk(w,offset,length)
+                journal['done'].append(index)
+                async with journal_lock:
+                    await self._save_journal_async(journal_path,journal)
+
+        tasks = [ asyncio.ensure_future(worker(w)) for w in range(min(self._parallel,max(1,queue.qsize()))) ]
+        try:
+            await asyncio.gather( *tasks )
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+
+    async def _transfer(self,direction,local_path,remote_path,size,signature,open_files,do_chunk,expected_hash,actual_hash):
+        journal_path = self._journal_path(direction,local_path,remote_path)
+        for attempt in range(2):
+            t0 = time.perf_counter()
+            journal = self._load_journal(journal_path,signature)
+            resume  = journal is not None
+            if not resume:
+                journal = { 'signature' : signature , 'done' : [] }
+                await self._save_journal_async(journal_path,journal)
+            files = await open_files(resume)
+            try:
+                await self._run_chunks(size,journal,journal_path,lambda w,offset,length: do_chunk(files[w%len(files)],offset,length))
+            finally:
+                for the_file in files:
+                    await the_file.close()
+            if await expected_hash() == await actual_hash():
+                self._remove_journal(journal_path)
+                self._stats.add(remote_path,size,time.perf_counter()-t0)
+                return
+            # corrupted: restart from scratch (once)
+            self._remove_journal(journal_path)
+        raise OSError("checksum mismatch after chunked transfer of "+local_path)
+
+    async def put(self,local_path,remote_path):
+        self._stats.start()
+        st = os.stat(local_path)
+        signature = [ st.st_size , st.st_mtime , self._chunk_size ]
+        local_file = open(local_path,'rb')
+        file_lock  = threading.Lock() # the chunks are read in the executor
+
+        def read_chunk(offset,length):
+            with file_lock:
+                local_file.seek(offset)
+                return local_file.read(length)
+
+        async def open_files(resume):
+            files = []
+            for ftp_client in self._ftp_clients:
+                mode = 'r+b' if resume or files else 'wb'
+                try:
+                    files.append( await ftp_client.open(remote_path,mode) )
+                except asyncssh.sftp.SFTPNoSuchFile:
+                    files.append( await ftp_client.open(remote_path,'wb') )
+            return files
+
+        async def do_chunk(remote_file,offset,length):
+            data = await asyncio.get_running_loop().run_in_executor(None,read_chunk,offset,length)
+            await remote_file.write(data,offset)
+
+        try:
+            await self._transfer('put',local_path,remote_path,st.st_size,signature,open_files,do_chunk,
+                                 lambda: self._hash_local(local_path),lambda: self._hash_remote(remote_path))
+        finally:
+            local_file.close()
+        self._stats.stop()
+
+    async def get(self,remote_path,local_path,size):
+        self._stats.start()
+        remote_hash = await self._hash_remote(remote_path)
+        signature = [ size , remote_hash , self._chunk_size ]
+        journal_path = self._journal_path('get',local_path,remote_path)
+        if self._load_journal(journal_path,signature) is None or not os.path.exists(local_path):
+            self._remove_journal(journal_path)
+            with open(local_path,'wb') as local_file:
+                local_file.truncate(size)
+        local_file = open(local_path,'r+b')
+        file_lock  = threading.Lock() # the chunks are written in the executor
+
+        def write_chunk(offset,data):
+            with file_lock:
+                local_file.seek(offset)
+                local_file.write(data)
+
+        async def open_files(resume):
+            return [ await ftp_client.open(remote_path,'rb') for ftp_client in self._ftp_clients ]
+
+        async def do_chunk(remote_file,offset,length):
+            data = await remote_file.read(length,offset)
+            await asyncio.get_running_loop().run_in_executor(None,write_chunk,offset,data)
+
+        async def local_hash():
+            local_file.flush()
+            return await self._hash_local(local_path)
+
+        async def expected_hash():
+            return remote_hash
+
+        try:
+            await self._transfer('get',local_path,remote_path,size,signature,open_files,do_chunk,expected_hash,local_hash)
+        finally:
+            local_file.close()
+        self._stats.stop()
@@ -3,6 +3,7 @@ import jcs , yaml
 import uuid
 import os
 import re
+import copy , glob , threading
 from katapult.attrs import K_COMPUTED
 import pkg_resources
 
@@ -64,6 +65,60 @@ def update_requirements_path(env_dict,path):
         
     return env_dict
 
+# cache of the computed environment objects (and their hashes)
+# computing an environment can read YAML files or run 'conda env export' / 'pip freeze' 
+# and it is requested many times for the same configuration (hash, deploy, json ...)
+# key = configuration + signature (mtime/size) of the files and env directories it references
+# so the cache entry is naturally invalidated when one of those changes
+_env_cache      = dict()
+_env_cache_lock = threading.Lock()
+
+def _path_signature(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    signature = [ path , st.st_mtime_ns , st.st_size ]
+    if os.path.isdir(path):
+        # packages installed/removed in a conda env or a virtualenv touch those directories
+        markers = [ os.path.join(path,'conda-meta') ] + glob.glob(os.path.join(path,'lib','python*','site-packages'))
+        for marker in sorted(markers):
+            try:
+                signature.append( os.stat(marker).st_mtime_ns )
+            except OSError:
+                signature.append( None )
+    return signature
+
+def _environment_cache_key(env_config):
+    signatures = []
+    for key in [ 'command' , 'env_conda' , 'env_pypi' ]:
+        value = env_config.get(key)
+        if isinstance(value,str):
+            signatures.append( _path_signature(value) )
+    return json.dumps( [ env_config , signatures ] , sort_keys=True , default=str )
+
+def _get_cached_environment(env_config):
+    key = _environment_cache_key(env_config)
+    with _env_cache_lock:
+        cached = _env_cache.get(key)
+    if cached is None:
+        env_obj  = _compute_environment_object(env_config)
+        env_hash = compute_environment_hash(env_obj)
+        cached   = ( env_obj , env_hash )
+        with _env_cache_lock:
+            _env_cache[key] = cached
+    return cached
+
+# forget the cached environments (all of them or the ones of this configuration)
+def invalidate_environment_cache(env_config=None):
+    with _env_cache_lock:
+        if env_config is None:
+            _env_cache.clear()
+        else:
+            prefix = json.dumps( [ env_config ] , sort_keys=True , default=str )[:-1]
+            for key in [ k for k in _env_cache if k.startswith(prefix+',') ]:
+                del _env_cache[key]
+
 # returns a JSON object that represents lists as in requirements.txt as well as YAML format (can be parsed by YAML module)
 # this object will be serialized and sent to remote host
 # this is also used to compute the hash for the environment
@@ -74,6 +129,21 @@ def compute_environment_object(env_config):
     if env_config.get(K_COMPUTED) == True:
         return env_config
 
+    # the callers modify the object (name, requirements path ...): always give them a copy
+    env_obj , _ = _get_cached_environment(env_config)
+    return copy.deepcopy(env_obj)
+
+# the hash of the environment object (cached along with the object)
+def compute_environment_object_hash(env_config):
+
+    if env_config.get(K_COMPUTED) == True:
+        return compute_environment_hash(env_config)
+
+    _ , env_hash = _get_cached_environment(env_config)
+    return env_hash
+
+def _compute_environment_object(env_config):
+
     environment_obj = {
         'command'    : None ,
         'env_aptget' : None , 
@@ -1,7 +1,7 @@
 import pytest
 import os
 import boto3
-from moto import mock_ec2 , mock_sts
+from moto import mock_ec2 , mock_sts , mock_s3
 from unittest import mock
 from pathlib import Path
 
@@ -31,3 +31,9 @@ def sts(aws_credentials):
         session=boto3.Session(profile_name='mock',region_name="eu-west-3")
         yield session.client('sts')
 
+
+@pytest.fixture(scope="function")
+def s3(aws_credentials):
+    with mock_s3():
+        session=boto3.Session(profile_name='mock',region_name="eu-west-3")
+        yield session.client('s3')
@@ -19,10 +19,17 @@ from datetime import datetime
 import re
 import asyncio
 import random
+import json
+import tarfile
+import io
+import hashlib
+import boto3
+from urllib.parse import urlparse , unquote
 
 from io import StringIO 
 
 MKCFG_REUPLOAD = 'reupload'
+MKCFG_TAR_FAIL = 'tar_fail'
 
 random.seed(10)
 
@@ -103,6 +110,10 @@ class SSHServerEmul:
         self.job_period = 5
         self.files  = dict()
         self.batches = dict()
+        self.tar_streams = 0
+        self.fetched = 0
+        self.removed = []
+        self.interrupted = set()
 
     async def listen(self,port=0):
         
@@ -114,6 +125,7 @@ class SSHServerEmul:
             server_factory=NoAuthSSHServer,
             server_host_keys=[self.privkey],
             process_factory=self.handler,
+            encoding=None, # (the tar streams are binary)
             sftp_factory=MySFTPServer(self),
             options=asyncssh.SSHServerConnectionOptions(host_based_auth=False)
         )
@@ -131,6 +143,9 @@ class SSHServerEmul:
     async def run_batch(self,batch):
         processes = batch['processes']
         for process in processes:    
+            if batch['instance'] in self.interrupted:
+                self.checkpoint(process)
+                continue
             command = process['command']
             if 'err_mem' in command:
                 process['state'] = 'aborted(OOM kill)'
@@ -144,7 +159,22 @@ class SSHServerEmul:
             else:
                 process['state'] = 'running(normally)'            
             await asyncio.sleep(self.job_period)
-            process['state'] = 'done(normally)'
+            if batch['instance'] in self.interrupted:
+                self.checkpoint(process)
+            else:
+                process['state'] = 'done(normally)'
+
+    # emulates spot_watch.py: the jobs of the instance are stopped (spot interruption notice)
+    def interrupt_instance(self,instance_name):
+        self.interrupted.add(instance_name)
+
+    # the checkpoint hook writes the checkpoint files declared in checkpoint.json
+    def checkpoint(self,process):
+        for path , content in list(self.files.items()):
+            if path.endswith(os.path.join(process['uid'],'checkpoint.json')):
+                for the_file in json.loads(content)['files']:
+                    self.files[os.path.join(os.path.dirname(path),the_file)] = 'checkpoint of ' + process['uid']
+        process['state'] = 'aborted(spot interruption)'
 
     def start_batch(self,uid):
         batch = self.batches[uid]
@@ -158,6 +188,68 @@ class SSHServerEmul:
         await asyncio.gather(*group)
         print("done")
 
+    # emulates remote_ops.py (batched operations sent on stdin)
+    def get_remote_ops_value(self,ops_str):
+        results = []
+        for op in json.loads(ops_str or '[]'):
+            result = { 'ok' : True }
+            if op['op'] == 'stat':
+                # TODO: add more control/granularity
+                if 'ready' in op['path']:
+                    exists = not self.config.get(MKCFG_REUPLOAD,True)
+                else:
+                    exists = True
+                result['exists'] = exists
+                if exists:
+                    result['type'] = 'file' if op['path'] in self.files or 'ready' in op['path'] else 'dir'
+                    if isinstance(self.files.get(op['path']),str):
+                        result['size'] = len(self.files[op['path']].encode())
+            elif op['op'] == 'write':
+                self.files[op['path']] = op.get('content','')
+            elif op['op'] == 'read':
+                result['exists']  = op['path'] in self.files
+                result['content'] = self.files.get(op['path'])
+            elif op['op'] == 'hash':
+                if op['path'] in self.files:
+                    result['hash'] = hashlib.sha256(self.files[op['path']].encode()).hexdigest()
+                else:
+                    result = { 'ok' : False , 'error' : 'No such file' }
+            elif op['op'] == 'fetch':
+                # the staging bucket is mocked by moto: read the object back with boto3
+                result['errors'] = []
+                for item in op.get('items',[]):
+                    try:
+                        self.files[item['path']] = self.fetch_url(item['url'])
+                        self.fetched += 1
+                        result['errors'].append(None)
+                    except Exception as e:
+                        result['errors'].append(str(e))
+            elif op['op'] == 'rm':
+                self.removed.append(op['path'])
+                self.files.pop(op['path'],None)
+            elif op['op'] == 'copy':
+                if op['src'] in self.files:
+                    self.files[op['path']] = self.files[op['src']]
+                else:
+                    result = { 'ok' : False , 'error' : 'No such file' }
+            results.append(result)
+        return json.dumps(results)
+
+    def fetch_url(self,url):
+        parsed = urlparse(url)
+        if parsed.port is not None:
+            # peer server (all the emulated instances share the same files): /<token>/<path>
+            path = '/' + unquote(parsed.path.lstrip('/').split('/',1)[1])
+            return self.files[path]
+        host   = parsed.netloc.split('.')[0]
+        path   = parsed.path.lstrip('/')
+        if host.startswith('s3'): # path-style URL
+            bucket , key = path.split('/',1)
+        else:
+            bucket , key = host , path
+        s3_client = boto3.client('s3')
+        return s3_client.get_object(Bucket=bucket,Key=key)['Body'].read().decode()
+
     def get_return_value(self,process):
         # get the return_value set by ssh_mock_server.return_value (from the test)
         # always force re-upload
@@ -182,6 +274,12 @@ class SSHServerEmul:
         # configure the environment
         elif 'run/config.py' in cmd:
             return ""
+        # peer server
+        elif 'p2p_serve.py' in cmd:
+            return "ok"
+        # wait for the boot-time bootstrap
+        elif 'cloud-init status' in cmd:
+            return ""
         # bootstrap env
         elif 'generate_envs.sh' in cmd:
             return ""
@@ -217,7 +315,20 @@ class SSHServerEmul:
             regex_find_state   = r"echo '([^']+)'\s*>\s*.*" + os.path.join(r_path,'state')
             # envwithhas - command - input files - output files - batch uid - jobhash - uid
             regex_find_more = r"" + os.path.join('run','run.sh') + spaced_arg_q + spaced_arg_q + spaced_arg_q + spaced_arg_q + spaced_arg + spaced_arg + spaced_arg
+            heredoc = None
             for line in batch_lines:
+                # files written with a here-document (checkpoint.json)
+                if heredoc is not None:
+                    if line == heredoc[1]:
+                        self.files[heredoc[0]] = '\n'.join(heredoc[2])
+                        heredoc = None
+                    else:
+                        heredoc[2].append(line)
+                    continue
+                heredocm = re.match(r"^cat > (\S+) <<'(\w+)'$", line)
+                if heredocm:
+                    heredoc = ( heredocm.group(1) , heredocm.group(2) , [] )
+                    continue
                 if line.startswith('ln'):
                     continue
                 elif line.startswith('echo'):
@@ -301,9 +412,29 @@ class SSHServerEmul:
             print("USING DEFAULT COMMAND ANSWER !")
             return ""
 
-    def handler(self,process):
-        value = self.get_return_value(process)
-        process.stdout.write(value)
+    # 'upload_mode':'tar' - extracts the stream into the files
+    async def extract_tar(self,process):
+        data = await process.stdin.read()
+        if self.config.get(MKCFG_TAR_FAIL,False):
+            process.stderr.write(b'tar: emulated failure\n')
+            process.exit(2)
+            return
+        self.tar_streams += 1
+        with tarfile.open(fileobj=io.BytesIO(data),mode='r|*') as tar:
+            for member in tar:
+                if member.isfile():
+                    self.files['/'+member.name] = tar.extractfile(member).read().decode()
+        process.exit(0)
+
+    async def handler(self,process):
+        if 'tar -x' in process.command:
+            await self.extract_tar(process)
+            return
+        if 'remote_ops.py' in process.command:
+            value = self.get_remote_ops_value((await process.stdin.read()).decode())
+        else:
+            value = self.get_return_value(process)
+        process.stdout.write(value.encode())
         process.exit(0)
 
     def file_exists(self,path):
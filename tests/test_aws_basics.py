@@ -1,20 +1,22 @@
 from .aws_patch import mock_make_api_call
 from unittest.mock import patch
 import pytest
-from moto import mock_ec2 , mock_sts
-from .aws_config import ec2 , sts , aws_credentials
+from moto import mock_ec2 , mock_sts , mock_s3
+from .aws_config import ec2 , sts , s3 , aws_credentials
 import boto3
 import os
 import pytest_asyncio
 import asyncio
+import time
 from .configs import config_aws_one_instance_local
 from katapult.core import KatapultInstanceState , KatapultProcessState
 from .ssh_server_mock import ssh_mock_server , MKCFG_REUPLOAD
-from .ssh_server_emul import SSHServerEmul
+from .ssh_server_emul import SSHServerEmul , MKCFG_TAR_FAIL
 from katapult.providerfat import RUNNER_FILES , set_sleep_period
 from pathlib import Path
 
 TEST_PERIOD = 0.5
+STAGE_DELAY = 1.0 # added to the deploy stages measured by test_client_deploy
 
 def check_file_uploaded(ssh_server,instance,file_list,ref_file,split=False):
     if not file_list:
@@ -125,6 +127,20 @@ async def test_client_deploy(ec2,sts):
         # attach the server to the client
         kt.set_mock_server(ssh_server)
 
+        # the spans of the environments and jobs stages (slowed down so an overlap can be measured)
+        spans = dict()
+        def record_stage(stage,method):
+            async def recorded(instance,*args,**kwargs):
+                start = time.perf_counter()
+                try:
+                    await asyncio.sleep(STAGE_DELAY)
+                    return await method(instance,*args,**kwargs)
+                finally:
+                    spans.setdefault(instance.get_name(),dict())[stage] = ( start , time.perf_counter() )
+            return recorded
+        kt._deploy_environments = record_stage('environments',kt._deploy_environments)
+        kt._deploy_jobs         = record_stage('jobs',kt._deploy_jobs)
+
         await kt.deploy()
 
         objs = await kt.get_objects()
@@ -146,6 +162,322 @@ async def test_client_deploy(ec2,sts):
             check_file_uploaded(ssh_server,instance,job.get_config('upload_files'),job.get_config('run_script'),False)
             check_file_uploaded(ssh_server,instance,job.get_config('input_files'),job.get_config('run_script'),False)
 
+        upload_stats = kt.get_upload_stats()
+        for instance in instances:
+            assert upload_stats[instance.get_name()]['files'] > 0
+
+        # the environments are bootstrapped concurrently
+        for path , content in ssh_server.files.items():
+            if path.endswith('generate_envs.sh'):
+                assert content.count('&\n') == content.count('bootstrap.sh')
+                assert content.endswith('wait\n')
+
+        # the stages are timed and the environments and jobs are deployed concurrently:
+        # the jobs upload starts before the environments are over and the deploy is shorter than the stages one after another
+        deploy_timings = kt.get_deploy_timings()
+        for instance in instances:
+            timings = deploy_timings[instance.get_name()]
+            for stage in [ 'instance' , 'environments' , 'jobs' , 'total' ]:
+                assert stage in timings
+            envs_span , jobs_span = spans[instance.get_name()]['environments'] , spans[instance.get_name()]['jobs']
+            assert jobs_span[0] < envs_span[1] and envs_span[0] < jobs_span[1]
+            assert timings['total'] < timings['instance'] + timings['environments'] + timings['jobs'] - STAGE_DELAY / 2
+
+        # deploying again does not re-send the unchanged files (content manifest)
+        for instance in instances:
+            await kt._deploy_all(instance)
+        upload_stats = kt.get_upload_stats()
+        for instance in instances:
+            assert upload_stats[instance.get_name()]['files'] == 0
+            assert upload_stats[instance.get_name()]['skipped'] > 0
+
+
+
+@mock_ec2
+@mock_sts
+@mock_s3
+@pytest.mark.asyncio
+async def test_client_deploy_bucket(ec2,sts,s3):
+    with patch('botocore.client.BaseClient._make_api_call', new=mock_make_api_call):
+
+        from katapult.provider import get_client
+
+        kt = get_client(os.path.join('tests','config.example.all_tests.local.py'))
+        kt._config['upload_mode'] = 'bucket'
+
+        await kt.start()
+
+        ssh_server = SSHServerEmul()
+        await ssh_server.listen()
+        ssh_server.set_config(MKCFG_REUPLOAD,True)
+
+        kt.set_mock_server(ssh_server)
+
+        await kt.deploy()
+
+        objs = await kt.get_objects()
+        instances = objs['instances']
+
+        for job in objs['jobs']:
+            instance = job.get_instance()
+            check_file_uploaded(ssh_server,instance,job.get_config('upload_files'),job.get_config('run_script'),False)
+            check_file_uploaded(ssh_server,instance,job.get_config('input_files'),job.get_config('run_script'),False)
+
+        # the instances pulled their files from the bucket ...
+        upload_stats = kt.get_upload_stats()
+        for instance in instances:
+            assert upload_stats[instance.get_name()]['pulled'] > 0
+            assert upload_stats[instance.get_name()]['files'] == 0
+
+        # ... and each content has been uploaded to the bucket only once
+        staged = s3.list_objects_v2(Bucket=kt._staging_bucket)['Contents']
+        assert kt.get_staging_stats()['files'] == len(staged)
+        assert len(staged) < ssh_server.fetched
+
+
+async def _deploy_tar(tar_fail):
+    with patch('botocore.client.BaseClient._make_api_call', new=mock_make_api_call):
+
+        from katapult.provider import get_client
+
+        kt = get_client(os.path.join('tests','config.example.all_tests.local.py'))
+        kt._config['upload_mode'] = 'tar'
+
+        await kt.start()
+
+        ssh_server = SSHServerEmul()
+        await ssh_server.listen()
+        ssh_server.set_config(MKCFG_REUPLOAD,True)
+        ssh_server.set_config(MKCFG_TAR_FAIL,tar_fail)
+
+        kt.set_mock_server(ssh_server)
+
+        await kt.deploy()
+
+        objs = await kt.get_objects()
+
+        # the files are there either way (extracted from the tar stream or sent by SFTP)
+        for job in objs['jobs']:
+            instance = job.get_instance()
+            check_file_uploaded(ssh_server,instance,job.get_config('upload_files'),job.get_config('run_script'),False)
+            check_file_uploaded(ssh_server,instance,job.get_config('input_files'),job.get_config('run_script'),False)
+
+        upload_stats = kt.get_upload_stats()
+        for instance in objs['instances']:
+            assert upload_stats[instance.get_name()]['files'] > 0
+
+        return ssh_server
+
+@mock_ec2
+@mock_sts
+@pytest.mark.asyncio
+async def test_client_deploy_tar(ec2,sts):
+    ssh_server = await _deploy_tar(False)
+    assert ssh_server.tar_streams > 0
+
+@mock_ec2
+@mock_sts
+@pytest.mark.asyncio
+async def test_client_deploy_tar_fallback(ec2,sts):
+    # the remote extraction fails: the files are sent by SFTP
+    ssh_server = await _deploy_tar(True)
+    assert ssh_server.tar_streams == 0
+
+
+@mock_ec2
+@mock_sts
+@mock_s3
+@pytest.mark.asyncio
+async def test_client_env_cache(ec2,sts,s3):
+    with patch('botocore.client.BaseClient._make_api_call', new=mock_make_api_call):
+
+        from katapult.provider import get_client
+        import json
+
+        kt = get_client(os.path.join('tests','config.example.all_tests.local.py'))
+        kt._config['env_cache'] = True
+
+        await kt.start()
+
+        ssh_server = SSHServerEmul()
+        await ssh_server.listen()
+        ssh_server.set_config(MKCFG_REUPLOAD,True)
+
+        kt.set_mock_server(ssh_server)
+
+        await kt.deploy()
+
+        # the environments have nothing in the cache yet: bootstrap.sh will upload them
+        artifacts = [ json.loads(content) for path , content in ssh_server.files.items() if path.endswith('artifact.json') ]
+        assert len(artifacts) > 0
+        for artifact in artifacts:
+            assert artifact.get('put') and not artifact.get('get')
+
+        # once uploaded, the packed environment is fetched instead of built
+        objs = await kt.get_objects()
+        instance = objs['instances'][0]
+        dpl_env  = list(instance.get_environments())[0].deploy(instance)
+        s3.put_object(Bucket=kt._staging_bucket,Key='envs/'+dpl_env.get_name_with_hash()+'.tar.gz',Body=b'packed')
+        urls = await kt._get_env_artifact_urls(dpl_env)
+        assert urls.get('get')
+
+
+@mock_ec2
+@mock_sts
+@pytest.mark.asyncio
+async def test_client_deploy_p2p(ec2,sts):
+    with patch('botocore.client.BaseClient._make_api_call', new=mock_make_api_call):
+
+        from katapult.provider import get_client
+
+        kt = get_client(os.path.join('tests','config.example.all_tests.local.py'))
+        kt._config['upload_mode']  = 'p2p'
+        kt._config['p2p_min_size'] = 0
+
+        await kt.start()
+
+        ssh_server = SSHServerEmul()
+        await ssh_server.listen()
+        ssh_server.set_config(MKCFG_REUPLOAD,True)
+
+        kt.set_mock_server(ssh_server)
+
+        await kt.deploy()
+
+        objs = await kt.get_objects()
+
+        for job in objs['jobs']:
+            instance = job.get_instance()
+            check_file_uploaded(ssh_server,instance,job.get_config('upload_files'),job.get_config('run_script'),False)
+            check_file_uploaded(ssh_server,instance,job.get_config('input_files'),job.get_config('run_script'),False)
+
+        # the shared files have been sent once by the client and copied between the instances
+        fanout_stats = kt._get_fanout().get_stats()
+        assert fanout_stats['peered'] > 0
+        assert fanout_stats['failed_peers'] == 0
+        assert sum( stats['peered'] for stats in kt.get_upload_stats().values() ) == fanout_stats['peered']
+
+
+@mock_ec2
+@mock_sts
+@pytest.mark.asyncio
+async def test_client_bake_images(ec2,sts):
+    with patch('botocore.client.BaseClient._make_api_call', new=mock_make_api_call):
+
+        from katapult.provider import get_client
+
+        kt = get_client(os.path.join('tests','config.example.all_tests.local.py'))
+        kt._config['bake_images'] = True
+
+        await kt.start()
+
+        ssh_server = SSHServerEmul()
+        await ssh_server.listen()
+        ssh_server.set_config(MKCFG_REUPLOAD,True)
+
+        kt.set_mock_server(ssh_server)
+
+        await kt.deploy()
+
+        # the environments are now bootstrapped
+        ssh_server.set_config(MKCFG_REUPLOAD,False)
+
+        images = await kt.bake_images()
+        assert len(images) > 0
+        # the runtime state of the instances is not baked
+        removed = [ os.path.basename(path) for path in ssh_server.removed ]
+        assert all( name in removed for name in [ '*.pid' , 'slots.json' , 'cancelled' , 'interrupted' ] )
+
+        # nothing new to bake
+        assert await kt.bake_images() == []
+
+        # a new instance is launched from the golden image
+        objs = await kt.get_objects()
+        instance = objs['instances'][0]
+        kt.terminate_instance(instance)
+        await kt.start()
+        assert instance.get_data('ImageId') in images
+
+
+@mock_ec2
+@mock_sts
+@mock_s3
+@pytest.mark.asyncio
+async def test_client_boot_bootstrap(ec2,sts,s3):
+    with patch('botocore.client.BaseClient._make_api_call', new=mock_make_api_call):
+
+        from katapult.provider import get_client
+        import base64 , gzip , re , hashlib
+
+        kt = get_client(os.path.join('tests','config.example.all_tests.local.py'))
+        kt._config['boot_bootstrap'] = True
+
+        await kt.start()
+
+        objs = await kt.get_objects()
+        env_names = [ env.get_name_with_hash() for env in objs['environments'] ]
+
+        ssh_server = SSHServerEmul()
+
+        # the instances boot with a loader of the runner files and the bootstrap of the environments (staged in the bucket)
+        for instance in objs['instances']:
+            ec2_client = boto3.client('ec2',region_name=instance.get_region())
+            attribute  = ec2_client.describe_instance_attribute(InstanceId=instance.get_id(),Attribute='userData')
+            user_data  = base64.b64decode(attribute['UserData']['Value'])
+            assert len(user_data) < 2048
+            loader     = gzip.decompress(user_data).decode()
+            assert loader.startswith('#!/bin/bash')
+            script     = ssh_server.fetch_url(re.search(r"'(https://[^']+)'",loader).group(1))
+            assert hashlib.sha256(script.encode()).hexdigest() in loader
+            assert script.startswith('#!/bin/bash')
+            for runner_file in RUNNER_FILES:
+                assert runner_file in script
+            for env_name in env_names:
+                assert env_name in script
+
+        await ssh_server.listen()
+        ssh_server.set_config(MKCFG_REUPLOAD,True)
+
+        kt.set_mock_server(ssh_server)
+
+        await kt.deploy()
+
+        for instance in objs['instances']:
+            for runner_file in RUNNER_FILES:
+                assert ssh_server.has_file( instance , runner_file )
+
+
+@mock_ec2
+@mock_sts
+@pytest.mark.asyncio
+async def test_client_ssh_probe(ec2,sts):
+    with patch('botocore.client.BaseClient._make_api_call', new=mock_make_api_call):
+
+        from katapult.provider import get_client
+        from katapult.connpool import probe_ssh_banner
+
+        kt = get_client(os.path.join('tests','config.example.all_tests.local.py'))
+
+        await kt.start()
+
+        ssh_server = SSHServerEmul()
+        await ssh_server.listen()
+
+        # nothing listening / not a SSH server
+        assert not await probe_ssh_banner(ssh_server.hostname,1,timeout=1)
+        http_server = await asyncio.start_server(lambda reader , writer : writer.write(b'HTTP/1.1 400\r\n'),'127.0.0.1',0)
+        assert not await probe_ssh_banner('127.0.0.1',http_server.sockets[0].getsockname()[1],timeout=1)
+        http_server.close()
+
+        assert await probe_ssh_banner(ssh_server.hostname,ssh_server.port)
+
+        kt.set_mock_server(ssh_server)
+
+        # the instances are ready as soon as their SSH server answers
+        objs = await kt.get_objects()
+        for instance in objs['instances']:
+            await asyncio.wait_for(kt._wait_for_instance(instance),30)
+            assert instance.get_reachability()
 
 
 @mock_ec2
@@ -210,9 +542,287 @@ async def test_client_run(ec2,sts):
             else:
                 assert state == KatapultProcessState.DONE
 
+        # the SSH connections have been re-used across deploy, run and wait
+        stats = kt.get_connection_stats()
+        assert stats['hits'] > 0
+        assert stats['misses'] <= len(objs['instances'])
+
 # working
 # @mock_ec2
 # def test_client_create():
 #     client = boto3.client('ec2',region_name="eu-west-3")
 #     result = client.describe_images()
 #     print(result)
+
+@mock_ec2
+@mock_sts
+@pytest.mark.asyncio
+async def test_client_run_array(ec2,sts):
+    with patch('botocore.client.BaseClient._make_api_call', new=mock_make_api_call):
+
+        from katapult.provider import get_client
+
+        kt = get_client(os.path.join('tests','config.example.all_tests.local.py'))
+
+        await kt.start()
+
+        objs = await kt.get_objects()
+
+        # the first job becomes a sweep of 4 tasks
+        array_job = objs['jobs'][0]
+        array_job.get_config_DIRTY()['array']          = [ 10 , 14 ]
+        array_job.get_config_DIRTY()['array_parallel'] = 2
+        array_job.get_config_DIRTY()['output_files']   = [ 'out-{index}.dat' , 'summary.dat' ]
+
+        ssh_server = SSHServerEmul()
+        await ssh_server.listen()
+        ssh_server.set_config(MKCFG_REUPLOAD,True)
+
+        kt.set_mock_server(ssh_server)
+
+        await kt.deploy()
+
+        set_sleep_period(TEST_PERIOD/2) 
+        ssh_server.set_job_period(TEST_PERIOD)
+
+        await kt.run()   
+        await ssh_server.wait_for_batches()  
+        await kt.wait(KatapultProcessState.DONE|KatapultProcessState.ABORTED)
+
+        # one process for the whole array, the tasks are run by run.sh
+        process = array_job.get_last_process()
+        assert len(array_job.get_deployed_jobs()) == 1
+        assert len(array_job.get_deployed_jobs()[0].get_processes()) == 1
+        batch_runs = [ content for path , content in ssh_server.files.items() if 'batch_run-' in path and isinstance(content,str) and process.get_uid() in content ]
+        assert len(batch_runs) == 1
+        run_lines = [ line for line in batch_runs[0].splitlines() if process.get_uid()+'>' in line ]
+        assert len(run_lines) == 1
+        assert 'KATAPULT_ARRAY=10:14:2 ' in run_lines[0]
+        # the outputs of the tasks are not checked by state.sh
+        assert '"summary.dat"' in run_lines[0]
+
+        # compact per-task states
+        process.set_state(KatapultProcessState.ABORTED)
+        process.set_tasks_state('dda.')
+        assert process.get_task_state(11) == KatapultProcessState.DONE
+        assert process.get_task_state(12) == KatapultProcessState.ABORTED
+        assert process.get_task_state(14) == KatapultProcessState.UNKNOWN
+        assert process.get_tasks_indices(KatapultProcessState.DONE) == [ 10 , 11 ]
+        assert kt._get_process_output_files(process) == [ 'out-10.dat' , 'out-11.dat' , 'summary.dat' ]
+
+@mock_ec2
+@mock_sts
+@pytest.mark.asyncio
+async def test_client_run_dynamic(ec2,sts):
+    with patch('botocore.client.BaseClient._make_api_call', new=mock_make_api_call):
+
+        from katapult.provider import get_client
+
+        kt = get_client(os.path.join('tests','config.example.all_tests.local.py'))
+        kt._config['job_dispatch'] = 'dynamic'
+
+        await kt.start()
+
+        ssh_server = SSHServerEmul()
+        await ssh_server.listen()
+        ssh_server.set_config(MKCFG_REUPLOAD,True)
+
+        kt.set_mock_server(ssh_server)
+
+        await kt.deploy()
+
+        set_sleep_period(TEST_PERIOD/2) 
+        ssh_server.set_job_period(TEST_PERIOD/5)
+
+        run_session = await kt.run()   
+
+        # the instances only get what their CPU can run (1 CPU each here): the rest waits in the central queue
+        objs = await kt.get_objects()
+        assert len(run_session._batches[0].get_processes()) <= len(objs['instances'])
+
+        await kt.wait(KatapultProcessState.DONE|KatapultProcessState.ABORTED)
+        await ssh_server.wait_for_batches()  
+
+        assert not kt._has_pending_dispatch()
+        # every job has been sent once
+        for job in objs['jobs']:
+            processes = [ p for p in run_session.get_processes() if p.get_job().get_parent_job() == job ]
+            assert len(processes) == 1
+            assert processes[0].get_state() & (KatapultProcessState.DONE|KatapultProcessState.ABORTED)
+        assert len(run_session._batches) > len(objs['instances'])
+
+        # an idle instance takes its own jobs first, then the jobs of the busiest instance (same environment)
+        instance_a , instance_b = objs['instances'][0] , objs['instances'][1]
+        jobs_a = [ job for job in instance_a.get_jobs() if instance_b.has_environment(job.get_env()) ]
+        jobs_b = [ job for job in instance_b.get_jobs() ]
+        assert jobs_a and jobs_b
+        kt._dispatch_queue = [ jobs_a[0] , jobs_b[0] ]
+        assert kt._take_dispatch_jobs(run_session,instance_b,False) == [ jobs_b[0] ]
+        assert kt._take_dispatch_jobs(run_session,instance_b,True) == [ jobs_a[0] ]
+        assert kt._dispatch_queue == []
+
+@mock_ec2
+@mock_sts
+@pytest.mark.asyncio
+async def test_client_run_dag(ec2,sts):
+    with patch('botocore.client.BaseClient._make_api_call', new=mock_make_api_call):
+
+        from katapult.provider import get_client
+
+        kt = get_client(os.path.join('tests','config.example.all_tests.local.py'))
+
+        await kt.start()
+
+        objs = await kt.get_objects()
+
+        ssh_server = SSHServerEmul()
+        await ssh_server.listen()
+        ssh_server.set_config(MKCFG_REUPLOAD,True)
+
+        kt.set_mock_server(ssh_server)
+
+        await kt.deploy()
+
+        # job_b (on another instance) consumes the outputs of job_a , job_c depends on a job that fails
+        valid_jobs = [ job for job in objs['jobs'] if 'err' not in job.get_env().get_name() and 'err' not in ( job.get_config('run_script') or job.get_config('run_command') ) and job.get_config('output_files') ]
+        failing    = [ job for job in objs['jobs'] if 'err' in ( job.get_config('run_script') or job.get_config('run_command') or '' ) ]
+        job_a = valid_jobs[0]
+        job_b = [ job for job in valid_jobs if job.get_instance() != job_a.get_instance() and job_a.get_instance().has_environment(job.get_env()) ][0]
+        job_c = [ job for job in valid_jobs if job not in ( job_a , job_b ) ][0]
+        job_b.add_dependency(job_a)
+        job_c.add_dependency(failing[0])
+
+        set_sleep_period(TEST_PERIOD/2) 
+        ssh_server.set_job_period(TEST_PERIOD/5)
+
+        run_session = await kt.run()   
+        await kt.wait(KatapultProcessState.DONE|KatapultProcessState.ABORTED)
+        await ssh_server.wait_for_batches()  
+
+        process_a = job_a.get_last_process()
+        process_b = job_b.get_last_process()
+        assert process_a.get_state() == KatapultProcessState.DONE
+        assert process_b.get_state() == KatapultProcessState.DONE
+        # job_b has been sent once job_a was done, where the outputs of job_a are (same environment)
+        assert process_b.get_batch() != process_a.get_batch()
+        assert process_b.get_instance() == process_a.get_instance()
+        batch_b = [ content for path , content in ssh_server.files.items() if 'batch_run-'+process_b.get_batch().get_uid() in path ][0]
+        for out_file in job_a.get_config('output_files'):
+            assert 'ln -sf ' + process_a.get_instance().path_join( process_a.get_path() , out_file ) in batch_b
+        # job_c never runs
+        assert job_c in kt._dispatch_failed
+        assert not [ p for p in run_session.get_processes() if p.get_job().get_parent_job() == job_c ]
+
+        # the outputs are copied directly between the instances when the job runs somewhere else
+        other    = [ instance for instance in objs['instances'] if instance != process_a.get_instance() ][0]
+        dpl_job  = job_b.deploy(job_b.get_env().deploy(other),False)
+        for out_file in job_a.get_config('output_files'):
+            ssh_server.files[ process_a.get_instance().path_join( process_a.get_path() , out_file ) ] = 'result of job a'
+        await kt._stage_dependencies(run_session,other,[ job_b ])
+        for out_file in job_a.get_config('output_files'):
+            assert ssh_server.files.get( other.path_join( dpl_job.get_path() , 'deps' , process_a.get_uid() , out_file ) ) == 'result of job a'
+        assert kt._get_fanout().get_stats()['failed_peers'] == 0
+
+@mock_ec2
+@mock_sts
+@pytest.mark.asyncio
+async def test_client_run_spot_interruption(ec2,sts):
+    with patch('botocore.client.BaseClient._make_api_call', new=mock_make_api_call):
+
+        from katapult.provider import get_client
+
+        kt = get_client(os.path.join('tests','config.example.all_tests.local.py'))
+
+        await kt.start()
+
+        objs = await kt.get_objects()
+
+        ssh_server = SSHServerEmul()
+        await ssh_server.listen()
+        ssh_server.set_config(MKCFG_REUPLOAD,True)
+
+        kt.set_mock_server(ssh_server)
+
+        await kt.deploy()
+
+        # the spot instance is reclaimed: its jobs (with an environment on the other instances) are moved
+        interrupted = objs['instances'][0]
+        moved_jobs  = [ job for job in interrupted.get_jobs() if 'err' not in job.get_env().get_name() and 'err' not in ( job.get_config('run_script') or job.get_config('run_command') ) and any( inst.has_environment(job.get_env()) for inst in objs['instances'] if inst != interrupted ) ]
+        assert moved_jobs
+        for job in interrupted.get_jobs():
+            job.get_config_DIRTY()['checkpoint_files']   = [ 'ckpt.dat' ]
+            job.get_config_DIRTY()['checkpoint_command'] = 'kill -USR1 $KATAPULT_JOB_PID'
+        ssh_server.interrupt_instance(interrupted.get_name())
+
+        set_sleep_period(TEST_PERIOD/2) 
+        ssh_server.set_job_period(TEST_PERIOD/5)
+
+        run_session = await kt.run()   
+        await kt.wait(KatapultProcessState.DONE|KatapultProcessState.ABORTED)
+        await ssh_server.wait_for_batches()  
+
+        assert interrupted.get_name() in kt._interrupted_instances
+        assert not kt._has_pending_dispatch()
+        for job in moved_jobs:
+            processes = [ p for p in run_session.get_processes() if p.get_job().get_parent_job() == job ]
+            assert len(processes) == 2
+            old_process , new_process = processes
+            assert old_process.get_instance() == interrupted
+            assert old_process.get_state() == KatapultProcessState.ABORTED
+            assert new_process.get_instance() != interrupted
+            assert new_process.get_state() == KatapultProcessState.DONE
+            assert job.get_instance() == new_process.get_instance()
+            # the checkpoint has been copied from the interrupted instance and is put back in the new run directory
+            target   = new_process.get_instance()
+            ckpt_src = target.path_join( new_process.get_job().get_path() , 'checkpoint' , old_process.get_uid() , 'ckpt.dat' )
+            assert ssh_server.files.get(ckpt_src) == 'checkpoint of ' + old_process.get_uid()
+            batch_content = [ content for path , content in ssh_server.files.items() if 'batch_run-'+new_process.get_batch().get_uid() in path ][0]
+            assert 'cp -f ' + ckpt_src + ' ' + target.path_join( new_process.get_path() , 'ckpt.dat' ) in batch_content
+            assert ssh_server.files.get( target.path_join( new_process.get_path() , 'checkpoint.json' ) )
+
+@mock_ec2
+@mock_sts
+@pytest.mark.asyncio
+async def test_client_run_warm(ec2,sts):
+    with patch('botocore.client.BaseClient._make_api_call', new=mock_make_api_call):
+
+        from katapult.provider import get_client
+
+        kt = get_client(os.path.join('tests','config.example.all_tests.local.py'))
+        kt._config['warm_timeout'] = 30
+
+        await kt.start()
+
+        objs = await kt.get_objects()
+
+        ssh_server = SSHServerEmul()
+        await ssh_server.listen()
+        ssh_server.set_config(MKCFG_REUPLOAD,True)
+
+        kt.set_mock_server(ssh_server)
+
+        # the python scripts of the environment go through its warm worker
+        env = [ job.get_env() for job in objs['jobs'] if ( job.get_config('run_script') or '' ).endswith('.py') or '.py ' in ( job.get_config('run_script') or '' ) ][0]
+        env.get_config_DIRTY()['warm_modules'] = [ 'numpy' , 'pandas' ]
+
+        await kt.deploy()
+
+        # the forkserver is uploaded with the environment
+        for instance in objs['instances']:
+            if instance.has_environment(env):
+                assert ssh_server.files.get( instance.path_join( env.deploy(instance).get_path() , 'forkserver.py' ) )
+
+        set_sleep_period(TEST_PERIOD/2) 
+        ssh_server.set_job_period(TEST_PERIOD/5)
+
+        run_session = await kt.run()   
+        await kt.wait(KatapultProcessState.DONE|KatapultProcessState.ABORTED)
+        await ssh_server.wait_for_batches()  
+
+        batches = [ content for path , content in ssh_server.files.items() if 'batch_run-' in path ]
+        for process in run_session.get_processes():
+            line = [ l for batch in batches for l in batch.splitlines() if process.get_uid() in l and 'run.sh' in l ][0]
+            job  = process.get_job()
+            warm = job.get_env().get_name() == env.get_name() and job.get_command().startswith('python3 ') and not job.is_array()
+            assert ( 'KATAPULT_WARM=numpy,pandas KATAPULT_WARM_TIMEOUT=30 ' in line ) == warm
+            assert process.get_state() & (KatapultProcessState.DONE|KatapultProcessState.ABORTED)
@@ -0,0 +1,268 @@
+import pytest
+import os
+import sys
+import json
+import hashlib
+import time
+import signal
+import threading
+import subprocess
+import katapult
+from http.server import ThreadingHTTPServer , BaseHTTPRequestHandler
+
+REMOTE_FILES = os.path.join(os.path.dirname(katapult.__file__),'resources','remote_files')
+SLOTRUN      = os.path.join(REMOTE_FILES,'slotrun.py')
+ARRAYRUN     = os.path.join(REMOTE_FILES,'arrayrun.py')
+SPOT_WATCH   = os.path.join(REMOTE_FILES,'spot_watch.py')
+FORKSERVER   = os.path.join(REMOTE_FILES,'forkserver.py')
+REMOTE_OPS   = os.path.join(REMOTE_FILES,'remote_ops.py')
+JOB_PERIOD   = 0.6
+
+# the job logs its start and end in $HOME/jobs.log
+def job(name,cpus,period=JOB_PERIOD):
+    log = '"$HOME/jobs.log"'
+    return '{0} echo "{1} start $(date +%s.%N)" >> {2} ; sleep {3} ; echo "{1} end $(date +%s.%N)" >> {2}'.format(cpus,name,log,period)
+
+def start_slotrun(home,slots,jobs,priority=None):
+    args = [ sys.executable , SLOTRUN , str(slots) ] + ( [ str(priority) ] if priority is not None else [] )
+    env  = dict(os.environ)
+    env['HOME'] = str(home)
+    process = subprocess.Popen(args,stdin=subprocess.PIPE,env=env)
+    process.stdin.write( '\n'.join(jobs).encode() + b'\n' )
+    process.stdin.close()
+    return process
+
+def run_slotrun(home,slots,jobs,priority=None):
+    assert start_slotrun(home,slots,jobs,priority).wait(timeout=30) == 0
+
+# name -> [ start , end ]
+def read_spans(home):
+    spans = dict()
+    for line in (home/'jobs.log').read_text().splitlines():
+        name , event , when = line.split()
+        spans.setdefault(name,[ None , None ])[ 0 if event == 'start' else 1 ] = float(when)
+    return spans
+
+def max_concurrency(spans):
+    events = sorted( [ ( start , 1 ) for start , end in spans.values() ] + [ ( end , -1 ) for start , end in spans.values() ] )
+    current = best = 0
+    for when , delta in events:
+        current += delta
+        best = max(best,current)
+    return best
+
+def read_ledger(home):
+    return json.loads( (home/'run'/'.locks'/'slots.json').read_text() )
+
+def test_slotrun_admission(tmp_path):
+    run_slotrun(tmp_path,2,[ job('a',1) , job('b',1) , job('c',1) , job('d',1) ])
+    spans = read_spans(tmp_path)
+    assert sorted(spans) == [ 'a' , 'b' , 'c' , 'd' ]
+    assert max_concurrency(spans) == 2
+    # the CPUs are given back to the ledger
+    ledger = read_ledger(tmp_path)
+    assert ledger['claims'] == {} and ledger['waiting'] == {}
+
+def test_slotrun_first_fit(tmp_path):
+    # 'c' fits next to 'a' while 'b' waits for the 2 CPUs
+    run_slotrun(tmp_path,2,[ job('a',1) , job('b',2) , job('c',1) ])
+    spans = read_spans(tmp_path)
+    assert spans['c'][0] < spans['a'][1]
+    assert spans['b'][0] >= max( spans['a'][1] , spans['c'][1] )
+
+def test_slotrun_clamped(tmp_path):
+    # a job asking for more CPUs than the slots still runs (alone)
+    run_slotrun(tmp_path,2,[ job('big',8) , job('small',1) ])
+    spans = read_spans(tmp_path)
+    assert sorted(spans) == [ 'big' , 'small' ]
+    assert max_concurrency(spans) == 1
+
+def test_slotrun_shared_slots(tmp_path):
+    # another batch gets the CPUs left free by the first one
+    first  = start_slotrun(tmp_path,2,[ job('a',1,2*JOB_PERIOD) ])
+    time.sleep(JOB_PERIOD/2)
+    second = start_slotrun(tmp_path,2,[ job('b',1) ])
+    assert first.wait(timeout=30) == 0 and second.wait(timeout=30) == 0
+    spans = read_spans(tmp_path)
+    assert spans['b'][1] < spans['a'][1]
+
+@pytest.mark.parametrize('priority_old,priority_new,first',[ ( 0 , 5 , 'new' ) , ( 0 , 0 , 'old' ) , ( 5 , 0 , 'old' ) ])
+def test_slotrun_priority(tmp_path,priority_old,priority_new,first):
+    # all the CPUs are busy: the batches started next wait for them
+    busy = start_slotrun(tmp_path,2,[ job('busy',2,3*JOB_PERIOD) ])
+    time.sleep(JOB_PERIOD/2)
+    old  = start_slotrun(tmp_path,2,[ job('old',2) ],priority_old)
+    time.sleep(JOB_PERIOD/2)
+    new  = start_slotrun(tmp_path,2,[ job('new',2) ],priority_new)
+    time.sleep(JOB_PERIOD/2)
+    waiting = read_ledger(tmp_path)['waiting']
+    assert sorted( v['priority'] for v in waiting.values() ) == sorted([ priority_old , priority_new ])
+    for process in ( busy , old , new ):
+        assert process.wait(timeout=30) == 0
+
+    # the highest priority (then the oldest batch) gets the CPUs freed by 'busy'
+    spans  = read_spans(tmp_path)
+    second = 'old' if first == 'new' else 'new'
+    assert spans[first][0] >= spans['busy'][1]
+    assert spans[second][0] >= spans[first][1]
+
+def run_arrayrun(run_path,spec,command):
+    return subprocess.run([ sys.executable , ARRAYRUN , spec , command ],cwd=str(run_path),timeout=30).returncode
+
+def test_arrayrun_failed_task(tmp_path):
+    # index 12 fails until the 'fixed' file exists
+    command = 'echo $KATAPULT_TASK_INDEX >> ran ; [ $KATAPULT_TASK_INDEX != 12 ] || [ -f fixed ]'
+    assert run_arrayrun(tmp_path,'10:15:2',command) == 90
+    assert (tmp_path/'tasks.state').read_text() == 'ddadd'
+    assert (tmp_path/'state').read_text() == 'aborted(array: 4 done 0 running 1 failed of 5)\n'
+    assert sorted( (tmp_path/'ran').read_text().split() ) == [ '10' , '11' , '12' , '13' , '14' ]
+
+    # the restart only runs the tasks that are not done
+    (tmp_path/'fixed').write_text('')
+    (tmp_path/'ran').unlink()
+    assert run_arrayrun(tmp_path,'10:15:2',command) == 0
+    assert (tmp_path/'ran').read_text().split() == [ '12' ]
+    assert (tmp_path/'tasks.state').read_text() == 'ddddd'
+    assert (tmp_path/'state').read_text() == 'done(array: 5 done 0 running 0 failed of 5)\n'
+
+def test_arrayrun_crash(tmp_path):
+    # not the status of failed tasks: run.sh writes the state
+    assert run_arrayrun(tmp_path,'0:x:1','true') not in ( 0 , 90 )
+    assert not (tmp_path/'state').exists()
+
+def test_arrayrun_new_range(tmp_path):
+    assert run_arrayrun(tmp_path,'0:3:0','echo $KATAPULT_TASK_INDEX >> ran') == 0
+    assert (tmp_path/'tasks.state').read_text() == 'ddd'
+    # another number of tasks: the previous states don't apply
+    (tmp_path/'ran').unlink()
+    assert run_arrayrun(tmp_path,'0:4:1','echo $KATAPULT_TASK_INDEX >> ran') == 0
+    assert (tmp_path/'ran').read_text().split() == [ '0' , '1' , '2' , '3' ]
+    assert (tmp_path/'tasks.state').read_text() == 'dddd'
+
+# instance metadata service with a spot interruption notice
+class MetadataHandler(BaseHTTPRequestHandler):
+
+    def do_PUT(self):
+        self.reply(b'token' if self.path == '/latest/api/token' else None)
+
+    def do_GET(self):
+        if self.path == '/latest/meta-data/spot/instance-action' and self.headers.get('X-aws-ec2-metadata-token') == 'token':
+            self.reply(json.dumps({ 'action' : 'terminate' , 'time' : '2026-10-18T12:00:00Z' }).encode())
+        else:
+            self.reply(None)
+
+    def reply(self,body):
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self,format,*args):
+        pass
+
+def test_spot_watch_interruption(tmp_path):
+    server = ThreadingHTTPServer(('127.0.0.1',0),MetadataHandler)
+    threading.Thread(target=server.serve_forever,daemon=True).start()
+
+    # a running job ($HOME/run/ENV/JOB_HASH/UID) with a checkpoint hook
+    run_path = tmp_path/'run'/'env'/'job'/'uid'
+    run_path.mkdir(parents=True)
+    runner = subprocess.Popen(['sleep','30'])
+    child  = subprocess.Popen(['sleep','30'])
+    (run_path/'pid').write_text(',{0},{1}'.format(runner.pid,child.pid))
+    (run_path/'state').write_text('running\n')
+    (run_path/'checkpoint.json').write_text(json.dumps({ 'command' : 'echo $KATAPULT_INTERRUPTION $KATAPULT_JOB_PID > hooked' }))
+    try:
+        env = dict(os.environ)
+        env['HOME'] = str(tmp_path)
+        url = 'http://127.0.0.1:{0}'.format(server.server_address[1])
+        subprocess.run([ sys.executable , SPOT_WATCH , url , '0.1' , '2' , 'foreground' ],env=env,timeout=30,check=True)
+        assert (run_path/'hooked').read_text().split() == [ '1' , str(child.pid) ]
+        assert child.wait(timeout=5) == -signal.SIGTERM
+        assert runner.wait(timeout=5) == -signal.SIGKILL
+        assert (run_path/'state').read_text() == 'aborted(spot interruption)\n'
+        assert json.loads((tmp_path/'run'/'interrupted').read_text())['action'] == 'terminate'
+    finally:
+        for process in ( runner , child ):
+            process.kill()
+        server.shutdown()
+
+def submit_job(home,run_path,command):
+    env = dict(os.environ)
+    env['HOME'] = str(home)
+    with open(run_path/'run.log','w') as out , open(run_path/'error.log','w') as err:
+        return subprocess.run([ sys.executable , FORKSERVER , 'submit' , 'env' , str(run_path/'pid') , command ],cwd=str(run_path),env=env,stdout=out,stderr=err,timeout=30).returncode
+
+def test_forkserver_submit(tmp_path):
+    env = dict(os.environ)
+    env['HOME'] = str(tmp_path)
+    server = subprocess.Popen([ sys.executable , FORKSERVER , 'serve' , 'env' , 'json' , '30' ],env=env,stdout=subprocess.PIPE)
+    try:
+        assert b'ready' in server.stdout.readline()
+        run_path = tmp_path/'run'
+        run_path.mkdir()
+        (run_path/'job.py').write_text('import sys\nprint("out")\nprint("err",file=sys.stderr)\nsys.exit(3)\n')
+        (run_path/'pid').write_text('uid,1234')
+
+        # the exit status is the one of the job and the forked child writes in run.log/error.log
+        assert submit_job(tmp_path,run_path,'python3 job.py') == 3
+        assert (run_path/'forked').exists()
+        assert (run_path/'run.log').read_text() == 'out\n'
+        assert (run_path/'error.log').read_text() == 'err\n'
+        pids = (run_path/'pid').read_text().strip().split(',')
+        assert pids[:2] == [ 'uid' , '1234' ] and pids[2] == (run_path/'forked').read_text()
+
+        # a command that needs a shell runs normally
+        (run_path/'forked').unlink()
+        submit_job(tmp_path,run_path,'python3 job.py > other.log')
+        assert not (run_path/'forked').exists()
+    finally:
+        server.kill()
+        server.wait()
+
+def run_remote_ops(home,ops):
+    env = dict(os.environ)
+    env['HOME'] = str(home)
+    result = subprocess.run([ 'python3' , REMOTE_OPS ],input=json.dumps(ops).encode(),env=env,stdout=subprocess.PIPE,timeout=30,check=True)
+    return json.loads(result.stdout.decode())
+
+def test_remote_ops(tmp_path):
+    (tmp_path/'input.txt').write_text('hello')
+    results = run_remote_ops(tmp_path,[
+        { 'op' : 'stat'    , 'path' : '~/input.txt' } ,
+        { 'op' : 'stat'    , 'path' : '~/missing' } ,
+        { 'op' : 'mkdir'   , 'path' : '~/run/env/files' } ,
+        { 'op' : 'write'   , 'path' : '~/run/env/run.sh' , 'content' : 'echo ok' } ,
+        { 'op' : 'write'   , 'path' : '~/run/env/files/a.tmp' , 'content' : 'a' } ,
+        { 'op' : 'write'   , 'path' : '~/run/env/files/b.tmp' , 'content' : 'b' } ,
+        { 'op' : 'rm'      , 'path' : '~/run/env/files/*.tmp' , 'glob' : True } ,
+        { 'op' : 'chmod'   , 'path' : '~/run/env/*.sh' , 'glob' : True } ,
+        { 'op' : 'symlink' , 'src'  : '~/input.txt' , 'path' : '~/run/env/files/input.txt' } ,
+        { 'op' : 'copy'    , 'src'  : '~/input.txt' , 'path' : '~/copy/input.txt' } ,
+        { 'op' : 'read'    , 'path' : '~/copy/input.txt' } ,
+        { 'op' : 'read'    , 'path' : '~/missing' } ,
+        { 'op' : 'hash'    , 'path' : '~/run/env/files/input.txt' } ,
+        { 'op' : 'hash'    , 'path' : '~/missing' } ,
+        { 'op' : 'unknown' , 'path' : '~/input.txt' } ,
+        { 'op' : 'stat'    , 'path' : '~/run/env/files' } ,
+    ])
+    assert len(results) == 16
+    assert results[0]['ok'] and results[0]['exists'] and results[0]['type'] == 'file' and results[0]['size'] == 5
+    assert results[1] == { 'ok' : True , 'exists' : False }
+    assert all( result == { 'ok' : True } for result in results[2:10] )
+    assert results[10] == { 'ok' : True , 'exists' : True , 'content' : 'hello' }
+    assert results[11] == { 'ok' : True , 'exists' : False }
+    assert results[12] == { 'ok' : True , 'hash' : hashlib.sha256(b'hello').hexdigest() }
+    # an error doesn't stop the next operations
+    assert results[13]['ok'] is False and 'missing' in results[13]['error']
+    assert results[14]['ok'] is False
+    assert results[15]['ok'] and results[15]['type'] == 'dir'
+
+    files = tmp_path/'run'/'env'/'files'
+    assert sorted( p.name for p in files.iterdir() ) == [ 'input.txt' ]
+    assert os.readlink(files/'input.txt') == str(tmp_path/'input.txt')
+    assert os.access(tmp_path/'run'/'env'/'run.sh',os.X_OK)
+    assert (tmp_path/'copy'/'input.txt').read_text() == 'hello'
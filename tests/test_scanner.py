@@ -0,0 +1,88 @@
+import pytest
+import os
+import json
+import katapult.scanner as scanner
+from katapult.scanner import KatapultImportCache , scan_python_imports , scan_file , SCAN_PARALLEL_MIN
+from katapult.provider import guess_environment
+
+def write_file(path,content,mtime=None):
+    path.parent.mkdir(parents=True,exist_ok=True)
+    path.write_text(content)
+    if mtime is not None:
+        os.utime(path,(mtime,mtime))
+    return str(path)
+
+def test_scan_relative_imports():
+    content = "\n".join([
+        "from . import sibling" ,
+        "from .module import name" ,
+        "from ..package.module import other" ,
+        "import numpy as np" ,
+        "import os.path , requests" ,
+        "from pandas.core import frame" ,
+        "def f():" ,
+        "    import scipy.linalg" ,
+    ])
+    assert sorted(scan_python_imports(content)) == [ 'numpy' , 'os' , 'pandas' , 'requests' , 'scipy' ]
+
+def test_scan_unparsable_file(tmp_path):
+    # python2: scanned with the regular expressions
+    path = write_file(tmp_path/'old.py',"import numpy\nprint 'hello'\nfrom six import moves\n")
+    assert scan_file(path) == [ 'numpy' , 'six' ]
+    assert scan_file(str(tmp_path/'missing.py')) is None
+
+def test_guess_environment_stdlib(tmp_path,monkeypatch):
+    write_file(tmp_path/'main.py',"import os , sys , json\nfrom collections import OrderedDict\nimport numpy\nfrom . import helpers\n")
+    write_file(tmp_path/'lib'/'helpers.py',"import asyncio\nimport requests\nimport numpy\n")
+    write_file(tmp_path/'model.jl',"using DataFrames\nPkg.add(\"CSV\")\n")
+    write_file(tmp_path/'.hidden'/'skipped.py',"import flask\n")
+    monkeypatch.chdir(tmp_path)
+
+    env , files = guess_environment('env-test',str(tmp_path))
+    assert sorted(env['env_pypi']) == [ 'numpy' , 'requests' ]
+    assert sorted(env['env_julia']) == [ 'CSV' , 'DataFrames' ]
+    assert 'julia' in env['env_conda']
+    assert len(files) == 3
+
+def test_import_cache_mtime(tmp_path,monkeypatch):
+    cache_file = str(tmp_path/'imports.json')
+    path       = write_file(tmp_path/'job.py',"import numpy\n",mtime=1000000000)
+    assert KatapultImportCache(cache_file).scan([ path ]) == { path : [ 'numpy' ] }
+
+    cache = KatapultImportCache(cache_file)
+    cache.scan([ path ])
+    cache.save()
+    assert json.loads(open(cache_file).read())[os.path.abspath(path)][2] == [ 'numpy' ]
+
+    # unchanged: served from the (saved) cache
+    scanned = []
+    def counting(abs_path):
+        scanned.append(abs_path)
+        return scan_file(abs_path)
+    monkeypatch.setattr(scanner,'scan_file',counting)
+    assert KatapultImportCache(cache_file).scan([ path ]) == { path : [ 'numpy' ] }
+    assert scanned == []
+
+    # modified: parsed again
+    write_file(tmp_path/'job.py',"import numpy\nimport pandas\n",mtime=1000000001)
+    assert KatapultImportCache(cache_file).scan([ path ]) == { path : [ 'numpy' , 'pandas' ] }
+    assert scanned == [ os.path.abspath(path) ]
+
+def test_import_cache_parallel(tmp_path,monkeypatch):
+    pools = []
+    class RecordingPool(scanner.ProcessPoolExecutor):
+        def __init__(self,*args,**kwargs):
+            pools.append(self)
+            super().__init__(*args,**kwargs)
+    monkeypatch.setattr(scanner,'ProcessPoolExecutor',RecordingPool)
+
+    paths = [ write_file(tmp_path/'pkg'/('module{0}.py'.format(i)),"import os\nimport package{0}\n".format(i)) for i in range(SCAN_PARALLEL_MIN+8) ]
+    result = KatapultImportCache(str(tmp_path/'imports.json')).scan(paths)
+    assert len(pools) == 1
+    for i , path in enumerate(paths):
+        assert result[path] == [ 'os' , 'package{0}'.format(i) ]
+
+    # below the threshold: scanned in this process
+    result = KatapultImportCache(str(tmp_path/'other.json')).scan(paths[:4],parallel_min=SCAN_PARALLEL_MIN)
+    assert len(pools) == 1
+    assert result[paths[3]] == [ 'os' , 'package3' ]
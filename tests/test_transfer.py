@@ -0,0 +1,148 @@
+import pytest
+import os
+import json
+import hashlib
+import asyncssh
+from katapult.transfer import KatapultChunkedTransfer
+
+CHUNK_SIZE = 1024
+
+# in-memory SFTP client: remote path -> bytearray
+class MemorySFTP():
+
+    def __init__(self,files=None):
+        self.files      = files if files is not None else dict()
+        self.writes     = 0
+        self.reads      = 0
+        self.fail_after = None  # the connection drops after this many writes/reads
+        self.corrupt    = 0     # number of writes to corrupt
+
+    async def open(self,path,mode):
+        if 'r' in mode and path not in self.files:
+            raise asyncssh.sftp.SFTPNoSuchFile(path)
+        if mode == 'wb':
+            self.files[path] = bytearray()
+        return MemoryFile(self,path)
+
+class MemoryFile():
+
+    def __init__(self,sftp,path):
+        self._sftp = sftp
+        self._path = path
+
+    async def write(self,data,offset):
+        if self._sftp.fail_after is not None and self._sftp.writes >= self._sftp.fail_after:
+            raise ConnectionError('connection lost')
+        self._sftp.writes += 1
+        if self._sftp.corrupt > 0:
+            self._sftp.corrupt -= 1
+            data = bytes([ data[0] ^ 0xff ]) + data[1:]
+        content = self._sftp.files[self._path]
+        if len(content) < offset + len(data):
+            content.extend( bytes( offset + len(data) - len(content) ) )
+        content[offset:offset+len(data)] = data
+
+    async def read(self,length,offset):
+        if self._sftp.fail_after is not None and self._sftp.reads >= self._sftp.fail_after:
+            raise ConnectionError('connection lost')
+        self._sftp.reads += 1
+        return bytes( self._sftp.files[self._path][offset:offset+length] )
+
+    async def close(self):
+        pass
+
+def get_transfer(sftp,tmp_path,parallel=1):
+    async def hash_local(path):
+        with open(path,'rb') as the_file:
+            return hashlib.sha256(the_file.read()).hexdigest()
+    async def hash_remote(path):
+        return hashlib.sha256(bytes(sftp.files[path])).hexdigest()
+    return KatapultChunkedTransfer([ sftp ],hash_local,hash_remote,chunk_size=CHUNK_SIZE,parallel=parallel,journal_dir=str(tmp_path/'journal'))
+
+def write_source(tmp_path,num_chunks,seed=b'x'):
+    path = tmp_path / 'input.bin'
+    path.write_bytes( hashlib.sha256(seed).digest() * ( num_chunks * CHUNK_SIZE // 32 ) )
+    return str(path)
+
+def get_journals(tmp_path):
+    journal_dir = tmp_path / 'journal'
+    return [ json.loads(p.read_text()) for p in journal_dir.glob('*.json') ] if journal_dir.exists() else []
+
+@pytest.mark.asyncio
+async def test_chunked_put(tmp_path):
+    source = write_source(tmp_path,8)
+    sftp   = MemorySFTP()
+    await get_transfer(sftp,tmp_path,parallel=4).put(source,'/remote/input.bin')
+    assert bytes(sftp.files['/remote/input.bin']) == open(source,'rb').read()
+    assert sftp.writes == 8
+    # the journal is removed once the transfer is verified
+    assert get_journals(tmp_path) == []
+
+@pytest.mark.asyncio
+async def test_chunked_put_resume(tmp_path):
+    source = write_source(tmp_path,8)
+    sftp   = MemorySFTP()
+    sftp.fail_after = 3
+    with pytest.raises(ConnectionError):
+        await get_transfer(sftp,tmp_path).put(source,'/remote/input.bin')
+    journals = get_journals(tmp_path)
+    assert len(journals) == 1 and sorted(journals[0]['done']) == [ 0 , 1 , 2 ]
+
+    # only the missing chunks are sent again
+    sftp.fail_after = None
+    sftp.writes     = 0
+    await get_transfer(sftp,tmp_path).put(source,'/remote/input.bin')
+    assert sftp.writes == 5
+    assert bytes(sftp.files['/remote/input.bin']) == open(source,'rb').read()
+    assert get_journals(tmp_path) == []
+
+@pytest.mark.asyncio
+async def test_chunked_put_corrupted(tmp_path):
+    source = write_source(tmp_path,4)
+    sftp   = MemorySFTP()
+    # checksum mismatch: the file is sent again from scratch
+    sftp.corrupt = 1
+    await get_transfer(sftp,tmp_path).put(source,'/remote/input.bin')
+    assert sftp.writes == 8
+    assert bytes(sftp.files['/remote/input.bin']) == open(source,'rb').read()
+
+    # ... once
+    sftp.corrupt = 5
+    with pytest.raises(OSError,match='checksum mismatch'):
+        await get_transfer(sftp,tmp_path).put(source,'/remote/input.bin')
+    assert get_journals(tmp_path) == []
+
+@pytest.mark.asyncio
+async def test_chunked_put_stale_journal(tmp_path):
+    source = write_source(tmp_path,8)
+    sftp   = MemorySFTP()
+    sftp.fail_after = 3
+    with pytest.raises(ConnectionError):
+        await get_transfer(sftp,tmp_path).put(source,'/remote/input.bin')
+
+    # the source has changed since: the journal doesn't apply anymore
+    source = write_source(tmp_path,6,seed=b'y')
+    os.utime(source,(0,0))
+    sftp.fail_after = None
+    sftp.writes     = 0
+    await get_transfer(sftp,tmp_path).put(source,'/remote/input.bin')
+    assert sftp.writes == 6
+    assert bytes(sftp.files['/remote/input.bin']) == open(source,'rb').read()
+
+@pytest.mark.asyncio
+async def test_chunked_get_resume(tmp_path):
+    content = hashlib.sha256(b'z').digest() * ( 8 * CHUNK_SIZE // 32 )
+    sftp    = MemorySFTP({ '/remote/output.bin' : bytearray(content) })
+    target  = str(tmp_path/'output.bin')
+    sftp.fail_after = 3
+    with pytest.raises(ConnectionError):
+        await get_transfer(sftp,tmp_path).get('/remote/output.bin',target,len(content))
+    assert len(get_journals(tmp_path)) == 1
+
+    # the chunks already written locally are kept
+    sftp.fail_after = None
+    sftp.reads      = 0
+    await get_transfer(sftp,tmp_path).get('/remote/output.bin',target,len(content))
+    assert sftp.reads == 5
+    assert open(target,'rb').read() == content
+    assert get_journals(tmp_path) == []
@@ -0,0 +1,63 @@
+import pytest
+import os
+import katapult.utils as katapultutils
+from katapult.core import KatapultEnvironment
+
+@pytest.fixture
+def computed(monkeypatch):
+    # counts the environments really computed (the others come from the cache)
+    calls   = []
+    compute = katapultutils._compute_environment_object
+    def counting(env_config):
+        calls.append(env_config)
+        return compute(env_config)
+    monkeypatch.setattr(katapultutils,'_compute_environment_object',counting)
+    katapultutils.invalidate_environment_cache()
+    yield calls
+    katapultutils.invalidate_environment_cache()
+
+def write_requirements(tmp_path,packages,mtime):
+    path = tmp_path / 'requirements.txt'
+    path.write_text('\n'.join(packages)+'\n')
+    os.utime(path,(mtime,mtime))
+    return str(path)
+
+def test_env_cache_hit(tmp_path,computed):
+    env_config = { 'name' : 'env-test' , 'env_pypi' : write_requirements(tmp_path,['numpy'],1000000000) }
+
+    env1 = KatapultEnvironment('project',env_config)
+    obj1 = env1.get_env_obj()
+    env2 = KatapultEnvironment('project',dict(env_config))
+    obj2 = env2.get_env_obj()
+
+    assert len(computed) == 1
+    assert env1.get_hash() == env2.get_hash()
+    assert obj1 == obj2
+    # the callers get their own copy
+    obj1['name'] = 'changed'
+    assert env2.get_env_obj()['name'] == 'env-test'
+    assert len(computed) == 1
+
+def test_env_cache_file_changed(tmp_path,computed):
+    env_config = { 'name' : 'env-test' , 'env_pypi' : write_requirements(tmp_path,['numpy'],1000000000) }
+    env1 = KatapultEnvironment('project',env_config)
+    assert len(computed) == 1
+
+    # the referenced requirements file has changed: the environment is computed again
+    write_requirements(tmp_path,['numpy','pandas'],1000000001)
+    env2 = KatapultEnvironment('project',env_config)
+    assert len(computed) == 2
+    assert env1.get_hash() != env2.get_hash()
+    assert 'pandas' in str(env2.get_env_obj()['env_pypi'])
+
+def test_env_cache_invalidate(tmp_path,computed):
+    env_config = { 'name' : 'env-test' , 'env_pypi' : write_requirements(tmp_path,['numpy'],1000000000) }
+    other      = { 'name' : 'env-other' , 'env_aptget' : [ 'git' ] }
+    KatapultEnvironment('project',env_config)
+    KatapultEnvironment('project',other)
+    assert len(computed) == 2
+
+    katapultutils.invalidate_environment_cache(env_config)
+    KatapultEnvironment('project',env_config)
+    KatapultEnvironment('project',other)
+    assert len(computed) == 3